@@ -0,0 +1,91 @@
+"""
+Date: 2026-10-18
+Purpose: Benchmark the vectorized concept aggregation in tdap_aggregate against the per group python path
+(groupby aggregation with a python mode callable per group, the get_mode_1 approach).  tests/test_aggregate.py checks
+the two give identical results.
+
+python benchmarks/bench_aggregate.py --patients 200 --rows_per_patient 2000
+"""
+#####################
+# imports and config
+#####################
+import argparse
+import sys
+from pathlib import Path
+from time import perf_counter
+import numpy as np
+import pandas as pd
+
+# repo root on the path so sibling modules import when run from anywhere
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import tdap_aggregate
+
+parser = argparse.ArgumentParser(description="Benchmark vectorized concept aggregation")
+parser.add_argument('--patients', type=int, default=200)
+parser.add_argument('--rows_per_patient', type=int, default=2000)
+parser.add_argument('--period', type=str, default='H')
+parser.add_argument('--seed', type=int, default=42)
+
+
+def make_rows(patients, rows_per_patient, seed):
+    """
+    High frequency flowsheet style rows - several readings per hour per patient, values drawn from a small set
+    so the mode is meaningful
+    """
+    rng = np.random.default_rng(seed)
+    n = patients * rows_per_patient
+    df = pd.DataFrame({
+        'person_id': np.repeat(np.arange(patients), rows_per_patient),
+        'measurement_datetime': pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 7*24*3600, n), unit='s'),
+        'value_as_number': rng.integers(60, 120, n).astype(float),
+    })
+    df['value_source_value'] = df['value_as_number'].astype(int).astype(str)
+    return df
+
+
+def get_mode_1(x):
+    """
+    Reference per group mode, as used by the per patient path
+    """
+    m = x.mode()
+    return m.iloc[0] if len(m) > 0 else np.nan
+
+
+def per_group_path(df, concept_key, value_col, period, origindatatype):
+    """
+    The per group python path - one groupby with a python callable for the mode of every group
+    """
+    df = df.copy()
+    df['key_time'] = df['measurement_datetime'].dt.to_period(period).dt.start_time
+    df = df.sort_values(['person_id', 'key_time', 'measurement_datetime'], kind='mergesort')
+    if origindatatype == 'numeric':
+        aggs = ['first', 'last', 'min', 'max', 'mean', get_mode_1, 'std']
+        names = tdap_aggregate.NUMERIC_AGGS
+    else:
+        df[value_col] = df[value_col].astype('string')
+        aggs = ['first', 'last', get_mode_1, lambda x: ','.join(x.dropna().astype(str))]
+        names = tdap_aggregate.STRING_AGGS
+    agg_df = df.groupby(['person_id', 'key_time'])[value_col].agg(aggs)
+    agg_df.columns = [f"{concept_key}_{value_col}_{a}" for a in names]
+    return agg_df
+
+
+def time_it(func, *args, **kwargs):
+    start = perf_counter()
+    ret = func(*args, **kwargs)
+    return ret, perf_counter() - start
+
+
+def main():
+    args = parser.parse_args()
+    df = make_rows(args.patients, args.rows_per_patient, args.seed)
+    print(f"{df.shape[0]:,} raw rows, {args.patients} patients, period {args.period}")
+    for origindatatype, value_col in [('numeric', 'value_as_number'), ('string', 'value_source_value')]:
+        ref_df, ref_secs = time_it(per_group_path, df, 'bench', value_col, args.period, origindatatype)
+        vec_df, vec_secs = time_it(tdap_aggregate.aggregate_concept_rows, df, 'bench', value_col, 'measurement_datetime',
+                                   args.period, origindatatype)
+        print(f"{origindatatype:8s} per group {ref_secs:8.3f}s  vectorized {vec_secs:8.3f}s  speedup {ref_secs/vec_secs:6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Date: 2026-10-18
+Purpose: Benchmark for tdap_fill.  A row by row reference implementation of the forwardfill / fill to normal rules
+and the column batched fill are timed on one larger stacked frame.  tests/test_fill.py checks the two agree.
+
+python benchmarks/bench_fill.py --patients 100 --rows_per_patient 168
+"""
+#####################
+# imports and config
+#####################
+import argparse
+import sys
+from pathlib import Path
+from time import perf_counter
+import numpy as np
+import pandas as pd
+
+# repo root on the path so sibling modules import when run from anywhere
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import tdap_fill
+
+parser = argparse.ArgumentParser(description="Benchmark for the column batched fill")
+parser.add_argument('--patients', type=int, default=100)
+parser.add_argument('--rows_per_patient', type=int, default=24*7)
+parser.add_argument('--cols', type=int, default=20)
+parser.add_argument('--seed', type=int, default=42)
+
+
+def reference_fill(stacked_df, col_list, fillwithnormalmode, filltimetonormal, fillnormalvalue):
+    """
+    Row by row reference - walks each patient and column carrying the last value and a count of periods since it
+    """
+    out_df = stacked_df.sort_values(['person_id', 'key_time'], kind='mergesort').reset_index(drop=True)
+    for c in col_list:
+        values = out_df[c].tolist()
+        last_val = None
+        since = 0
+        prev_pat = None
+        for i, pat in enumerate(out_df['person_id'].tolist()):
+            if pat != prev_pat:
+                last_val = None
+                prev_pat = pat
+            if not pd.isna(values[i]):
+                last_val = values[i]
+                since = 0
+            elif last_val is not None:
+                since += 1
+                if fillwithnormalmode == 'y' and since > filltimetonormal:
+                    values[i] = fillnormalvalue
+                else:
+                    values[i] = last_val
+        out_df[c] = pd.Series(values, dtype=object).infer_objects()
+    return out_df
+
+
+def make_stacked(rng, patients, rows_per_patient, cols, sparsity):
+    n = patients * rows_per_patient
+    data = {
+        'person_id': np.repeat(np.arange(patients), rows_per_patient),
+        'key_time': np.tile(pd.date_range('2024-01-01', periods=rows_per_patient, freq='H'), patients),
+    }
+    for i in range(cols):
+        vals = rng.normal(100, 10, n).round(1)
+        data[f"c{i}"] = np.where(rng.random(n) < sparsity, vals, np.nan)
+    df = pd.DataFrame(data)
+    # shuffle so the stacked fill has to sort
+    return df.sample(frac=1, random_state=int(rng.integers(0, 1_000_000))).reset_index(drop=True)
+
+
+def main():
+    args = parser.parse_args()
+    rng = np.random.default_rng(args.seed)
+
+    df = make_stacked(rng, args.patients, args.rows_per_patient, args.cols, 0.05)
+    col_list = [f"c{i}" for i in range(args.cols)]
+    for normal_value in ['unk', 0.0]:
+        start = perf_counter()
+        reference_fill(df, col_list, 'y', 4, normal_value)
+        ref_secs = perf_counter() - start
+        start = perf_counter()
+        tdap_fill.fill_columns_stacked(df.copy(), col_list, 'y', 4, normal_value)
+        vec_secs = perf_counter() - start
+        print(f"{df.shape[0]:,} rows x {args.cols} cols, normal value {normal_value!r:6}  reference {ref_secs:8.3f}s  batched {vec_secs:8.3f}s  speedup {ref_secs/vec_secs:6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+"""
+Date: 2026-10-18
+Purpose: Reproducible end to end benchmark of the TDAP pipeline on a synthetic OMOP CDM.  A seeded CDM is generated
+with synthetic_omop, the dev_omop style config is pointed at it, and each stage is timed:
+
+    generate    - writing the synthetic CDM
+    extract     - concept SQL joined to windows staged by tdap_omop_batch, in chunks of databases.omop.chunk_size windows
+    aggregate   - period alignment and down sampling of every concept (tdap_aggregate)
+    fill        - forwardfill of the stacked matrix (tdap_fill)
+    write       - bulk matrix write to a SQLite destination (tdap_writer)
+    run_omop_serial / run_omop_parallel
+                - the full per patient run_omop, serially and through the worker pool.  Needs the tapestry package;
+                  skipped with a note when it is not installed.
+
+Each stage reports seconds, patients/s, rows/s and the peak RSS of the process (and of pool workers for the parallel
+stage).  Every run is appended as one JSON line to benchmarks/results/bench_pipeline.jsonl with the git commit, so
+runs on different versions can be lined up with --compare.  A stage more than --threshold slower than the previous run
+with the same parameters is flagged.
+
+python benchmarks/bench_pipeline.py --persons 500 --events_per_person 1000 --processes 4
+python benchmarks/bench_pipeline.py --compare 10
+"""
+#####################
+# imports and config
+#####################
+import argparse
+import json
+import resource
+import subprocess
+import sys
+from datetime import datetime
+from multiprocessing import Pool
+from pathlib import Path
+from time import perf_counter
+import pandas as pd
+from sqlalchemy import create_engine, text, BigInteger, DateTime, Float, Text
+
+# repo root on the path so sibling modules import when run from anywhere
+REPO_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO_ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import tdap_aggregate
+import tdap_config_graph
+import tdap_fill
+import tdap_omop_batch
+from tdap_writer import TDAPMatrixWriter
+import synthetic_omop
+
+# value column aggregated for each origintype
+DOMAIN_VALUE_COLS = {
+    'measurement': ('value_as_number', 'numeric'),
+    'observation': ('value_as_number', 'numeric'),
+    'condition_occurrence': ('condition_source_value', 'string'),
+    'drug_exposure': ('drug_source_value', 'string'),
+    'procedure_occurrence': ('procedure_source_value', 'string'),
+    'device_exposure': ('device_source_value', 'string')
+}
+
+parser = argparse.ArgumentParser(description="End to end TDAP pipeline benchmark on a synthetic OMOP CDM")
+parser.add_argument('--config_key', type=str, default='dev_omop')
+parser.add_argument('--work_dir', type=str, default='benchmarks/work')
+parser.add_argument('--results_path', type=str, default='benchmarks/results/bench_pipeline.jsonl')
+parser.add_argument('--persons', type=int, default=500)
+parser.add_argument('--events_per_person', type=int, default=1000)
+parser.add_argument('--days', type=int, default=14)
+parser.add_argument('--seed', type=int, default=42)
+parser.add_argument('--processes', type=int, default=4)
+parser.add_argument('--label', type=str, default=None, help="free text stored with the run, e.g. the change under test")
+parser.add_argument('--threshold', type=float, default=0.10, help="slowdown vs the previous comparable run to flag")
+parser.add_argument('--compare', type=int, default=None, help="print the last N stored runs per stage and exit")
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def get_git_version():
+    try:
+        sha = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, capture_output=True, text=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_ROOT, capture_output=True,
+                               text=True).stdout.strip()
+        return sha + ('-dirty' if dirty else '')
+    except OSError:
+        return None
+
+
+class StageTimer:
+    """
+    Records seconds, throughput and peak RSS for each stage
+    """
+    def __init__(self):
+        self.stage_list = []
+
+    def run(self, name, func, *args, patients=0, rows_func=None, rss_who=resource.RUSAGE_SELF, **kwargs):
+        start = perf_counter()
+        ret = func(*args, **kwargs)
+        seconds = perf_counter() - start
+        rows = rows_func(ret) if rows_func is not None else 0
+        self.stage_list.append({'stage': name, 'seconds': round(seconds, 4), 'patients': patients, 'rows': rows,
+                                'patients_per_s': round(patients / seconds, 2) if seconds > 0 else None,
+                                'rows_per_s': round(rows / seconds, 1) if seconds > 0 else None,
+                                'peak_rss_mb': round(peak_rss_mb(rss_who), 1)})
+        print(f"{name:20s}{seconds:9.2f}s  {patients / seconds if seconds > 0 else 0:10,.1f} patients/s  "
+              f"{rows / seconds if seconds > 0 else 0:12,.0f} rows/s  peak rss {peak_rss_mb(rss_who):8,.0f} MB")
+        return ret
+
+    def skip(self, name, reason):
+        self.stage_list.append({'stage': name, 'skipped': reason})
+        print(f"{name:20s}skipped - {reason}")
+
+
+##########################
+# stages
+##########################
+def get_bench_config(tdap_config, db_path):
+    """
+    The config with its omop database pointed at the synthetic CDM.  The secret is what ucdripydbutils is handed;
+    get_engine below resolves it to a SQLite engine.
+    """
+    databases = dict(tdap_config.get('databases'))
+    databases['omop'] = {**databases.get('omop'), 'secret': {'bench_sqlite_path': str(db_path)}}
+    return {**tdap_config, 'databases': databases}
+
+
+def get_engine(connect_dict, *args, **kwargs):
+    return create_engine(f"sqlite:///{connect_dict['bench_sqlite_path']}")
+
+
+def get_process_df(pop_df, days):
+    process_df = pop_df.copy()
+    process_df['end_time'] = process_df['start_time'] + pd.Timedelta(days=days)
+    process_df['start_time_str'] = process_df['start_time'].astype(str)
+    process_df['end_time_str'] = process_df['end_time'].astype(str)
+    process_df['visit_occurrence_id_list'] = None
+    process_df['id_type'] = 'person_id'
+    process_df['window_id'] = range(process_df.shape[0])
+    return process_df
+
+
+def get_extract_sql(origintype, concept_id_list, window_table_name):
+    """
+    Pulls every row of one concept for a staged chunk of windows, tagged with the window it falls in
+    """
+    domain = tdap_omop_batch.OMOP_DOMAINS[origintype]
+    col_str = ', '.join(f"c.{c}" for c in [domain['id_col'], domain['datetime_col']] + domain['value_cols'])
+    id_str = ', '.join(str(x) for x in concept_id_list)
+    return f"""
+    select w.window_id, {col_str}
+    from {domain['table']} c
+    join {window_table_name} w on c.person_id = w.person_id
+        and c.{domain['datetime_col']} >= w.start_time and c.{domain['datetime_col']} <= w.end_time
+    where c.{domain['concept_col']} in ({id_str})
+    """
+
+
+def extract(engine, process_df, tdap_config, logger_name):
+    """
+    Returns window_id -> {concept_key: concept rows}, one query per concept per chunk of windows
+    """
+    omop_config = tdap_config.get('databases').get('omop')
+    concepts = tdap_omop_batch.get_batchable_concepts(tdap_config)
+    window_dict = {}
+    for chunk_df in tdap_omop_batch.chunk_windows(process_df, omop_config.get('chunk_size', 500)):
+        with engine.connect() as conn:
+            window_table_name = tdap_omop_batch.stage_windows(conn, chunk_df, logger_name)
+            for concept_key, concept in concepts.items():
+                props = concept.get('conceptproperties')
+                sql = get_extract_sql(props.get('origintype'), tdap_omop_batch.originid_to_list(props.get('originid')),
+                                      window_table_name)
+                concept_df = pd.read_sql(text(sql), conn)
+                for window_id, window_df in concept_df.groupby('window_id'):
+                    window_dict.setdefault(window_id, {})[concept_key] = window_df.drop(columns='window_id')
+    return window_dict
+
+
+def count_extracted(window_dict):
+    return sum(df.shape[0] for concepts in window_dict.values() for df in concepts.values())
+
+
+def aggregate(window_dict, process_df, tdap_config):
+    """
+    Stacks each concept's frames across windows and aggregates every concept in one pass per concept
+    """
+    person_ids = process_df.set_index('window_id')['person_id']
+    concepts = tdap_omop_batch.get_batchable_concepts(tdap_config)
+    concept_df_dict = {}
+    spec_dict = {}
+    for concept_key, concept in concepts.items():
+        origintype = concept.get('conceptproperties').get('origintype')
+        frame_list = [concept_dict[concept_key].assign(person_id=person_ids[w]) for w, concept_dict in window_dict.items()
+                      if concept_key in concept_dict and concept_dict[concept_key].shape[0] > 0]
+        if len(frame_list) == 0:
+            continue
+        concept_df = pd.concat(frame_list, ignore_index=True)
+        time_col = tdap_omop_batch.OMOP_DOMAINS[origintype]['datetime_col']
+        concept_df[time_col] = pd.to_datetime(concept_df[time_col])
+        value_col, origindatatype = DOMAIN_VALUE_COLS[origintype]
+        concept_df_dict[concept_key] = concept_df
+        spec_dict[concept_key] = {'value_col': value_col, 'time_col': time_col, 'origindatatype': origindatatype,
+                                  'aggs': concept.get('conceptproperties').get('aggregations')}
+    return tdap_aggregate.aggregate_concepts(concept_df_dict, spec_dict, tdap_config.get('period', 'H'))
+
+
+def fill(agg_df, process_df, tdap_config):
+    """
+    Reindexes onto the full period grid of every window, as the matrix is, then forwardfills
+    """
+    period = tdap_config.get('period', 'H')
+    grid_df = pd.concat([pd.DataFrame({'person_id': row.person_id,
+                                       'key_time': pd.date_range(row.start_time, row.end_time, freq=period, inclusive='left')})
+                         for row in process_df.itertuples(index=False)], ignore_index=True)
+    matrix_df = grid_df.merge(agg_df.reset_index(), on=['person_id', 'key_time'], how='left')
+    return tdap_fill.fill_concepts(matrix_df, tdap_config, key_col='person_id', time_col='key_time')
+
+
+def get_output_metadata(matrix_df):
+    """
+    SQLAlchemy column types for the matrix, standing in for the output_metadata run_omop returns
+    """
+    output_metadata = {}
+    for c, dtype in matrix_df.dtypes.items():
+        if pd.api.types.is_datetime64_any_dtype(dtype):
+            output_metadata[c] = DateTime()
+        elif pd.api.types.is_integer_dtype(dtype):
+            output_metadata[c] = BigInteger()
+        elif pd.api.types.is_float_dtype(dtype):
+            output_metadata[c] = Float()
+        else:
+            output_metadata[c] = Text()
+    return output_metadata
+
+
+def write(matrix_df, db_path, logger_name):
+    engine = create_engine(f"sqlite:///{db_path}")
+    output_metadata = get_output_metadata(matrix_df)
+    writer = TDAPMatrixWriter(engine, 'bench_matrix', {}, logger_name)
+    for _, person_df in matrix_df.groupby('person_id', sort=False):
+        writer.write(person_df, output_metadata)
+    writer.close()
+    engine.dispose()
+    return writer.rows_written
+
+
+def get_payload_list(process_df):
+    return [(row.person_id, row.start_time_str, row.end_time_str, row.visit_occurrence_id_list, row.id_type)
+            for row in process_df.itertuples(index=False)]
+
+
+def init_bench_worker(tdap_config, logger_name):
+    # point every engine request at the synthetic CDM before the worker caches its engines
+    from ucdripydbutils import ucdripydbutils
+    import tdap_workers
+    ucdripydbutils.get_engine_from_connect_dict = get_engine
+    tdap_workers.init_worker(tdap_config, logger_name)
+
+
+def run_omop_serial(payload_list, tdap_config, logger_name):
+    import tdap_workers
+    init_bench_worker(tdap_config, logger_name)
+    return [tdap_workers.run_omop_task(payload) for payload in payload_list]
+
+
+def run_omop_parallel(payload_list, tdap_config, logger_name, processes):
+    import tdap_workers
+    with Pool(processes=processes, initializer=init_bench_worker, initargs=(tdap_config, logger_name)) as pool:
+        ret_list = list(pool.imap_unordered(tdap_workers.run_omop_task, payload_list, chunksize=1))
+    return ret_list
+
+
+def count_matrix_rows(ret_list):
+    return sum(ret['matrix_df'].shape[0] for ret in ret_list if isinstance(ret, dict) and ret.get('matrix_df') is not None)
+
+
+##########################
+# stored results
+##########################
+def load_results(results_path):
+    results_path = Path(results_path)
+    if not results_path.exists():
+        return []
+    with open(results_path) as f:
+        return [json.loads(line) for line in f if line.strip() != '']
+
+
+def flag_regressions(run, prior_runs, threshold):
+    """
+    Compares each stage against the latest earlier run with the same parameters
+    """
+    comparable = [r for r in prior_runs if r.get('params') == run['params']]
+    if len(comparable) == 0:
+        print("No earlier run with the same parameters to compare against")
+        return []
+    previous = {s['stage']: s for s in comparable[-1]['stages'] if 'seconds' in s}
+    regression_list = []
+    for s in run['stages']:
+        p = previous.get(s['stage'])
+        if 'seconds' not in s or p is None or p['seconds'] <= 0:
+            continue
+        change = s['seconds'] / p['seconds'] - 1
+        if change > threshold:
+            regression_list.append(s['stage'])
+            print(f"REGRESSION {s['stage']}: {p['seconds']:.2f}s at {comparable[-1]['git']} -> {s['seconds']:.2f}s ({change:+.0%})")
+    if len(regression_list) == 0:
+        print(f"No stage slower than {threshold:.0%} against {comparable[-1]['git']}")
+    return regression_list
+
+
+def compare(results_path, n):
+    run_list = load_results(results_path)[-n:]
+    if len(run_list) == 0:
+        print(f"No stored runs in {results_path}")
+        return
+    record_list = [{'run': f"{r['timestamp'][:16]} {r['git']}", 'stage': s['stage'], 'seconds': s['seconds']}
+                   for r in run_list for s in r['stages'] if 'seconds' in s]
+    print(pd.DataFrame(record_list).pivot_table(index='run', columns='stage', values='seconds', sort=False)
+            .to_string(float_format=lambda x: f"{x:,.2f}"))
+
+
+def main():
+    args = parser.parse_args()
+    if args.compare is not None:
+        compare(args.results_path, args.compare)
+        return
+    import example_tapestry_config as my_tdap_config
+    logger_name = 'bench_pipeline'
+    work_dir = Path(args.work_dir)
+    work_dir.mkdir(parents=True, exist_ok=True)
+    cdm_path = work_dir / 'synthetic_omop.sqlite'
+    matrix_path = work_dir / 'bench_matrix.sqlite'
+    if matrix_path.exists():
+        matrix_path.unlink()
+    # benchmark the config as a run would see it, with its projection applied
+    tdap_config = tdap_config_graph.apply_projection(get_bench_config(my_tdap_config.tdap_configs.get(args.config_key), cdm_path),
+                                                     logger_name)
+
+    timer = StageTimer()
+    row_counts, pop_df = timer.run('generate', synthetic_omop.generate, cdm_path, tdap_config, args.persons,
+                                   args.events_per_person, args.days, args.seed, patients=args.persons,
+                                   rows_func=lambda x: sum(x[0].values()))
+    process_df = get_process_df(pop_df, args.days)
+    engine = get_engine(tdap_config.get('databases').get('omop').get('secret'))
+    window_dict = timer.run('extract', extract, engine, process_df, tdap_config, logger_name, patients=args.persons,
+                            rows_func=count_extracted)
+    engine.dispose()
+    extracted_rows = count_extracted(window_dict)
+    agg_df = timer.run('aggregate', aggregate, window_dict, process_df, tdap_config, patients=args.persons,
+                       rows_func=lambda x: extracted_rows)
+    matrix_df = timer.run('fill', fill, agg_df, process_df, tdap_config, patients=args.persons, rows_func=len)
+    timer.run('write', write, matrix_df, matrix_path, logger_name, patients=args.persons, rows_func=lambda x: x)
+
+    try:
+        import tapestry  # noqa: F401
+        has_tapestry = True
+    except ImportError:
+        has_tapestry = False
+    if has_tapestry:
+        payload_list = get_payload_list(process_df)
+        timer.run('run_omop_serial', run_omop_serial, payload_list, tdap_config, logger_name, patients=args.persons,
+                  rows_func=count_matrix_rows)
+        timer.run('run_omop_parallel', run_omop_parallel, payload_list, tdap_config, logger_name, args.processes,
+                  patients=args.persons, rows_func=count_matrix_rows, rss_who=resource.RUSAGE_CHILDREN)
+    else:
+        for name in ['run_omop_serial', 'run_omop_parallel']:
+            timer.skip(name, "the tapestry package is not installed")
+
+    run = {'timestamp': datetime.now().isoformat(timespec='seconds'), 'git': get_git_version(), 'label': args.label,
+           'params': {'config_key': args.config_key, 'persons': args.persons, 'events_per_person': args.events_per_person,
+                      'days': args.days, 'seed': args.seed, 'processes': args.processes},
+           'python': sys.version.split()[0], 'pandas': pd.__version__, 'row_counts': row_counts, 'stages': timer.stage_list}
+    flag_regressions(run, load_results(args.results_path), args.threshold)
+    results_path = Path(args.results_path)
+    results_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(results_path, 'a') as f:
+        f.write(json.dumps(run, default=str) + '\n')
+    print(f"Stored run in {results_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Date: 2026-10-18
+Purpose: Benchmark for tdap_ts_features.  A per patient, per column reference (pad, convolve, argrelextrema and
+ruptures on each series in turn) and the stacked engine are timed on one larger stacked frame, and the change point
+variants are timed on one long hourly series.  tests/test_ts_features.py checks the two agree.
+
+python benchmarks/bench_ts_features.py --patients 50 --rows_per_patient 168
+"""
+#####################
+# imports and config
+#####################
+import argparse
+import sys
+from pathlib import Path
+from time import perf_counter
+import numpy as np
+import pandas as pd
+from scipy.signal import argrelextrema
+
+# repo root on the path so sibling modules import when run from anywhere
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import tdap_ts_features
+
+parser = argparse.ArgumentParser(description="Benchmark for the stacked time series feature engine")
+parser.add_argument('--patients', type=int, default=50)
+parser.add_argument('--rows_per_patient', type=int, default=24*7)
+parser.add_argument('--cols', type=int, default=8)
+parser.add_argument('--long_series_days', type=int, default=120)
+parser.add_argument('--seed', type=int, default=42)
+
+TS_CONFIG = {
+    "window_len": 4,
+    "window_type": "blackman",
+    "fill_val": 0,
+    "group_level": 0,
+    "peak_order": 2,
+    "peak_suffix": "_peak",
+    "cp_model": "l2",
+    "cp_min_size": 2,
+    "cp_jump": 1,
+    "cp_pen": 10,
+    "cp_suffix": "_cp",
+    "cp_method": "pelt"
+}
+
+
+def reference_features(stacked_df, col_list, ts_config):
+    """
+    One patient and one column at a time
+    """
+    out_df = stacked_df.sort_values(['person_id', 'key_time'], kind='mergesort').reset_index(drop=True)
+    kernel = tdap_ts_features.get_kernel(ts_config['window_type'], ts_config['window_len'])
+    pad_left = (ts_config['window_len'] - 1) // 2
+    pad_right = ts_config['window_len'] - 1 - pad_left
+    cp_kwargs = tdap_ts_features.get_cp_kwargs(ts_config)
+    for c in col_list:
+        smooth_list, peak_list, cp_list = [], [], []
+        for _, pat_df in out_df.groupby('person_id', sort=True):
+            values = pat_df[c].astype(float).fillna(ts_config['fill_val']).to_numpy()
+            smoothed = np.convolve(np.pad(values, (pad_left, pad_right), mode='edge'), kernel[::-1], mode='valid')
+            peaks = np.zeros(len(values), dtype=bool)
+            peaks[argrelextrema(smoothed, np.greater, order=ts_config['peak_order'], mode='clip')[0]] = True
+            cps = np.zeros(len(values), dtype=bool)
+            cps[tdap_ts_features.change_points(values, **cp_kwargs)] = True
+            smooth_list.append(smoothed)
+            peak_list.append(peaks)
+            cp_list.append(cps)
+        out_df[c + '_smooth'] = np.concatenate(smooth_list)
+        out_df[c + ts_config['peak_suffix']] = np.concatenate(peak_list)
+        out_df[c + ts_config['cp_suffix']] = np.concatenate(cp_list)
+    return out_df
+
+
+def make_stacked(rng, patients, rows_per_patient, cols, sparsity):
+    n = patients * rows_per_patient
+    data = {
+        'person_id': np.repeat(np.arange(patients), rows_per_patient),
+        'key_time': np.tile(pd.date_range('2024-01-01', periods=rows_per_patient, freq='H'), patients),
+    }
+    for i in range(cols):
+        # level shifts every few days, so there are change points to find
+        level = np.repeat(rng.normal(100, 20, n // 72 + 1), 72)[:n]
+        vals = (level + rng.normal(0, 3, n)).round(1)
+        data[f"c{i}"] = np.where(rng.random(n) < sparsity, vals, np.nan)
+    df = pd.DataFrame(data)
+    # shuffle so the stacked engine has to sort
+    return df.sample(frac=1, random_state=int(rng.integers(0, 1_000_000))).reset_index(drop=True)
+
+
+def main():
+    args = parser.parse_args()
+    rng = np.random.default_rng(args.seed)
+
+    # timing
+    df = make_stacked(rng, args.patients, args.rows_per_patient, args.cols, 0.9)
+    col_list = [f"c{i}" for i in range(args.cols)]
+    start = perf_counter()
+    reference_features(df, col_list, TS_CONFIG)
+    ref_secs = perf_counter() - start
+    start = perf_counter()
+    tdap_ts_features.add_ts_features(df.copy(), TS_CONFIG, col_list, key_col='person_id')
+    vec_secs = perf_counter() - start
+    print(f"{df.shape[0]:,} rows x {args.cols} cols  reference {ref_secs:8.3f}s  stacked {vec_secs:8.3f}s  "
+          f"speedup {ref_secs/vec_secs:6.1f}x")
+
+    # long series change points
+    long_df = make_stacked(rng, 1, 24 * args.long_series_days, 1, 1.0)
+    signal = long_df.sort_values('key_time')['c0'].to_numpy()
+    for cp_method in ['auto', 'binseg', 'pelt']:
+        start = perf_counter()
+        found = tdap_ts_features.change_points(signal, **tdap_ts_features.get_cp_kwargs({**TS_CONFIG, 'cp_method': cp_method}))
+        print(f"{len(signal):,} period series  {cp_method:6}  {perf_counter() - start:8.3f}s  {len(found)} change points")
+
+
+if __name__ == "__main__":
+    main()
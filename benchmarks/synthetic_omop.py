@@ -0,0 +1,161 @@
+"""
+Date: 2026-10-18
+Purpose: Synthetic OMOP CDM generator for benchmarks.  Writes person, visit_occurrence and the six clinical event tables
+(measurement, condition_occurrence, drug_exposure, procedure_occurrence, observation, device_exposure) into a SQLite
+file at a configurable scale.  Event concept ids are drawn from the concepts of a tdap config so its queries hit, with
+a share of unrelated concept ids mixed in as the noise a real CDM carries.  Everything is seeded, so the same arguments
+always produce the same database.
+
+python benchmarks/synthetic_omop.py --db_path benchmarks/synthetic_omop.sqlite --persons 1000 --events_per_person 2000
+"""
+#####################
+# imports and config
+#####################
+import argparse
+import sqlite3
+import sys
+from pathlib import Path
+from time import perf_counter
+import numpy as np
+import pandas as pd
+
+# repo root on the path so sibling modules import when run from anywhere
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import tdap_omop_batch
+
+# share of events per domain, roughly what a hospital CDM looks like
+DOMAIN_SHARES = {
+    'measurement': 0.55,
+    'observation': 0.15,
+    'drug_exposure': 0.15,
+    'condition_occurrence': 0.07,
+    'procedure_occurrence': 0.05,
+    'device_exposure': 0.03
+}
+# share of events whose concept is not one the config asks for
+NOISE_SHARE = 0.5
+NOISE_CONCEPT_IDS = list(range(9000000, 9000050))
+
+parser = argparse.ArgumentParser(description="Generate a synthetic OMOP CDM into SQLite")
+parser.add_argument('--db_path', type=str, default='benchmarks/synthetic_omop.sqlite')
+parser.add_argument('--config_key', type=str, default='dev_omop')
+parser.add_argument('--persons', type=int, default=1000)
+parser.add_argument('--events_per_person', type=int, default=2000)
+parser.add_argument('--days', type=int, default=30)
+parser.add_argument('--seed', type=int, default=42)
+
+
+def get_domain_concept_ids(tdap_config):
+    """
+    origintype -> concept ids asked for by the config's concepts
+    """
+    domain_ids = {k: [] for k in tdap_omop_batch.OMOP_DOMAINS}
+    for concept in tdap_omop_batch.get_batchable_concepts(tdap_config).values():
+        props = concept.get('conceptproperties')
+        domain_ids[props.get('origintype')].extend(tdap_omop_batch.originid_to_list(props.get('originid')))
+    return domain_ids
+
+
+def make_persons(rng, persons, start_time):
+    person_df = pd.DataFrame({
+        'person_id': np.arange(1, persons + 1),
+        'gender_concept_id': rng.choice([8507, 8532], persons),
+        'year_of_birth': rng.integers(1930, 2005, persons),
+        'race_concept_id': rng.choice([8527, 8516, 8515, 0], persons),
+        'ethnicity_concept_id': rng.choice([38003563, 38003564], persons),
+    })
+    visit_df = pd.DataFrame({
+        'visit_occurrence_id': person_df['person_id'],
+        'person_id': person_df['person_id'],
+        'visit_concept_id': 9201,
+        'visit_start_datetime': start_time,
+        'visit_end_datetime': start_time + pd.Timedelta(days=7),
+    })
+    return person_df, visit_df
+
+
+def make_events(rng, domain, person_ids, concept_ids, start_time, days, id_offset):
+    """
+    One domain's events for the given person_ids, which the caller draws with skewed weights so some patients are much heavier than others.
+    """
+    definition = tdap_omop_batch.OMOP_DOMAINS[domain]
+    n = len(person_ids)
+    concept_pool = np.array(concept_ids if len(concept_ids) > 0 else NOISE_CONCEPT_IDS[:1])
+    is_noise = rng.random(n) < NOISE_SHARE
+    event_df = pd.DataFrame({
+        definition['id_col']: np.arange(id_offset, id_offset + n),
+        'person_id': person_ids,
+        definition['concept_col']: np.where(is_noise, rng.choice(NOISE_CONCEPT_IDS, n), rng.choice(concept_pool, n)),
+        definition['datetime_col']: start_time + pd.to_timedelta(rng.integers(0, days * 24 * 3600, n), unit='s'),
+    })
+    numbers = rng.normal(50, 15, n).round(1)
+    for c in definition['value_cols']:
+        if c.endswith('_datetime'):
+            event_df[c] = event_df[definition['datetime_col']] + pd.to_timedelta(rng.integers(0, 72, n), unit='h')
+        elif c.endswith('_concept_id'):
+            event_df[c] = rng.choice([0, 4181412, 45877994], n)
+        elif c in ('value_as_number', 'quantity'):
+            event_df[c] = np.where(rng.random(n) < 0.05, np.nan, numbers)
+        else:
+            # *_source_value / value_as_string - a small vocabulary so modes and lists are meaningful
+            event_df[c] = pd.Series(rng.integers(0, 20, n)).map(lambda x: f"code_{x}")
+    return event_df
+
+
+def generate(db_path, tdap_config, persons=1000, events_per_person=2000, days=30, seed=42):
+    """
+    Builds the synthetic CDM at db_path, replacing any file already there.
+    Returns a dict of table -> row count and the population (person_id, start_time) to run.
+    """
+    rng = np.random.default_rng(seed)
+    db_path = Path(db_path)
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    if db_path.exists():
+        db_path.unlink()
+    start_time = pd.Timestamp('2024-01-01')
+    person_df, visit_df = make_persons(rng, persons, start_time)
+    domain_ids = get_domain_concept_ids(tdap_config)
+    # lognormal weights give a long tail of heavy patients
+    weights = rng.lognormal(0, 1, persons)
+    weights = weights / weights.sum()
+
+    row_counts = {}
+    conn = sqlite3.connect(str(db_path))
+    try:
+        person_df.to_sql('person', conn, index=False)
+        visit_df.to_sql('visit_occurrence', conn, index=False)
+        row_counts['person'] = person_df.shape[0]
+        row_counts['visit_occurrence'] = visit_df.shape[0]
+        total_events = persons * events_per_person
+        id_offset = 1
+        for domain, share in DOMAIN_SHARES.items():
+            n = int(total_events * share)
+            person_ids = rng.choice(person_df['person_id'].to_numpy(), n, p=weights)
+            event_df = make_events(rng, domain, person_ids, domain_ids[domain], start_time, days, id_offset)
+            event_df.to_sql(tdap_omop_batch.OMOP_DOMAINS[domain]['table'], conn, index=False, chunksize=100000)
+            definition = tdap_omop_batch.OMOP_DOMAINS[domain]
+            conn.execute(f"create index ix_{domain}_person on {definition['table']} (person_id, {definition['concept_col']}, {definition['datetime_col']})")
+            row_counts[definition['table']] = n
+            id_offset += n
+        conn.commit()
+    finally:
+        conn.close()
+    pop_df = pd.DataFrame({'person_id': person_df['person_id'], 'start_time': start_time})
+    return row_counts, pop_df
+
+
+def main():
+    args = parser.parse_args()
+    import example_tapestry_config as my_tdap_config
+    tdap_config = my_tdap_config.tdap_configs.get(args.config_key)
+    start = perf_counter()
+    row_counts, _ = generate(args.db_path, tdap_config, args.persons, args.events_per_person, args.days, args.seed)
+    seconds = perf_counter() - start
+    total = sum(row_counts.values())
+    print(f"Wrote {total:,} rows to {args.db_path} in {seconds:.1f}s ({total/seconds:,.0f} rows/s)")
+    for table, n in row_counts.items():
+        print(f"    {table:24s}{n:>12,}")
+
+
+if __name__ == "__main__":
+    main()
@@ -17,10 +17,11 @@ import distutils.util
 import sys
 import atexit
 from pathlib import Path
+from sqlalchemy import inspect
 
 # logging imports for multiprocess logging
 import logging
-from multiprocessing import Pool
+from multiprocessing import Pool, Process
 from time import sleep
 
 # ripy
@@ -38,6 +39,23 @@ from tapestry.tapestry import (get_concept_metadata,
 
 # sibling file imports
 import example_tapestry_config as my_tdap_config
+import tdap_omop_batch
+import tdap_workers
+import tdap_dtypes
+import tdap_incremental
+import tdap_schedule
+import tdap_timing
+import tdap_parquet
+import tdap_phases
+import tdap_config_graph
+import tdap_module_dag
+import tdap_concept_cache
+import tdap_pop_index
+import tdap_windows
+from tdap_checkpoint import TDAPCheckpoint
+import tdap_distributed
+from tdap_distributed import ShardQueue
+from tdap_writer import TDAPMatrixWriter
 
 
 ###########################################
@@ -66,6 +84,50 @@ parser.add_argument('--use_named_ad_auth_to_mssql',
                     type=lambda x:bool(distutils.util.strtobool(x)),
                     default=False)
 
+parser.add_argument('--parallel',
+                    help='If True, process patients on a persistent pool of databases.omop.sess_limit worker processes',
+                    type=lambda x:bool(distutils.util.strtobool(x)),
+                    default=False)
+
+parser.add_argument('--stream_write',
+                    help='If True, write each patient matrix as it finishes instead of holding every result in memory',
+                    type=lambda x:bool(distutils.util.strtobool(x)),
+                    default=False)
+
+parser.add_argument('--incremental',
+                    help='If True, only rebuild patients whose source data changed since the last run and merge them into the existing matrix table',
+                    type=lambda x:bool(distutils.util.strtobool(x)),
+                    default=False)
+
+parser.add_argument('--checkpoint',
+                    help='If True, spill each finished patient result to --spill_dir so a failed run can be resumed with --resume',
+                    type=lambda x:bool(distutils.util.strtobool(x)),
+                    default=False)
+
+parser.add_argument('--resume',
+                    help='The run_id of a checkpointed run to resume.  Finished patients are skipped',
+                    type=str,
+                    default=None)
+
+parser.add_argument('--spill_dir',
+                    help='Directory checkpointed runs are spilled to.  Defaults to ./spill',
+                    default=Path.cwd() / 'spill')
+
+parser.add_argument('--role',
+                    help='single runs everything here.  coordinator shards the population into --dist_dir and merges the results, worker runs shards from --dist_dir',
+                    type=str,
+                    choices=['single', 'coordinator', 'worker'],
+                    default='single')
+
+parser.add_argument('--dist_dir',
+                    help='Shared run directory for distributed runs, visible to the coordinator and every worker',
+                    default=None)
+
+parser.add_argument('--local_workers',
+                    help='Number of worker processes the coordinator starts on this host',
+                    type=int,
+                    default=0)
+
 parser.add_argument('--build_number',
                     type=int,
                     help="Optional argument that, when passed, will result in the logfile being named to incldue this number",
@@ -103,12 +165,35 @@ def get_omop_matrix_parallel(data_tuple_list, process_count=4):
         ret_dict_list = p.starmap(run_omop, data_tuple_list)
     return ret_dict_list
 
+#####################################
+# streaming versions of the calls above
+# results are yielded as each patient finishes so they can be
+# handed straight to a writer instead of being held in memory
+# the parallel versions take a persistent pool from tdap_workers.get_worker_pool
+# and send only the small per-patient payload to the workers
+#####################################
+def iter_omop_matrix_serial(data_tuple_list):
+    # one bad patient yields a failure record rather than ending the run, see tdap_workers.call_with_retry
+    for one_tuple in tqdm(data_tuple_list):
+        run_func = tdap_dtypes.get_run_func(one_tuple[5], tdap_module_dag.get_run_func(one_tuple[5], run_omop))
+        yield tdap_timing.call_timed(tdap_workers.call_with_retry, run_func, one_tuple, one_tuple[6],
+                                     **tdap_workers.get_retry_kwargs(one_tuple[5]))
+
+def iter_omop_matrix_parallel(payload_list, pool, ordered=False):
+    # ordered=True yields in payload order, needed when results are matched back to their windows
+    # chunksize 1 so a free worker always takes the next (longest remaining, when cost scheduled) patient
+    map_func = pool.imap if ordered else pool.imap_unordered
+    for ret in map_func(tdap_workers.run_omop_task, payload_list, chunksize=1):
+        yield ret
 
 def get_pop(tdap_config, logger_name):
     """
     This function gets the population for processing
+    With pop_index enabled the population comes from the precomputed index instead, see tdap_pop_index.py
     """
     logger = logging.getLogger(logger_name)
+    if tdap_pop_index.get_pop_index_config(tdap_config).get('enabled', False):
+        return tdap_pop_index.get_pop(tdap_config, logger_name)
     logger.info("Getting the population from OMOP")
     omop_engine = ucdripydbutils.get_engine_from_connect_dict(tdap_config.get('databases').get('omop').get('secret'))
     # get the population
@@ -167,7 +252,7 @@ def get_pop(tdap_config, logger_name):
     return pop_df
 
 
-def create_process_df(df, logger_name):
+def create_process_df(df, logger_name, window_days=7, merge_gap_hours=None, max_window_days=None):
     """
     This function creates a dataframe that sets the population for processing
 
@@ -175,27 +260,64 @@ def create_process_df(df, logger_name):
 
     In this OMOP version we will only support processing by person_id and start/stop times
 
+    With merge_gap_hours set, each person's overlapping windows (and windows within merge_gap_hours of each other)
+    are coalesced into one, no merged window spanning more than max_window_days, see tdap_windows.py
     """
     logger = logging.getLogger(logger_name)
 
     process_df = df.copy()
-    process_df['end_time'] = process_df['start_time'] + pd.Timedelta(days=7)
+    process_df['end_time'] = process_df['start_time'] + pd.Timedelta(days=window_days)
+    if merge_gap_hours is not None:
+        process_df = tdap_windows.coalesce_windows(process_df, merge_gap_hours, max_window_days=max_window_days,
+                                                   logger_name=logger_name)
     process_df['start_time_str'] = process_df['start_time'].dt.strftime('%Y-%m-%d %H:%M:%S')
     process_df['end_time_str'] = process_df['end_time'].dt.strftime('%Y-%m-%d %H:%M:%S')
     process_df['visit_occurrence_id_list'] = None
     process_df['id_type'] = 'person_id'
+    # unique key per window, checkpoints and shards record finished windows by it
+    process_df = process_df.reset_index(drop=True)
+    process_df['window_id'] = process_df.index
 
     return process_df
 
 
-def run(tdap_config, write_to_db, logger_name, pat_limit, parallel=False):
+def get_incremental_process_df(process_df, tdap_config, logger_name):
     """
-    This function is the main function that runs the TDAP process
+    Narrows process_df to the patients whose watermarks moved in any destination database.
+    Returns the narrowed process_df and the dict write_results needs to merge the rebuilt patients and remove the
+    ones that left the population.
     """
     logger = logging.getLogger(logger_name)
-    logger.info("Starting the TDAP run")
-
+    omop_config = tdap_config.get('databases').get('omop')
+    omop_engine = ucdripydbutils.get_engine_from_connect_dict(omop_config.get('secret'))
+    watermark_df = tdap_incremental.get_current_watermarks(omop_engine, process_df, tdap_config, logger_name,
+                                                           chunk_size=omop_config.get('chunk_size', 500))
+    omop_engine.dispose()
 
+    changed_ids = set()
+    dropped_ids = set()
+    for k,v in tdap_config.get('databases').items():
+        if v['dest'] == True:
+            dest_engine = ucdripydbutils.get_engine_from_connect_dict(v.get('secret'))
+            stored_df = tdap_incremental.get_stored_watermarks(dest_engine, tdap_config)
+            if stored_df is None:
+                logger.info(f"No stored watermarks in the {k} database, every patient will be built")
+            changed_ids.update(tdap_incremental.get_changed_person_ids(watermark_df, stored_df))
+            dropped_ids.update(tdap_incremental.get_dropped_person_ids(watermark_df, stored_df))
+            dest_engine.dispose()
+    changed_ids = sorted(changed_ids)
+    logger.info(f"Incremental run - {len(changed_ids)} of {process_df['person_id'].nunique()} patients changed, "
+                f"{len(dropped_ids)} left the population")
+    process_df = process_df.loc[process_df['person_id'].isin(changed_ids)]
+    return process_df, {'person_ids': changed_ids, 'dropped_ids': sorted(dropped_ids), 'watermark_df': watermark_df}
+
+
+def build_process_df(tdap_config, write_to_db, logger_name, pat_limit, incremental=False):
+    """
+    Gets the population and turns it into process_df, narrowed to changed patients for incremental runs and sampled
+    down to pat_limit.  Returns process_df and the incremental state (None unless incremental).
+    """
+    logger = logging.getLogger(logger_name)
     # get the population
     logger.info("Getting the population from OMOP")
     pop_df = get_pop(tdap_config, logger_name)
@@ -203,17 +325,70 @@ def run(tdap_config, write_to_db, logger_name, pat_limit, parallel=False):
 
     # create the process_df
     logger.info("Creating a patient set with start and end times to feed population to TDAP")
-    process_df = create_process_df(pop_df, logger_name)
+    coalesce_config = tdap_windows.get_window_coalesce_config(tdap_config)
+    process_df = create_process_df(pop_df, logger_name,
+                                   window_days=tdap_pop_index.get_pop_index_config(tdap_config).get('window_days', 7),
+                                   merge_gap_hours=coalesce_config.get('merge_gap_hours', 0) if coalesce_config.get('enabled', False) else None,
+                                   max_window_days=coalesce_config.get('max_window_days', 30))
     logger.info(f"Process_df size: {process_df.shape[0]}")
-    process_tuples = list(process_df.filter(['person_id', 'start_time_str', 'end_time_str','visit_occurrence_id_list','id_type']).to_records(index=False))
-    run_args_tuple = (tdap_config, logger_name, 'omop')
-    process_tuples_final = [tuple(x) + run_args_tuple for x in process_tuples]
-    logger.info(f"Process_tuples_final size: {len(process_tuples_final)}")
-    if pat_limit > 0 and pat_limit < len(process_tuples_final):
-        process_tuples_final = sample(process_tuples_final, pat_limit)
+    incremental_dict = None
+    if incremental:
+        if not write_to_db:
+            logger.warning("Incremental mode only applies when writing to a database, running in full")
+        else:
+            process_df, incremental_dict = get_incremental_process_df(process_df, tdap_config, logger_name)
+            if process_df.shape[0] == 0:
+                logger.info("No patients changed since the last run, nothing to rebuild")
+    if incremental_dict is not None:
+        if pat_limit > 0 and pat_limit < process_df['person_id'].nunique():
+            # whole patients, since a rebuild replaces all of a patient's rows.  Everyone else's rows and watermarks
+            # are left alone
+            process_df = tdap_incremental.sample_persons(process_df, pat_limit)
+            incremental_dict['person_ids'] = sorted(set(incremental_dict['person_ids']) & set(process_df['person_id']))
+            logger.info(f"Processing limited to {pat_limit} patients")
+    elif pat_limit > 0 and pat_limit < process_df.shape[0]:
+        process_df = process_df.loc[sample(process_df.index.tolist(), pat_limit)]
         logger.info(f"Processing limited to {pat_limit} patients")
+    return process_df, incremental_dict
+
+
+def schedule_process_df(process_df, tdap_config, logger_name):
+    """
+    Orders process_df most expensive first when databases.omop.schedule is set, so heavy windows don't make up the
+    tail of a parallel run
+    """
+    omop_config = tdap_config.get('databases').get('omop')
+    schedule = omop_config.get('schedule')
+    if schedule is None:
+        return process_df
+    omop_engine = ucdripydbutils.get_engine_from_connect_dict(omop_config.get('secret')) if schedule == 'precount' else None
+    process_df = tdap_schedule.order_by_cost(process_df, tdap_config, logger_name, method=schedule, engine=omop_engine,
+                                             chunk_size=omop_config.get('chunk_size', 500))
+    if omop_engine is not None:
+        omop_engine.dispose()
+    return process_df
+
 
+def get_ret_dict_iter(process_df, tdap_config, logger_name, pool=None, ordered=False):
+    """
+    Picks the serial or parallel (pool given) path for process_df and returns its result iterator.
+    ordered=True yields results in process_df order.
+    """
+    logger = logging.getLogger(logger_name)
+    process_tuples = list(process_df.filter(['person_id', 'start_time_str', 'end_time_str','visit_occurrence_id_list','id_type']).to_records(index=False))
+    if pool is not None:
+        logger.info("Running TDAP on OMOP in parallel using {} processes".format(tdap_config.get('databases').get('omop').get('sess_limit')))
+        process_payloads = [tuple(x) for x in process_tuples]
+        return iter_omop_matrix_parallel(process_payloads, pool, ordered=ordered)
+    else:
+        logger.info("Running TDAP on OMOP in serial")
+        run_args_tuple = (tdap_config, logger_name, 'omop')
+        process_tuples_final = [tuple(x) + run_args_tuple for x in process_tuples]
+        logger.info(f"Process_tuples_final size: {len(process_tuples_final)}")
+        return iter_omop_matrix_serial(process_tuples_final)
 
+
+def log_run_review(tdap_config, logger_name):
     ##########################
     # TDAP - review whats about to be processed
     ##########################
@@ -223,51 +398,351 @@ def run(tdap_config, write_to_db, logger_name, pat_limit, parallel=False):
     print_cleanups(tdap_config, print_or_log='log', logger_name=logger_name)
 
 
+def run(tdap_config, write_to_db, logger_name, pat_limit, parallel=False, stream=False, incremental=False, checkpoint=None):
+    """
+    This function is the main function that runs the TDAP process
+
+    With a TDAPCheckpoint, results are spilled to disk as they finish and the write reads them back from there.
+    A checkpoint that already holds state is a resume: the saved population is reused and finished windows skipped.
+    """
+    logger = logging.getLogger(logger_name)
+    logger.info("Starting the TDAP run")
+
+    if checkpoint is not None and checkpoint.has_state():
+        process_df, incremental_dict = checkpoint.load_state()
+        logger.info(f"Resuming run {checkpoint.run_id} with {process_df.shape[0]} windows")
+    else:
+        process_df, incremental_dict = build_process_df(tdap_config, write_to_db, logger_name, pat_limit, incremental=incremental)
+        if incremental_dict is not None and process_df.shape[0] == 0:
+            # still clear out patients that left the population
+            write_results([], tdap_config, logger_name, incremental_dict=incremental_dict)
+            return
+        if checkpoint is not None:
+            checkpoint.save_state(process_df, incremental_dict)
+            logger.info(f"Checkpointing to {checkpoint.run_dir}.  Resume a failed run with --resume {checkpoint.run_id}")
+
+    # every window of the run, finished or not, for fanning merged windows back out
+    window_df = process_df
+    if checkpoint is not None:
+        completed_ids = checkpoint.completed_window_ids()
+        if len(completed_ids) > 0:
+            logger.info(f"Skipping {len(completed_ids)} windows already finished in run {checkpoint.run_id}")
+        process_df = process_df.loc[~process_df['window_id'].isin(completed_ids)]
+
     if parallel:
-        logger.info("Running TDAP on OMOP in parallel using {} processes".format(tdap_config.get('databases').get('omop').get('sess_limit')))
-        ret_dict_list = get_omop_matrix_parallel(process_tuples_final, process_count=tdap_config.get('databases').get('omop').get('sess_limit'))
-        logger.info("TDAP run complete")
+        process_df = schedule_process_df(process_df, tdap_config, logger_name)
+
+    log_run_review(tdap_config, logger_name)
+
+    if stream:
+        if not write_to_db:
+            logger.warning("Stream mode only applies when writing to a database, falling back to an in memory run")
+            stream = False
+        else:
+            logger.info("Stream mode - results are written as each patient finishes")
+
+    # per stage timing for patients run in this process, workers set themselves up in init_worker
+    tdap_timing.configure(tdap_config)
+    pool = None
+    if parallel:
+        # one persistent pool for the whole run, workers receive the config once
+        pool = tdap_workers.get_worker_pool(tdap_config, logger_name, tdap_config.get('databases').get('omop').get('sess_limit'))
+
+    try:
+        ret_dict_iter = get_ret_dict_iter(process_df, tdap_config, logger_name, pool=pool, ordered=checkpoint is not None)
+
+        utilization = tdap_schedule.WorkerUtilization(logger_name)
+        ret_dict_iter = utilization.track(ret_dict_iter)
+        timing = tdap_timing.TimingReport(tdap_config, logger_name)
+        ret_dict_iter = timing.track(ret_dict_iter)
+        memory = tdap_dtypes.MemoryReport(tdap_config, logger_name)
+        ret_dict_iter = memory.track(ret_dict_iter)
+
+        failure_list = []
+        if checkpoint is not None:
+            # everything goes to disk first, the rest of the run reads the spilled results back
+            failure_ret_list = checkpoint.spill_results(ret_dict_iter, process_df['window_id'].tolist())
+            failure_list.extend([x['failure'] for x in failure_ret_list])
+            checkpoint.set_status('extracted', failure_count=len(failure_list))
+            ret_dict_iter = checkpoint.iter_results()
+        else:
+            ret_dict_iter = tdap_workers.record_failures(ret_dict_iter, failure_list)
+        if tdap_windows.fan_out_enabled(tdap_config):
+            ret_dict_iter = tdap_windows.fan_out_results(ret_dict_iter, window_df, tdap_config)
+
+        if not stream:
+            ret_dict_list = collect_results(ret_dict_iter, tdap_config, logger_name)
+            logger.info("TDAP run complete")
+
+        if write_to_db:
+            write_results(ret_dict_iter if stream else ret_dict_list, tdap_config, logger_name, incremental_dict=incremental_dict,
+                          failure_list=failure_list)
+            if stream:
+                logger.info("TDAP run complete")
+            if checkpoint is not None:
+                checkpoint.set_status('written')
+            report_failures(failure_list, tdap_config, write_to_db, logger_name)
+            utilization.log_summary()
+            timing.report()
+            memory.report()
+        else:
+            logger.info("TDAP run complete.  Results not written to DB")
+            report_failures(failure_list, tdap_config, write_to_db, logger_name)
+            utilization.log_summary()
+            timing.report()
+            memory.report()
+            return ret_dict_list
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+#####################################
+# distributed mode
+# a coordinator shards process_df into a queue in a shared directory,
+# workers on any host claim and run shards, and the coordinator
+# merges their outputs and does the final write
+#####################################
+def run_worker(tdap_config, logger_name, dist_dir, parallel=False):
+    """
+    Claims and runs shards from the queue in dist_dir until every shard is finished.  Each shard is spilled to its
+    own checkpoint in the shared output directory, so a shard that is requeued after a crash picks up where it stopped.
+    """
+    logger = logging.getLogger(logger_name)
+    dist_config = tdap_config.get('distributed', {})
+    queue = ShardQueue(dist_dir, logger_name)
+    tdap_timing.configure(tdap_config)
+    pool = None
+    if parallel:
+        pool = tdap_workers.get_worker_pool(tdap_config, logger_name, tdap_config.get('databases').get('omop').get('sess_limit'))
+    try:
+        while True:
+            claim = queue.claim()
+            if claim is None:
+                if queue.is_finished(dist_config.get('max_attempts', 3)):
+                    break
+                # other workers still running, or failed shards waiting to be requeued by the coordinator
+                sleep(dist_config.get('poll_seconds', 10))
+                continue
+            shard_id, attempt = claim
+            logger.info(f"Claimed shard {shard_id}, attempt {attempt}")
+            try:
+                checkpoint = queue.shard_checkpoint(shard_id)
+                shard_df = queue.load_shard(shard_id)
+                shard_df = shard_df.loc[~shard_df['window_id'].isin(checkpoint.completed_window_ids())]
+                if parallel:
+                    shard_df = schedule_process_df(shard_df, tdap_config, logger_name)
+                ret_dict_iter = get_ret_dict_iter(shard_df, tdap_config, logger_name, pool=pool, ordered=True)
+                with tdap_distributed.ShardHeartbeat(queue, shard_id, attempt, dist_config.get('heartbeat_seconds', 60)):
+                    failure_ret_list = checkpoint.spill_results(ret_dict_iter, shard_df['window_id'].tolist())
+                if queue.complete(shard_id, attempt, [x['failure'] for x in failure_ret_list]):
+                    logger.info(f"Finished shard {shard_id}")
+            except Exception as e:
+                logger.exception(f"Shard {shard_id} failed")
+                queue.fail(shard_id, attempt, e)
+    finally:
+        queue.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def run_coordinator(tdap_config, write_to_db, logger_name, pat_limit, dist_dir, incremental=False, local_workers=0,
+                    parallel=False):
+    """
+    Shards the population into the queue in dist_dir (or picks up the queue already there), optionally starts
+    local_workers worker processes on this host, waits for every shard to finish while requeuing stale ones, then
+    merges the shard outputs and writes them with the usual temp table swap.
+    """
+    logger = logging.getLogger(logger_name)
+    dist_config = tdap_config.get('distributed', {})
+    max_attempts = dist_config.get('max_attempts', 3)
+    queue = ShardQueue(dist_dir, logger_name)
+    if queue.shard_count() == 0:
+        process_df, incremental_dict = build_process_df(tdap_config, write_to_db, logger_name, pat_limit, incremental=incremental)
+        if incremental_dict is not None and process_df.shape[0] == 0:
+            # still clear out patients that left the population
+            write_results([], tdap_config, logger_name, incremental_dict=incremental_dict)
+            return
+        queue.create_shards(process_df, dist_config.get('shard_size', 1000), incremental_dict)
     else:
-        logger.info("Running TDAP on OMOP in serial")
-        ret_dict_list = get_omop_matrix_serial(process_tuples_final)
-        logger.info("TDAP run complete")
-    
+        incremental_dict = queue.load_state()
+        logger.info(f"Picking up the {queue.shard_count()} shards already queued in {dist_dir}")
+    log_run_review(tdap_config, logger_name)
+
+    worker_list = []
+    for i in range(local_workers):
+        worker = Process(target=run_worker, args=(tdap_config, logger_name, dist_dir, parallel))
+        worker.start()
+        worker_list.append(worker)
+    logger.info(f"Started {len(worker_list)} local workers.  Remote workers can join with --role worker --dist_dir {dist_dir}")
+
+    heartbeat_timeout = dist_config.get('heartbeat_timeout_seconds', 900)
+    max_wait_seconds = dist_config.get('max_wait_seconds')
+    wait_start = datetime.now()
+    while not queue.is_finished(max_attempts):
+        queue.requeue_stale(heartbeat_timeout, max_attempts)
+        logger.info(f"Shard status: {queue.status_counts()}")
+        waited = (datetime.now() - wait_start).total_seconds()
+        if max_wait_seconds is not None and waited > max_wait_seconds:
+            logger.error(f"Stopped waiting for shards after {waited:,.0f}s, unfinished shards are reported as failures")
+            break
+        if len(worker_list) > 0 and not any(w.is_alive() for w in worker_list) and queue.live_shard_count(heartbeat_timeout) == 0:
+            # nothing left to run the open shards, unless remote workers join
+            logger.error("Every local worker has exited and no shard has a live heartbeat, unfinished shards are "
+                         "reported as failures")
+            break
+        sleep(dist_config.get('poll_seconds', 10))
+    for worker in worker_list:
+        worker.join()
+
+    failure_list = queue.failures()
+    logger.info(f"All shards finished: {queue.status_counts()}")
+    # shard results carry their patients' stage timings from whichever host ran them
+    timing = tdap_timing.TimingReport(tdap_config, logger_name)
+    ret_dict_iter = timing.track(queue.iter_results())
+    memory = tdap_dtypes.MemoryReport(tdap_config, logger_name)
+    ret_dict_iter = memory.track(ret_dict_iter)
+    if tdap_windows.fan_out_enabled(tdap_config):
+        window_df = pd.concat([queue.load_shard(i) for i in range(queue.shard_count())], ignore_index=True)
+        ret_dict_iter = tdap_windows.fan_out_results(ret_dict_iter, window_df, tdap_config)
+    if write_to_db:
+        write_results(ret_dict_iter, tdap_config, logger_name, incremental_dict=incremental_dict, failure_list=failure_list)
+        report_failures(failure_list, tdap_config, write_to_db, logger_name)
+        timing.report()
+        memory.report()
+        queue.close()
+        logger.info("TDAP distributed run complete")
+    else:
+        ret_dict_list = collect_results(ret_dict_iter, tdap_config, logger_name)
+        report_failures(failure_list, tdap_config, write_to_db, logger_name)
+        timing.report()
+        memory.report()
+        queue.close()
+        logger.info("TDAP distributed run complete.  Results not written to DB")
+        return ret_dict_list
+
+
+def collect_results(ret_dict_iter, tdap_config, logger_name):
+    """
+    Gathers results into a list for the in memory path.  Matrices arrive already compacted by the workers when
+    matrix_representation is configured, see tdap_dtypes.run_compact.
+    """
+    return list(ret_dict_iter)
+
 
-    if write_to_db:            
+def report_failures(failure_list, tdap_config, write_to_db, logger_name):
+    """
+    Logs the patients that failed for good and saves their tracebacks to log/tdap_failures_<timestamp>.csv and, when
+    writing, to a <matrix_table_name>_failures table in every destination database
+    """
+    logger = logging.getLogger(logger_name)
+    if len(failure_list) == 0:
+        return
+    failure_df = pd.DataFrame(failure_list)
+    failure_df['run_time'] = datetime.now()
+    logger.warning(f"{failure_df.shape[0]} patients failed: " + ", ".join([f"{k} x{v}" for k, v in failure_df['error_type'].value_counts().items()]))
+    failure_file = Path('log') / f"tdap_failures_{datetime.today().strftime('%Y-%m-%dT%H:%M:%S')}.csv"
+    failure_file.parent.mkdir(exist_ok=True)
+    failure_df.to_csv(failure_file, index=False)
+    logger.warning(f"Failure details written to {failure_file}")
+    if write_to_db:
         for k,v in tdap_config.get('databases').items():
             if v['dest'] == True:
-                start_time = datetime.now()
-                # create an engine for output db
-                logger.info("Now writing to {} database".format(k))
-                connect_dict = v.get('secret')
-                o_engine = ucdripydbutils.get_engine_from_connect_dict(connect_dict)
-                print(pd.read_sql("select @@version", o_engine))
-                ###############################
-                ## do the writing here
-                ###############################
-                
-                ## step 1 - obtain matrix metadata from tdap results and create a table
-                # pcd_matrices
-                meta_dict_list = [x['output_metadata'] for x in ret_dict_list]
-                # find longest outputmetadata, use it as template for table creation
-                tdap_output_table_metadata = max([x for x in meta_dict_list], key=len)
-                # create empty table with template and persist to DB
-                temp_matrix_df = pd.DataFrame(columns=tdap_output_table_metadata.keys())
-                temp_matrix_df.to_sql(tdap_config['tables']['matrix_table_name']+'_temp', o_engine, dtype=tdap_output_table_metadata, index=False, if_exists='replace')
-
-                matrix_df_list = [x['matrix_df'] for x in ret_dict_list]
-                for matrix_df in matrix_df_list:
-                    matrix_df.filter(tdap_output_table_metadata.keys()).to_sql(tdap_config['tables']['matrix_table_name']+'_temp', o_engine, dtype=tdap_output_table_metadata, index=False, if_exists='append')
-                             
-                # rename temp table to final table
-                ucdripydbutils.rename_table_mssql(o_engine, tdap_config['tables']['matrix_table_name']+'_temp', tdap_config['tables']['matrix_table_name'], logger)
-
-                o_engine.dispose()
-                end_time = datetime.now()
-                logger.info(f"Writing to {k} database took {end_time-start_time}")
-    else:
-        logger.info("TDAP run complete.  Results not written to DB")
-        return ret_dict_list
+                engine = ucdripydbutils.get_engine_from_connect_dict(v.get('secret'))
+                failure_df.to_sql(tdap_config['tables']['matrix_table_name']+'_failures', engine, index=False, if_exists='append')
+                engine.dispose()
+
+
+def write_results(ret_dicts, tdap_config, logger_name, incremental_dict=None, failure_list=None):
+    """
+    Writes TDAP results to every database flagged as a destination, and to a Parquet dataset when the parquet_sink
+    stanza is enabled (tdap_parquet).  Per database the dense matrix table, the phase compressed table (tdap_phases),
+    or both are written according to phase_output.mode.
+
+    ret_dicts can be a list of result dicts or a generator of them (stream mode).  Each matrix is handed to a
+    TDAPMatrixWriter per destination as it arrives, and output_metadata is unioned incrementally by the writer.
+
+    With incremental_dict (from get_incremental_process_df) results are written to a <table>_incr staging table and
+    merged into the existing table per chunk of patients, delete and insert in one transaction, in place of the temp
+    table swap.  Patients that left the population are deleted.  Patients in failure_list keep their old rows and
+    watermarks so the next incremental run picks them up again.
+    """
+    logger = logging.getLogger(logger_name)
+    start_time = datetime.now()
+    writer_dict = {}
+    table_dict = {}
+    engine_dict = {}
+    for k,v in tdap_config.get('databases').items():
+        if v['dest'] == True:
+            # create an engine for output db
+            logger.info("Now writing to {} database".format(k))
+            connect_dict = v.get('secret')
+            engine_dict[k] = ucdripydbutils.get_engine_from_connect_dict(connect_dict)
+            logger.info(f"Destination dialect is {engine_dict[k].dialect.name}")
+            # the dense matrix table, the phase table, or both depending on phase_output.mode
+            for table_name, phased in tdap_phases.get_output_tables(tdap_config):
+                stage_suffix = '_incr' if incremental_dict is not None else '_temp'
+                writer = TDAPMatrixWriter(engine_dict[k], table_name+stage_suffix, None, logger_name,
+                                          batch_size=v.get('write_batch_size', 50000))
+                writer_key = f"{k}:{table_name}"
+                writer_dict[writer_key] = tdap_phases.TDAPPhaseWriter(writer, tdap_config, logger_name) if phased else writer
+                table_dict[writer_key] = (k, table_name)
+
+    # Parquet file sink, written alongside (or instead of) the database destinations
+    parquet_writer = tdap_parquet.get_parquet_writer(tdap_config, logger_name, incremental=incremental_dict is not None)
+    if parquet_writer is not None:
+        logger.info(f"Now writing to Parquet dataset {parquet_writer.dataset_path}")
+        writer_dict['parquet'] = parquet_writer
+
+    # with everything in hand, union the schema up front so the table is created once with every column
+    if isinstance(ret_dicts, list):
+        for x in ret_dicts:
+            for writer in writer_dict.values():
+                writer.merge_output_metadata(x['output_metadata'])
+
+    ###############################
+    ## do the writing here
+    ###############################
+    for x in ret_dicts:
+        for writer in writer_dict.values():
+            writer.write(x['matrix_df'], x['output_metadata'])
+
+    if incremental_dict is not None:
+        # failed patients keep their old rows and watermarks
+        failed_ids = {x['person_id'] for x in (failure_list or [])}
+        done_ids = [x for x in incremental_dict['person_ids'] if x not in failed_ids]
+        merge_ids = done_ids + incremental_dict.get('dropped_ids', [])
+    for writer_key, writer in writer_dict.items():
+        writer.close()
+        if writer_key == 'parquet':
+            if incremental_dict is None:
+                writer.swap()
+            else:
+                writer.merge(merge_ids)
+            continue
+        k, table_name = table_dict[writer_key]
+        if incremental_dict is None:
+            # rename temp table to final table
+            ucdripydbutils.rename_table_mssql(engine_dict[k], table_name+'_temp', table_name, logger)
+            continue
+        target = TDAPMatrixWriter(engine_dict[k], table_name, None, logger_name)
+        if target.attach_existing():
+            # add any new columns before the staged rows are copied across
+            target.merge_output_metadata(getattr(writer, 'writer', writer).output_metadata)
+            logger.info(f"Merging {len(done_ids)} rebuilt and removing {len(merge_ids) - len(done_ids)} dropped patients in {table_name}")
+            tdap_incremental.merge_staged_rows(engine_dict[k], table_name, table_name+'_incr', merge_ids)
+        elif inspect(engine_dict[k]).has_table(table_name+'_incr'):
+            ucdripydbutils.rename_table_mssql(engine_dict[k], table_name+'_incr', table_name, logger)
+    for k, engine in engine_dict.items():
+        if incremental_dict is not None:
+            # watermarks only move once the patients' rows are in
+            tdap_incremental.save_watermarks(engine, tdap_config, incremental_dict['watermark_df'], done_ids,
+                                             dropped_ids=incremental_dict.get('dropped_ids', []))
+        engine.dispose()
+    end_time = datetime.now()
+    logger.info(f"Writing to {', '.join(writer_dict.keys())} took {end_time-start_time}")
     
 
 #####################################
@@ -275,6 +750,7 @@ def run(tdap_config, write_to_db, logger_name, pat_limit, parallel=False):
 #####################################
 def main():
     print("Hello, I'm PCD on tdap 2.0")
+    checkpoint = None
     try:
         # DO MAIN STUFF
         print("Hello, I'm TDAP on OMOP here to procees a test run for  you!!")
@@ -288,6 +764,15 @@ def main():
         #dev args
         dev_email = args.dev_email
         pat_limit = args.pat_limit
+        stream_write = args.stream_write
+        parallel = args.parallel
+        use_checkpoint = args.checkpoint
+        resume_run_id = args.resume
+        spill_dir = args.spill_dir
+        role = args.role
+        dist_dir = args.dist_dir
+        local_workers = args.local_workers
+        incremental = args.incremental
        
        # logging setup
         logging_config = my_tdap_config.logging_config
@@ -326,12 +811,49 @@ def main():
         # update tdap config with secrets
         # NOTE - if using mysecrets, be sure you have imported the file so that you can can include in the arguments here using my_secrets = mysecrets.my_secrets
         tdap_config = inject_secrets_into_config(dotenv_file_path, tdap_config, dev_email, logger_name, mssql_ad_user=ad_user, mssql_ad_pass=ad_pass)
+        # drop the concepts and aggregates nothing consumes, when the projection stanza is enabled
+        tdap_config = tdap_config_graph.apply_projection(tdap_config, logger_name)
+        # fail fast on module dependency cycles rather than part way through the cohort
+        if tdap_module_dag.get_module_dag_config(tdap_config).get('enabled', False):
+            tdap_module_dag.validate_module_dag(tdap_config, logger_name)
+        # incremental runs stage windows in a temp table on the OMOP server (precount scheduling falls back on its own)
+        if incremental:
+            omop_engine = ucdripydbutils.get_engine_from_connect_dict(tdap_config.get('databases').get('omop').get('secret'))
+            tdap_omop_batch.check_staging_dialect(omop_engine)
+            omop_engine.dispose()
+        # configured concept ids checked against the concept table once, and tapestry's concept metadata lookups
+        # memoized, when concept_cache is enabled
+        tdap_concept_cache.check_concepts(tdap_config, logger_name)
+        tdap_concept_cache.memoize_concept_metadata(tdap_config, logger_name)
+
+        # distributed roles
+        if role != 'single':
+            if dist_dir is None:
+                raise ValueError(f"--role {role} needs --dist_dir")
+            if role == 'coordinator':
+                run_coordinator(tdap_config, write_to_db, logger_name, pat_limit, dist_dir, incremental=incremental,
+                                local_workers=local_workers, parallel=parallel)
+            else:
+                run_worker(tdap_config, logger_name, dist_dir, parallel=parallel)
+            return
+
+        # checkpointing - a resume always checkpoints into the run it resumes
+        if resume_run_id is not None:
+            if not (Path(spill_dir) / resume_run_id).exists():
+                raise ValueError(f"No checkpointed run {resume_run_id} under {spill_dir}")
+            checkpoint = TDAPCheckpoint(spill_dir, resume_run_id, logger_name)
+        elif use_checkpoint:
+            checkpoint = TDAPCheckpoint(spill_dir, None, logger_name)
 
         # call run
-        run(tdap_config, write_to_db, logger_name, pat_limit)
+        run(tdap_config, write_to_db, logger_name, pat_limit, parallel=parallel, stream=stream_write, incremental=incremental,
+            checkpoint=checkpoint)
     except Exception as e:
         if dev_email is not None:
-            piesafe.failure_email(log_file_name, email_subject=f'Bad Exit from TDAP OMOP EXAMPLE', email_txt=f"{piesafe.exception_to_string(e)}",email_to=dev_email)
+            email_txt = f"{piesafe.exception_to_string(e)}"
+            if checkpoint is not None:
+                email_txt += f"\n\nFinished patients are checkpointed, rerun with --resume {checkpoint.run_id}"
+            piesafe.failure_email(log_file_name, email_subject=f'Bad Exit from TDAP OMOP EXAMPLE', email_txt=email_txt,email_to=dev_email)
         logger.exception('------Traceback------')
         logger.error(e)
         sys.exit("\N{CRYING FACE}")
@@ -206,15 +206,123 @@ tdap_configs = {
             "sess_limit" : 25,
             "query_window_start" : 0,
             "query_window_end" : 24,
+            # number of patient windows per staged query for incremental watermarks and precount scheduling, see tdap_omop_batch.py
+            "chunk_size" : 500,
+            # transient DB errors are retried per patient, waiting retry_backoff_seconds and doubling each try
+            "max_retries" : 3,
+            "retry_backoff_seconds" : 2,
+            # order windows most expensive first when running --parallel: "precount" (source row counts) or "window"
+            # (length x concepts, only differs between windows when window_coalesce is enabled).  None keeps
+            # population order
+            "schedule" : None,
             "dest":False
         },
         "tdap_dm":{
                 "type":"btss",
                 "btss_secret_title":"edm_srv_tdap",
+                # rows buffered per bulk insert when writing matrices
+                "write_batch_size":50000,
                 "dest":True
             }
     },       
 
+    # build the population from a per person, per concept first/last event index instead of scanning the clinical tables
+    # each run, see tdap_pop_index.py.  window_mode "first", "per_concept" or "span", windows are window_days long
+    "pop_index": {
+        "enabled": False,
+        "database": "tdap_dm",
+        "table_name": None,
+        "max_age_hours": 24,
+        "window_mode": "first",
+        "window_days": 7
+    },
+
+    # merge each person's overlapping windows (and windows within merge_gap_hours) before dispatch, no merge spanning more than max_window_days, see tdap_windows.py
+    # fan_out slices the merged matrices back to the original windows, tagged with window_start_time
+    "window_coalesce": {
+        "enabled": False,
+        "merge_gap_hours": 0,
+        "max_window_days": 30,
+        "fan_out": False
+    },
+
+    # bulk load concept metadata for every originid once at start up (cached on disk) and check the ids, and memoize
+    # tapestry's get_concept_metadata in every process, see tdap_concept_cache.py
+    "concept_cache": {
+        "enabled": False,
+        "path": "cache/concept_cache",
+        "ttl_hours": 168,
+        "strict": False,
+        "check_descendants": True
+    },
+
+    # per stage timing summary at the end of each run, see tdap_timing.py
+    # add stage names such as "derivation:pcd_gates" to profile_stages for cProfile output
+    "timing": {
+        "enabled": True,
+        "dump_dir": "log",
+        "profile_stages": [],
+        "profile_dir": "log/profiles"
+    },
+
+    # shard queue settings for --role coordinator/worker runs, see tdap_distributed.py
+    "distributed": {
+        "shard_size": 1000,
+        "heartbeat_seconds": 60,
+        "heartbeat_timeout_seconds": 900,
+        "max_attempts": 3,
+        "poll_seconds": 10,
+        # the coordinator stops waiting after this many seconds, None waits for every shard
+        "max_wait_seconds": None
+    },
+
+    # convert sparse concept columns to SparseArrays/categoricals in the worker, held that way until they are written
+    "matrix_representation": {
+        "sparse": False,
+        "max_density": 0.3,
+        # cast finished matrix columns to compact dtypes from their output_metadata SQL types, see tdap_dtypes.py
+        "dtype_plan": False,
+        "float32": "bounded",
+        "category_suffixes": ["_native", "_list"],
+        "max_category_ratio": 0.5,
+        "exclude_cols": ["key_time"]
+    },
+
+    # also write the matrix as a partitioned Parquet dataset at <path>/<matrix_table_name>, see tdap_parquet.py
+    # partition_by "person_hash" (hash_buckets buckets) or "period" (partition_period of time_col)
+    "parquet_sink": {
+        "enabled": False,
+        "path": "output/parquet",
+        "partition_by": "person_hash",
+        "hash_buckets": 32,
+        "partition_period": "M",
+        "time_col": "key_time",
+        "write_batch_size": 50000
+    },
+
+    # "dense" writes every period row, "phases" only run-length phase rows to <matrix_table_name>_phases, "both" writes both
+    # see tdap_phases.py, read phase tables back with tdap_phases.read_dense_matrix
+    "phase_output": {
+        "mode": "dense",
+        "time_col": "key_time"
+    },
+
+    # skip concepts and aggregates that no derivation, cleanup or output column consumes, see tdap_config_graph.py
+    # output_columns lists matrix columns or whole concept keys, None treats every concept as output
+    # python tdap_config_graph.py --config_key dev_omop prints what would be pruned
+    "projection": {
+        "enabled": False,
+        "output_columns": None
+    },
+
+    # run extensions, cleanups and derivations as a DAG built from their required_cols and produced_cols, see tdap_module_dag.py
+    # independent modules with "concurrency": "thread" run together on up to max_threads threads
+    # a module whose inputs are missing is skipped, with the modules that read its produced_cols
+    "module_dag": {
+        "enabled": False,
+        "max_threads": 4
+    },
+
     "ts_features_config": {
         "window_len": 4,
         "window_type": "blackman",
@@ -468,14 +576,16 @@ tdap_configs = {
             "include":True,
             "module":"derivation_kl_ratio",
             "config":{
-                "required_cols":["kapalr_ord_num_value_mean", "lmdalr_ord_num_value_mean"]
+                "required_cols":["kapalr_ord_num_value_mean", "lmdalr_ord_num_value_mean"],
+                "produced_cols":["kl_ratio"]
             }
         },
         "creat_clearance":{
             "include":True,
             "module":"derivation_creat_clearance",
             "config":{
-                "required_cols":["enc_weight_mean","creat_ord_num_value_mean"]
+                "required_cols":["enc_weight_mean","creat_ord_num_value_mean"],
+                "produced_cols":["creat_clearance"]
             }
         },
         "num_dc":{
@@ -483,7 +593,8 @@ tdap_configs = {
             "module":"derivation_num_dc",
             "config":{
                 "required_cols":["hgb_ord_num_value_min","clcm_ord_num_value_max",
-                "creat_ord_num_value_max","creat_clearance","kl_ratio"]
+                "creat_ord_num_value_max","creat_clearance","kl_ratio"],
+                "produced_cols":["num_dc"]
             }
         },
         # NOTE: PCD Gates/mm_pub_algod MUST run as the last derivations
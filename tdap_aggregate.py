@@ -0,0 +1,100 @@
+"""
+Date: 2026-10-18
+Purpose: Vectorized period alignment and down sampling of raw concept rows.  Every aggregate for a concept is computed
+in one grouped pass over all patients in the frame, using pandas' built in (cython) group reductions.  The mode is
+computed from sorted value counts rather than a python callable per group.
+
+Aggregations follow the TAPESTRY down sampling rules:
+    numeric - first, last, min, max, mean, mode, std
+    string - first, last, mode (most frequent), list
+"""
+# imports
+import pandas as pd
+
+NUMERIC_AGGS = ['first', 'last', 'min', 'max', 'mean', 'mode', 'std']
+STRING_AGGS = ['first', 'last', 'mode', 'list']
+
+
+def align_to_period(time_series, period):
+    """
+    Vectorized equivalent of keying a timestamp to the start of its period, e.g. 'H', 'D', 'W', 'M'
+    """
+    return time_series.dt.to_period(period).dt.start_time
+
+
+def grouped_mode(df, key_cols, value_col):
+    """
+    Mode of value_col per group without a per group callable.
+    Counts every (key, value) pair, sorts by count descending then value ascending, and keeps the first row per key.
+    Ties resolve to the smallest value, the same answer as Series.mode().iloc[0].
+    """
+    counts = (df.dropna(subset=[value_col])
+                .groupby(key_cols + [value_col], sort=False, observed=True)
+                .size()
+                .rename('_count')
+                .reset_index())
+    counts = counts.sort_values(key_cols + ['_count', value_col], ascending=[True] * len(key_cols) + [False, True], kind='mergesort')
+    return counts.drop_duplicates(subset=key_cols, keep='first').set_index(key_cols)[value_col]
+
+
+def aggregate_concept_rows(raw_df, concept_key, value_col, time_col, period, origindatatype, key_cols=None,
+                           period_col='key_time', aggs=None):
+    """
+    Aligns raw concept rows to period and computes every aggregate in one pass.
+
+    raw_df may hold one patient or a whole batch, key_cols identifies the patient.
+    aggs limits the output to those aggregates (see tdap_config_graph), every aggregate is computed when None.
+    Returns a frame indexed by key_cols + [period_col] with columns named <concept_key>_<value_col>_<agg>
+    """
+    key_cols = ['person_id'] if key_cols is None else key_cols
+    df = raw_df[key_cols + [time_col, value_col]].copy()
+    df[period_col] = align_to_period(df[time_col], period)
+    group_cols = key_cols + [period_col]
+    # time order within each period drives first/last
+    df = df.sort_values(group_cols + [time_col], kind='mergesort')
+
+    if origindatatype == 'numeric':
+        agg_list = [a for a in NUMERIC_AGGS if aggs is None or a in aggs]
+        df[value_col] = pd.to_numeric(df[value_col], errors='coerce')
+        grouped = df.groupby(group_cols, sort=True, observed=True)[value_col]
+        # the cython reductions in one call, mode separately since it is not one of them
+        agg_df = grouped.agg([a for a in agg_list if a != 'mode'] or ['size'])
+        if 'mode' in agg_list:
+            agg_df['mode'] = grouped_mode(df, group_cols, value_col)
+    else:
+        agg_list = [a for a in STRING_AGGS if aggs is None or a in aggs]
+        df[value_col] = df[value_col].astype('string')
+        grouped = df.groupby(group_cols, sort=True, observed=True)[value_col]
+        agg_df = grouped.agg([a for a in agg_list if a in ('first', 'last')] or ['size'])
+        if 'mode' in agg_list:
+            agg_df['mode'] = grouped_mode(df, group_cols, value_col)
+        if 'list' in agg_list:
+            # non null values of each group joined in time order
+            non_null_df = df.dropna(subset=[value_col])
+            agg_df['list'] = (non_null_df[value_col].astype(str)
+                                                    .groupby([non_null_df[c] for c in group_cols], sort=True)
+                                                    .agg(','.join))
+
+    agg_df = agg_df[agg_list]
+    agg_df.columns = [f"{concept_key}_{value_col}_{a}" for a in agg_list]
+    return agg_df
+
+
+def aggregate_concepts(concept_df_dict, concept_spec_dict, period, key_cols=None, period_col='key_time'):
+    """
+    Aggregates every concept of a patient, or a batch of patients, and joins the results on key_cols + [period_col].
+
+    concept_spec_dict is concept_key -> {'value_col', 'time_col', 'origindatatype'[, 'aggs']}
+    """
+    key_cols = ['person_id'] if key_cols is None else key_cols
+    agg_df_list = []
+    for concept_key, raw_df in concept_df_dict.items():
+        spec = concept_spec_dict[concept_key]
+        if raw_df.shape[0] == 0:
+            continue
+        agg_df_list.append(aggregate_concept_rows(raw_df, concept_key, spec['value_col'], spec['time_col'], period,
+                                                  spec['origindatatype'], key_cols=key_cols, period_col=period_col,
+                                                  aggs=spec.get('aggs')))
+    if len(agg_df_list) == 0:
+        return pd.DataFrame(index=pd.MultiIndex.from_tuples([], names=key_cols + [period_col]))
+    return pd.concat(agg_df_list, axis=1, join='outer').sort_index()
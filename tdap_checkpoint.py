@@ -0,0 +1,132 @@
+"""
+Date: 2026-10-18
+Purpose: Checkpoint and resume for long executor runs.  Completed patient results are spilled to a local directory as
+they finish, so a run that dies part way through (DB timeout, worker crash) can be resumed with --resume <run_id>,
+skipping every window that already finished and going straight on to the write.
+
+Layout of one run under the spill directory:
+
+    <spill_dir>/<run_id>/manifest.json    run level info and status
+    <spill_dir>/<run_id>/state.pkl        the process_df (and incremental state) the run was started with
+    <spill_dir>/<run_id>/completed.txt    one window_id per line, appended as each result is spilled
+    <spill_dir>/<run_id>/results/<window_id>.pkl    one run_omop result dict per window
+"""
+# imports
+import json
+import logging
+import os
+import pickle
+from datetime import datetime
+from pathlib import Path
+
+
+class TDAPCheckpoint:
+    """
+    Spill directory for one run.  Pass run_id=None to start a new run, or the id of an earlier run to resume it.
+    """
+    def __init__(self, spill_dir, run_id, logger_name):
+        self.logger_name = logger_name
+        self.run_id = run_id if run_id is not None else datetime.today().strftime('%Y%m%dT%H%M%S')
+        self.run_dir = Path(spill_dir) / self.run_id
+        self.result_dir = self.run_dir / 'results'
+        self.manifest_path = self.run_dir / 'manifest.json'
+        self.state_path = self.run_dir / 'state.pkl'
+        self.completed_path = self.run_dir / 'completed.txt'
+        self.result_dir.mkdir(parents=True, exist_ok=True)
+        if not self.manifest_path.exists():
+            self.write_manifest({'run_id': self.run_id, 'created': datetime.now().isoformat(), 'status': 'started'})
+
+    ##########################
+    # manifest and run state
+    ##########################
+    def read_manifest(self):
+        with open(self.manifest_path) as f:
+            return json.load(f)
+
+    def write_manifest(self, manifest):
+        self._atomic_write(self.manifest_path, json.dumps(manifest, indent=2).encode('utf-8'))
+
+    def set_status(self, status, **kwargs):
+        manifest = self.read_manifest()
+        manifest['status'] = status
+        manifest[status] = datetime.now().isoformat()
+        manifest.update(kwargs)
+        self.write_manifest(manifest)
+
+    def has_state(self):
+        return self.state_path.exists()
+
+    def save_state(self, process_df, incremental_dict=None):
+        """
+        Saves the windows the run was started with, so a resume processes exactly the same population
+        """
+        self._atomic_write(self.state_path, pickle.dumps({'process_df': process_df, 'incremental_dict': incremental_dict},
+                                                         protocol=pickle.HIGHEST_PROTOCOL))
+        self.set_status('extracting', window_count=int(process_df.shape[0]))
+
+    def load_state(self):
+        with open(self.state_path, 'rb') as f:
+            state = pickle.load(f)
+        return state['process_df'], state['incremental_dict']
+
+    ##########################
+    # results
+    ##########################
+    def completed_window_ids(self):
+        """
+        Window ids with a result on disk.  A line without its result file (killed mid write) does not count.
+        """
+        if not self.completed_path.exists():
+            return set()
+        with open(self.completed_path) as f:
+            window_ids = {int(x) for x in f.read().split()}
+        return {w for w in window_ids if (self.result_dir / f"{w}.pkl").exists()}
+
+    def save_result(self, window_id, ret):
+        self._atomic_write(self.result_dir / f"{window_id}.pkl", pickle.dumps(ret, protocol=pickle.HIGHEST_PROTOCOL))
+        with open(self.completed_path, 'a') as f:
+            f.write(f"{window_id}\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def spill_results(self, ret_dict_iter, window_id_list):
+        """
+        Consumes a result iterator that yields in window_id_list order, spilling each result as it arrives.
+        Failure records (see tdap_workers.call_with_retry) are not spilled, so a resume retries those windows.
+        Results are matched to windows by position, so a result count that differs from window_id_list raises
+        ValueError.  Returns the list of failure records seen.
+        """
+        logger = logging.getLogger(self.logger_name)
+        count = 0
+        seen = 0
+        failure_ret_list = []
+        for ret in ret_dict_iter:
+            if seen >= len(window_id_list):
+                raise ValueError(f"More results than the {len(window_id_list)} windows they were run for")
+            window_id = window_id_list[seen]
+            seen += 1
+            if 'failure' in ret:
+                failure_ret_list.append(ret)
+                continue
+            self.save_result(window_id, ret)
+            count += 1
+        if seen < len(window_id_list):
+            raise ValueError(f"{seen} results for {len(window_id_list)} windows, the results can't be matched to windows")
+        logger.info(f"Spilled {count} results to {self.result_dir}")
+        return failure_ret_list
+
+    def iter_results(self):
+        """
+        Yields every spilled result in window_id order
+        """
+        for window_id in sorted(self.completed_window_ids()):
+            with open(self.result_dir / f"{window_id}.pkl", 'rb') as f:
+                yield pickle.load(f)
+
+    def _atomic_write(self, path, data):
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
@@ -0,0 +1,386 @@
+"""
+Date: 2026-10-18
+Purpose: Concept metadata check and cache.  Every configured originid is looked up in the OMOP concept table in bulk
+once at executor start, rather than finding a bad id part way through the cohort.  The rows are stored on disk keyed by
+the concept_id list, so later runs with the same concepts skip the database entirely.
+
+tapestry.tapestry.get_concept_metadata is also memoized per process, the way tdap_workers swaps the engine factory:
+results are keyed by the call's arguments (an engine by its URL) and looked up in memory, then on disk, before the
+database is queried.  The executor loads every stored result once and hands them to each pool worker through the
+initializer, so workers start warm.  Like the engine swap, this reaches run_omop because it looks the function up on
+the tapestry module at call time.
+
+Configured with the concept_cache stanza of a tdap config:
+
+    "concept_cache": {
+        "enabled": True,
+        "path": "cache/concept_cache",
+        "ttl_hours": 168,
+        "strict": False,            # True raises on unknown concept ids rather than warning
+        "check_descendants": True   # warn about standard descendants (concept_ancestor) missing from originid
+    }
+
+The check logs configured ids missing from the concept table, invalid (deprecated or replaced) concepts, non standard
+concepts, concepts whose domain does not match the concept's origintype and, with check_descendants, valid standard
+descendants of a concept's ids that its originid leaves out.  The config itself is not changed, so descendants are
+reported rather than added.
+
+The executor runs the check at start up.  To inspect or clear the on-disk cache:
+
+python tdap_concept_cache.py --config_key dev_omop stats
+python tdap_concept_cache.py --config_key dev_omop clear
+"""
+# imports
+import argparse
+import copy
+import hashlib
+import logging
+import pickle
+import shutil
+from datetime import datetime
+from pathlib import Path
+import pandas as pd
+from sqlalchemy import exc as sa_exc, text
+
+# ripy
+from ucdripydbutils import ucdripydbutils
+
+# TDAP imports
+from tapestry import tapestry
+
+# sibling imports
+import tdap_omop_batch
+
+CONCEPT_COLS = ['concept_id', 'concept_name', 'domain_id', 'vocabulary_id', 'concept_class_id', 'standard_concept',
+                'concept_code', 'invalid_reason']
+# OMOP domain_id expected for each origintype
+ORIGINTYPE_DOMAINS = {
+    'measurement': 'Measurement',
+    'condition_occurrence': 'Condition',
+    'drug_exposure': 'Drug',
+    'procedure_occurrence': 'Procedure',
+    'observation': 'Observation',
+    'device_exposure': 'Device'
+}
+# ids per in list, kept under the parameter limits of the supported databases
+LOOKUP_CHUNK_SIZE = 1000
+# cache key prefix of memoized get_concept_metadata results
+METADATA_KEY_PREFIX = 'metadata_'
+# descendants listed per concept in a warning
+DESCENDANT_EXAMPLES = 5
+
+# per process memo, populated by memoize_concept_metadata
+_memo_state = {}
+
+
+def get_concept_cache_config(tdap_config):
+    return tdap_config.get('concept_cache', {})
+
+
+def get_configured_concept_ids(tdap_config):
+    """
+    Every originid of every OMOP concept in the config, sorted and unique
+    """
+    id_set = set()
+    for concept in tdap_omop_batch.get_batchable_concepts(tdap_config).values():
+        props = concept.get('conceptproperties', {})
+        id_set.update(tdap_omop_batch.originid_to_list(props.get('originid')))
+    return sorted(id_set)
+
+
+def make_cache_key(concept_id_list):
+    key_str = ",".join([str(x) for x in concept_id_list])
+    return hashlib.sha256(key_str.encode('utf-8')).hexdigest()
+
+
+def _chunked_read(conn, sql_template, id_list):
+    df_list = []
+    for i in range(0, len(id_list), LOOKUP_CHUNK_SIZE):
+        chunk = id_list[i:i+LOOKUP_CHUNK_SIZE]
+        df_list.append(pd.read_sql(text(sql_template.format(id_list=",".join([str(int(x)) for x in chunk]))), conn))
+    return pd.concat(df_list, ignore_index=True) if len(df_list) > 0 else None
+
+
+def _call_key_arg(x):
+    # engines are created per patient but point at the same database
+    url = getattr(x, 'url', None)
+    return ('engine', repr(url)) if url is not None else x
+
+
+def make_call_key(args, kwargs):
+    """
+    Cache key of one get_concept_metadata call, from its arguments with any engine replaced by its URL
+    """
+    key_args = ([_call_key_arg(x) for x in args], sorted((k, _call_key_arg(v)) for k, v in kwargs.items()))
+    try:
+        key_bytes = pickle.dumps(key_args, protocol=4)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        key_bytes = repr(key_args).encode('utf-8')
+    return METADATA_KEY_PREFIX + hashlib.sha256(key_bytes).hexdigest()
+
+
+def load_concepts(engine, concept_id_list):
+    """
+    Bulk loads the concept rows for concept_id_list
+    """
+    with engine.connect() as conn:
+        concept_df = _chunked_read(conn, f"""
+            select {", ".join(CONCEPT_COLS)}
+            from concept
+            where concept_id in ({{id_list}})
+            """, concept_id_list)
+    if concept_df is None:
+        concept_df = pd.DataFrame(columns=CONCEPT_COLS)
+    return concept_df
+
+
+class TDAPConceptCache:
+    """
+    On-disk store of concept metadata, one pickle per concept_id list
+    """
+    def __init__(self, path, logger_name, ttl_hours=168):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.logger_name = logger_name
+        self.ttl_seconds = ttl_hours * 3600 if ttl_hours is not None else None
+
+    def get(self, cache_key):
+        """
+        Returns concept_df, or None on a miss or an expired entry
+        """
+        entry_path = self.path / f"{cache_key}.pkl"
+        if not entry_path.exists():
+            return None
+        if self.ttl_seconds is not None and datetime.now().timestamp() - entry_path.stat().st_mtime > self.ttl_seconds:
+            entry_path.unlink()
+            return None
+        with open(entry_path, 'rb') as f:
+            return pickle.load(f)
+
+    def put(self, cache_key, concept_df):
+        # written under a temp name and renamed, so a concurrent reader never sees half a file
+        temp_path = self.path / f"{cache_key}.pkl.tmp"
+        with open(temp_path, 'wb') as f:
+            pickle.dump(concept_df, f, protocol=pickle.HIGHEST_PROTOCOL)
+        temp_path.replace(self.path / f"{cache_key}.pkl")
+
+    def items(self, prefix=''):
+        """
+        Yields (cache_key, value) for every unexpired entry whose key starts with prefix
+        """
+        for entry_path in sorted(self.path.glob(f"{prefix}*.pkl")):
+            value = self.get(entry_path.name[:-len('.pkl')])
+            if value is not None:
+                yield entry_path.name[:-len('.pkl')], value
+
+    def stats(self):
+        entry_list = list(self.path.glob('*.pkl'))
+        return {'entries': len(entry_list), 'mb': sum(p.stat().st_size for p in entry_list) / 1e6}
+
+    def clear(self):
+        count = len(list(self.path.glob('*.pkl')))
+        shutil.rmtree(self.path)
+        self.path.mkdir(parents=True)
+        return count
+
+
+def get_concept_cache(tdap_config, logger_name):
+    """
+    Returns a TDAPConceptCache for the config's concept_cache stanza, or None when it is not enabled
+    """
+    cache_config = get_concept_cache_config(tdap_config)
+    if not cache_config.get('enabled', False):
+        return None
+    return TDAPConceptCache(cache_config.get('path', 'cache/concept_cache'), logger_name,
+                            ttl_hours=cache_config.get('ttl_hours', 168))
+
+
+def _memoized_concept_metadata(*args, **kwargs):
+    """
+    Drop-in replacement for tapestry.tapestry.get_concept_metadata.  Callers get a copy, so one patient changing the
+    result can't leak into the next.
+    """
+    call_key = make_call_key(args, kwargs)
+    memo_dict = _memo_state['memo_dict']
+    if call_key not in memo_dict:
+        cache = _memo_state['cache']
+        ret = cache.get(call_key) if cache is not None else None
+        if ret is None:
+            ret = _memo_state['get_metadata_func'](*args, **kwargs)
+            if cache is not None:
+                try:
+                    cache.put(call_key, ret)
+                except (pickle.PicklingError, TypeError, AttributeError):
+                    logging.getLogger(_memo_state['logger_name']).warning("Concept metadata is not picklable, memoized in memory only")
+        memo_dict[call_key] = ret
+    return copy.deepcopy(memo_dict[call_key])
+
+
+_memoized_concept_metadata._tdap_memoized = True
+
+
+def memoize_concept_metadata(tdap_config, logger_name, memo_dict=None):
+    """
+    Swaps tapestry.tapestry.get_concept_metadata for the memoized version in this process, when concept_cache is
+    enabled.  memo_dict seeds the in memory results, e.g. the executor's get_metadata_memo() in a pool worker;
+    without it every result stored on disk is loaded.
+    """
+    cache = get_concept_cache(tdap_config, logger_name)
+    if cache is None:
+        return
+    if memo_dict is None:
+        memo_dict = dict(cache.items(METADATA_KEY_PREFIX))
+    if not getattr(tapestry.get_concept_metadata, '_tdap_memoized', False):
+        _memo_state['get_metadata_func'] = tapestry.get_concept_metadata
+        tapestry.get_concept_metadata = _memoized_concept_metadata
+    _memo_state['memo_dict'] = dict(memo_dict)
+    _memo_state['cache'] = cache
+    _memo_state['logger_name'] = logger_name
+
+
+def get_metadata_memo():
+    """
+    The memoized results held by this process, for the worker initializer.  Empty when nothing is memoized.
+    """
+    return dict(_memo_state.get('memo_dict', {}))
+
+
+def load_descendants(engine, concept_id_list):
+    """
+    (ancestor_concept_id, descendant_concept_id, concept_name) for every valid standard descendant of concept_id_list
+    """
+    with engine.connect() as conn:
+        descendant_df = _chunked_read(conn, """
+            select ca.ancestor_concept_id, ca.descendant_concept_id, c.concept_name
+            from concept_ancestor ca
+            join concept c on c.concept_id = ca.descendant_concept_id
+            where ca.ancestor_concept_id in ({id_list})
+                and ca.descendant_concept_id <> ca.ancestor_concept_id
+                and c.standard_concept = 'S'
+                and c.invalid_reason is null
+            """, concept_id_list)
+    if descendant_df is None:
+        descendant_df = pd.DataFrame(columns=['ancestor_concept_id', 'descendant_concept_id', 'concept_name'])
+    return descendant_df
+
+
+def validate_descendants(tdap_config, descendant_df, logger_name):
+    """
+    Logs, per concept, the standard descendants of its originids that the originid itself leaves out, and returns
+    those problems as a list of strings
+    """
+    logger = logging.getLogger(logger_name)
+    problem_list = []
+    for key, concept in tdap_omop_batch.get_batchable_concepts(tdap_config).items():
+        id_list = tdap_omop_batch.originid_to_list(concept.get('conceptproperties', {}).get('originid'))
+        missing_df = descendant_df[descendant_df['ancestor_concept_id'].isin(id_list)
+                                   & ~descendant_df['descendant_concept_id'].isin(id_list)]
+        missing_df = missing_df.drop_duplicates('descendant_concept_id').sort_values('descendant_concept_id')
+        if missing_df.shape[0] == 0:
+            continue
+        example_str = ", ".join(f"{int(r.descendant_concept_id)} {r.concept_name}"
+                                for r in missing_df.head(DESCENDANT_EXAMPLES).itertuples())
+        problem_list.append(f"{key}: {missing_df.shape[0]} standard descendants are not in originid ({example_str})")
+    for problem in problem_list:
+        logger.warning(problem)
+    return problem_list
+
+
+def validate_concepts(tdap_config, concept_df, logger_name):
+    """
+    Logs problems with the configured concept ids and returns them as a list of strings.
+    Unknown ids raise a ValueError when concept_cache.strict is set.
+    """
+    logger = logging.getLogger(logger_name)
+    concept_records = {int(r['concept_id']): r for r in concept_df.to_dict('records')}
+    problem_list = []
+    unknown_list = []
+    for key, concept in tdap_omop_batch.get_batchable_concepts(tdap_config).items():
+        props = concept.get('conceptproperties', {})
+        expected_domain = ORIGINTYPE_DOMAINS.get(props.get('origintype'))
+        for concept_id in tdap_omop_batch.originid_to_list(props.get('originid')):
+            record = concept_records.get(concept_id)
+            if record is None:
+                unknown_list.append(f"{key}: {concept_id} is not in the concept table")
+                continue
+            if record.get('invalid_reason') not in (None, '') and not pd.isna(record.get('invalid_reason')):
+                problem_list.append(f"{key}: {concept_id} {record['concept_name']} is invalid ({record['invalid_reason']})")
+            if record.get('standard_concept') != 'S':
+                problem_list.append(f"{key}: {concept_id} {record['concept_name']} is not a standard concept")
+            if expected_domain is not None and record.get('domain_id') != expected_domain:
+                problem_list.append(f"{key}: {concept_id} {record['concept_name']} is in domain {record['domain_id']}, "
+                                    f"not {expected_domain}")
+    for problem in unknown_list + problem_list:
+        logger.warning(problem)
+    if len(unknown_list) > 0 and get_concept_cache_config(tdap_config).get('strict', False):
+        raise ValueError(f"{len(unknown_list)} configured concept ids are not in the concept table")
+    return unknown_list + problem_list
+
+
+def _load_cached(cache, cache_key, load_func, omop_engine, concept_id_list):
+    df = cache.get(cache_key)
+    if df is None:
+        df = load_func(omop_engine(), concept_id_list)
+        cache.put(cache_key, df)
+    return df
+
+
+def check_concepts(tdap_config, logger_name, engine=None):
+    """
+    Loads metadata for every configured concept (from disk when cached) and validates it.  Returns the list of
+    problems found, or None when the concept_cache stanza is not enabled.
+    """
+    logger = logging.getLogger(logger_name)
+    cache = get_concept_cache(tdap_config, logger_name)
+    if cache is None:
+        return None
+    engine_dict = {}
+
+    def omop_engine():
+        # only connected when something is not cached
+        if 'engine' not in engine_dict:
+            engine_dict['engine'] = engine if engine is not None else \
+                ucdripydbutils.get_engine_from_connect_dict(tdap_config.get('databases').get('omop').get('secret'))
+        return engine_dict['engine']
+
+    concept_id_list = get_configured_concept_ids(tdap_config)
+    cache_key = make_cache_key(concept_id_list)
+    start_time = datetime.now()
+    concept_df = _load_cached(cache, cache_key, load_concepts, omop_engine, concept_id_list)
+    problem_list = validate_concepts(tdap_config, concept_df, logger_name)
+    if get_concept_cache_config(tdap_config).get('check_descendants', True):
+        try:
+            descendant_df = _load_cached(cache, 'descendants_' + cache_key, load_descendants, omop_engine, concept_id_list)
+            problem_list += validate_descendants(tdap_config, descendant_df, logger_name)
+        except sa_exc.DBAPIError as e:
+            logger.warning(f"Skipping the descendant check, concept_ancestor could not be read: {e}")
+    logger.info(f"Checked metadata for {concept_df.shape[0]} concepts in {(datetime.now() - start_time).total_seconds():.2f}s"
+                f"{'' if 'engine' in engine_dict else ', read from the concept cache'}")
+    if engine is None and 'engine' in engine_dict:
+        engine_dict['engine'].dispose()
+    return problem_list
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the local TDAP concept metadata cache")
+    parser.add_argument('--config_key', help='Chooses which configuration from tdap_config to use', type=str, required=True)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('stats', help='Print the number and size of cached entries')
+    subparsers.add_parser('clear', help='Remove every cached entry')
+    args = parser.parse_args()
+
+    import example_tapestry_config as my_tdap_config
+    tdap_config = my_tdap_config.tdap_configs.get(args.config_key)
+    cache = get_concept_cache(tdap_config, 'tdap_logger')
+    if cache is None:
+        print(f"concept_cache is not enabled for {args.config_key}")
+        return
+    if args.command == 'clear':
+        print(f"Removed {cache.clear()} entries")
+    else:
+        stats = cache.stats()
+        print(f"{stats['entries']} entries, {stats['mb']:,.2f} MB")
+
+
+if __name__ == "__main__":
+    main()
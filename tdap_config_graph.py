@@ -0,0 +1,216 @@
+"""
+Date: 2026-10-18
+Purpose: Projection-aware concept evaluation.  Builds a dependency graph from what a config consumes - the
+required_cols of every included extension, cleanup and derivation, plus the configured output columns - back to the
+concepts that produce those columns, and prunes what nobody consumes:
+
+    whole concepts - dropped from the concepts stanza, so they are never queried or ingested
+    aggregates - kept concepts carry conceptproperties.aggregations, the aggregates still needed, e.g. ["max"]
+
+An included module that does not declare required_cols (most extensions) is taken to read every concept, so nothing is
+pruned from under it.  Only tdap_aggregate reads conceptproperties.aggregations.  run_omop computes every aggregate
+whatever it says, so in a normal run only whole concept pruning has an effect.
+
+Matrix columns are matched to concepts the way tdap_fill does: a column belongs to the longest concept key it is
+prefixed with, and its aggregate is the trailing _<agg> (first, last, min, max, mean, mode, std, list).  Other columns
+of a concept, such as <concept>_native, <concept>_value or <concept>_raw_timestamp, keep the concept but need no
+particular aggregate.  A column an included module declares in its produced_cols (creat_clearance, even though it
+starts with creat_) and a column with no concept prefix (kl_ratio) are listed as derived in the report.
+
+Configured with the projection stanza of a tdap config:
+
+    "projection": {
+        "enabled": True,
+        "output_columns": ["testmsr", "testdx_condition_source_value_last"]
+    }
+
+An output_columns entry equal to a concept key keeps that concept with every aggregate.  Without output_columns every
+concept is treated as output and nothing is pruned.
+
+Dry run report of what would be pruned:
+
+python tdap_config_graph.py --config_key pcd
+"""
+# imports
+import argparse
+import copy
+import logging
+import pandas as pd
+
+# sibling imports
+from tdap_aggregate import NUMERIC_AGGS, STRING_AGGS
+
+AGG_NAMES = sorted(set(NUMERIC_AGGS + STRING_AGGS), key=len, reverse=True)
+# sections whose included modules read matrix columns, declared in config.required_cols
+CONSUMER_SECTIONS = ['extensions', 'cleanups', 'derivations']
+
+
+def get_projection_config(tdap_config):
+    return tdap_config.get('projection', {})
+
+
+def get_consumers(tdap_config):
+    """
+    consumer name -> list of matrix columns it reads.  Output is the consumer 'output'.
+    A module without required_cols reads every concept as far as the graph can tell.
+    """
+    consumer_dict = {}
+    for section in CONSUMER_SECTIONS:
+        for key, v in tdap_config.get(section, {}).items():
+            if v.get('include', False):
+                module_config = v.get('config', {})
+                if 'required_cols' in module_config:
+                    consumer_dict[f"{section[:-1]}:{key}"] = list(module_config['required_cols'])
+                else:
+                    consumer_dict[f"{section[:-1]}:{key}"] = list(tdap_config.get('concepts', {}).keys())
+    output_columns = get_projection_config(tdap_config).get('output_columns')
+    # no projection means the whole matrix is output
+    consumer_dict['output'] = list(tdap_config.get('concepts', {}).keys()) if output_columns is None else list(output_columns)
+    return consumer_dict
+
+
+def get_produced_cols(tdap_config):
+    """
+    Every column an included extension, cleanup or derivation declares in config.produced_cols
+    """
+    produced = set()
+    for section in CONSUMER_SECTIONS:
+        for v in tdap_config.get(section, {}).values():
+            if v.get('include', False):
+                produced.update(v.get('config', {}).get('produced_cols') or [])
+    return produced
+
+
+def match_column(col, concept_keys, produced_cols=()):
+    """
+    (concept_key, agg) for a matrix column.  concept_key is None for columns no concept produces, agg is None for
+    columns that need the concept but no particular aggregate (and '*' when col is the concept key itself).
+    concept_keys must be sorted longest first.  produced_cols are module outputs, derived even when they share a
+    concept's prefix, e.g. creat_clearance.
+    """
+    if col in concept_keys:
+        return col, '*'
+    if col in produced_cols:
+        return None, None
+    concept_key = next((k for k in concept_keys if col.startswith(k + '_')), None)
+    if concept_key is None:
+        return None, None
+    return concept_key, next((a for a in AGG_NAMES if col.endswith('_' + a)), None)
+
+
+def build_graph(tdap_config):
+    """
+    Returns (concept_dict, derived_dict)
+        concept_dict - concept_key -> {'consumers': set, 'aggs': set of aggregates needed, '*' for all}
+        derived_dict - column -> set of consumers, for consumed columns no concept produces
+    """
+    concepts = tdap_config.get('concepts', {})
+    concept_keys = sorted(concepts.keys(), key=len, reverse=True)
+    concept_dict = {k: {'consumers': set(), 'aggs': set()} for k in concepts.keys()}
+    derived_dict = {}
+    produced_cols = get_produced_cols(tdap_config)
+    for consumer, col_list in get_consumers(tdap_config).items():
+        for col in col_list:
+            concept_key, agg = match_column(col, concept_keys, produced_cols)
+            if concept_key is None:
+                derived_dict.setdefault(col, set()).add(consumer)
+                continue
+            concept_dict[concept_key]['consumers'].add(consumer)
+            if agg is not None:
+                concept_dict[concept_key]['aggs'].add(agg)
+    return concept_dict, derived_dict
+
+
+def get_concept_aggs(origindatatype):
+    return STRING_AGGS if origindatatype == 'string' else NUMERIC_AGGS
+
+
+def plan_projection(tdap_config):
+    """
+    concept_key -> None when the concept is pruned, else the list of aggregates to compute (every one when '*' is needed)
+    """
+    concept_dict, _ = build_graph(tdap_config)
+    plan_dict = {}
+    for concept_key, node in concept_dict.items():
+        all_aggs = get_concept_aggs(tdap_config['concepts'][concept_key].get('conceptproperties', {}).get('origindatatype'))
+        if len(node['consumers']) == 0:
+            plan_dict[concept_key] = None
+        elif '*' in node['aggs']:
+            plan_dict[concept_key] = list(all_aggs)
+        else:
+            plan_dict[concept_key] = [a for a in all_aggs if a in node['aggs']]
+    return plan_dict
+
+
+def projection_report(tdap_config):
+    """
+    One row per concept: keep / partial / prune, the aggregates kept and pruned and who consumes it,
+    plus a row per consumed column that no concept produces
+    """
+    concept_dict, derived_dict = build_graph(tdap_config)
+    record_list = []
+    for concept_key, aggs in plan_projection(tdap_config).items():
+        all_aggs = get_concept_aggs(tdap_config['concepts'][concept_key].get('conceptproperties', {}).get('origindatatype'))
+        if aggs is None:
+            status = 'prune'
+        elif len(aggs) == len(all_aggs):
+            status = 'keep'
+        else:
+            status = 'partial'
+        record_list.append({'concept': concept_key, 'status': status,
+                            'aggs_kept': ','.join(aggs or []),
+                            'aggs_pruned': ','.join([a for a in all_aggs if aggs is None or a not in aggs]),
+                            'consumers': ','.join(sorted(concept_dict[concept_key]['consumers']))})
+    for col, consumers in derived_dict.items():
+        record_list.append({'concept': col, 'status': 'derived', 'aggs_kept': '', 'aggs_pruned': '',
+                            'consumers': ','.join(sorted(consumers))})
+    return pd.DataFrame(record_list, columns=['concept', 'status', 'aggs_kept', 'aggs_pruned', 'consumers'])
+
+
+def apply_projection(tdap_config, logger_name):
+    """
+    Returns a copy of tdap_config with unconsumed concepts removed and conceptproperties.aggregations set on the rest.
+    tdap_config is returned untouched when projection is not enabled.
+    """
+    logger = logging.getLogger(logger_name)
+    if not get_projection_config(tdap_config).get('enabled', False):
+        return tdap_config
+    plan_dict = plan_projection(tdap_config)
+    report_df = projection_report(tdap_config)
+    concepts = {}
+    for concept_key, concept in tdap_config.get('concepts', {}).items():
+        aggs = plan_dict[concept_key]
+        if aggs is None:
+            continue
+        concept = copy.deepcopy(concept)
+        concept.setdefault('conceptproperties', {})['aggregations'] = aggs
+        concepts[concept_key] = concept
+    status_counts = report_df['status'].value_counts()
+    logger.info(f"Projection: {status_counts.get('keep', 0)} concepts kept whole, {status_counts.get('partial', 0)} with "
+                f"some aggregates pruned, {status_counts.get('prune', 0)} pruned\n" + report_df.to_string(index=False))
+    return {**tdap_config, 'concepts': concepts}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dry run report of the concepts and aggregates projection would prune")
+    parser.add_argument('--config_key', help='Chooses which configuration from tdap_config to use', type=str, required=True)
+    parser.add_argument('--output_columns', help='Comma delimited output columns, overrides projection.output_columns',
+                        type=str, default=None)
+    args = parser.parse_args()
+
+    import example_tapestry_config as my_tdap_config
+    tdap_config = my_tdap_config.tdap_configs.get(args.config_key)
+    if args.output_columns is not None:
+        tdap_config = {**tdap_config, 'projection': {**get_projection_config(tdap_config),
+                                                     'output_columns': [x.strip() for x in args.output_columns.split(',')]}}
+    report_df = projection_report(tdap_config)
+    print(report_df.to_string(index=False))
+    aggs_total = sum(len(get_concept_aggs(c.get('conceptproperties', {}).get('origindatatype')))
+                     for c in tdap_config.get('concepts', {}).values())
+    aggs_kept = sum(len(x) for x in plan_projection(tdap_config).values() if x is not None)
+    print(f"\n{(report_df['status'] == 'prune').sum()} of {len(tdap_config.get('concepts', {}))} concepts and "
+          f"{aggs_total - aggs_kept} of {aggs_total} aggregate columns would be pruned")
+
+
+if __name__ == "__main__":
+    main()
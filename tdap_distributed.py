@@ -0,0 +1,261 @@
+"""
+Date: 2026-10-18
+Purpose: Multi-node execution of run_omop.  The coordinator partitions process_df into shards and enqueues them in a
+SQLite backed queue inside a shared run directory.  Independent workers, on this host or any host that can see the
+directory, claim shards, run them and spill their results into the shared output directory.  Once every shard is done
+the coordinator merges the outputs and does the final write and table swap.
+
+Layout of the shared run directory:
+
+    <dist_dir>/queue.sqlite                  shard queue
+    <dist_dir>/state.pkl                     incremental state the run was created with, if any
+    <dist_dir>/shards/<shard_id>.pkl         the process_df slice for each shard
+    <dist_dir>/output/shard_<shard_id>/      a TDAPCheckpoint spill directory per shard
+    <dist_dir>/output/shard_<shard_id>/failures.pkl    per patient failure records for the shard
+
+SQLite stands in for a real broker.  Claims take a write lock (BEGIN IMMEDIATE) so two workers never get the same
+shard; the shared directory should be on storage with working file locks.  A claim is identified by the worker and
+its attempt number, and completes, failures and heartbeats only apply while that claim still holds, so a worker whose
+shard was requeued from under it can't overwrite the new owner's state.
+"""
+# imports
+import logging
+import os
+import pickle
+import socket
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+
+# sibling imports
+from tdap_checkpoint import TDAPCheckpoint
+
+
+class ShardQueue:
+    """
+    Shard queue and shared output for one distributed run
+    """
+    def __init__(self, dist_dir, logger_name, worker_id=None):
+        self.dist_dir = Path(dist_dir)
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.shard_dir = self.dist_dir / 'shards'
+        self.output_dir = self.dist_dir / 'output'
+        self.state_path = self.dist_dir / 'state.pkl'
+        self.logger_name = logger_name
+        self.shard_dir.mkdir(parents=True, exist_ok=True)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.queue_path = self.dist_dir / 'queue.sqlite'
+        # autocommit, transactions are opened explicitly where they matter
+        self.conn = sqlite3.connect(str(self.queue_path), timeout=60, isolation_level=None)
+        self.conn.execute("""
+            create table if not exists shards (
+                shard_id integer primary key,
+                window_count integer,
+                status text,
+                worker text,
+                attempts integer default 0,
+                claimed_at real,
+                heartbeat real,
+                finished_at real,
+                error text
+            )""")
+
+    ##########################
+    # coordinator side
+    ##########################
+    def shard_count(self):
+        return self.conn.execute("select count(*) from shards").fetchone()[0]
+
+    def create_shards(self, process_df, shard_size, incremental_dict=None):
+        """
+        Writes process_df out as shards of shard_size windows and enqueues them
+        """
+        logger = logging.getLogger(self.logger_name)
+        with open(self.state_path, 'wb') as f:
+            pickle.dump({'incremental_dict': incremental_dict}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        shard_size = max(int(shard_size), 1)
+        rows = []
+        for shard_id, i in enumerate(range(0, process_df.shape[0], shard_size)):
+            shard_df = process_df.iloc[i:i+shard_size]
+            with open(self.shard_dir / f"{shard_id}.pkl", 'wb') as f:
+                pickle.dump(shard_df, f, protocol=pickle.HIGHEST_PROTOCOL)
+            rows.append((shard_id, shard_df.shape[0], 'pending'))
+        self.conn.executemany("insert into shards (shard_id, window_count, status) values (?,?,?)", rows)
+        logger.info(f"Enqueued {len(rows)} shards of up to {shard_size} windows in {self.dist_dir}")
+
+    def load_state(self):
+        with open(self.state_path, 'rb') as f:
+            return pickle.load(f)['incremental_dict']
+
+    def requeue_stale(self, timeout_seconds, max_attempts=3):
+        """
+        Puts running shards whose worker has not sent a heartbeat in timeout_seconds, and failed shards with attempts
+        left, back to pending.  Returns the number requeued.
+        """
+        now = datetime.now().timestamp()
+        self.conn.execute("begin immediate")
+        count = self.conn.execute("""
+            update shards set status = 'pending', worker = null
+            where (status = 'running' and heartbeat < ?) or (status = 'failed' and attempts < ?)""",
+            (now - timeout_seconds, max_attempts)).rowcount
+        self.conn.execute("commit")
+        if count > 0:
+            logging.getLogger(self.logger_name).warning(f"Requeued {count} stale or failed shards")
+        return count
+
+    def status_counts(self):
+        return dict(self.conn.execute("select status, count(*) from shards group by status").fetchall())
+
+    def live_shard_count(self, timeout_seconds):
+        """
+        Running shards whose worker has sent a heartbeat in the last timeout_seconds
+        """
+        return self.conn.execute("select count(*) from shards where status = 'running' and heartbeat >= ?",
+                                 (datetime.now().timestamp() - timeout_seconds,)).fetchone()[0]
+
+    def is_finished(self, max_attempts=3):
+        """
+        True once every shard is done or has failed max_attempts times
+        """
+        open_count = self.conn.execute("select count(*) from shards where status in ('pending', 'running') "
+                                       "or (status = 'failed' and attempts < ?)", (max_attempts,)).fetchone()[0]
+        return open_count == 0
+
+    ##########################
+    # worker side
+    ##########################
+    def claim(self, worker_id=None):
+        """
+        Atomically claims the next pending shard.  Returns (shard_id, attempt), or None when nothing is pending.
+        The attempt number is the claim token complete, fail and ShardHeartbeat are given.
+        """
+        worker_id = worker_id or self.worker_id
+        now = datetime.now().timestamp()
+        self.conn.execute("begin immediate")
+        row = self.conn.execute("select shard_id, attempts from shards where status = 'pending' order by shard_id limit 1").fetchone()
+        if row is not None:
+            self.conn.execute("""update shards set status = 'running', worker = ?, attempts = attempts + 1, claimed_at = ?,
+                                 heartbeat = ?, error = null where shard_id = ?""", (worker_id, now, now, row[0]))
+        self.conn.execute("commit")
+        return (row[0], row[1] + 1) if row is not None else None
+
+    def _holds_claim(self, shard_id, attempt, worker_id):
+        row = self.conn.execute("select 1 from shards where shard_id = ? and status = 'running' and worker = ? and attempts = ?",
+                                (shard_id, worker_id, attempt)).fetchone()
+        return row is not None
+
+    def _finish(self, shard_id, attempt, worker_id, status, error=None, failure_list=None):
+        worker_id = worker_id or self.worker_id
+        self.conn.execute("begin immediate")
+        try:
+            if not self._holds_claim(shard_id, attempt, worker_id):
+                logging.getLogger(self.logger_name).warning(f"Shard {shard_id} attempt {attempt} is no longer claimed by "
+                                                            f"{worker_id}, not marking it {status}")
+                return False
+            if failure_list is not None:
+                with open(self.shard_output_dir(shard_id) / 'failures.pkl', 'wb') as f:
+                    pickle.dump(failure_list, f, protocol=pickle.HIGHEST_PROTOCOL)
+            self.conn.execute("""update shards set status = ?, finished_at = ?, error = ?
+                                 where shard_id = ? and worker = ? and attempts = ?""",
+                              (status, datetime.now().timestamp(), error, shard_id, worker_id, attempt))
+            return True
+        finally:
+            self.conn.execute("commit")
+
+    def complete(self, shard_id, attempt, failure_list, worker_id=None):
+        """
+        Marks a claimed shard done.  Returns False, changing nothing, when the claim was lost to a requeue.
+        """
+        return self._finish(shard_id, attempt, worker_id, 'done', failure_list=failure_list)
+
+    def fail(self, shard_id, attempt, error, worker_id=None):
+        """
+        Marks a claimed shard failed.  Returns False, changing nothing, when the claim was lost to a requeue.
+        """
+        return self._finish(shard_id, attempt, worker_id, 'failed', error=str(error))
+
+    def load_shard(self, shard_id):
+        with open(self.shard_dir / f"{shard_id}.pkl", 'rb') as f:
+            return pickle.load(f)
+
+    ##########################
+    # shared output
+    ##########################
+    def shard_output_dir(self, shard_id):
+        return self.output_dir / f"shard_{shard_id}"
+
+    def shard_checkpoint(self, shard_id):
+        """
+        The spill directory for a shard.  A requeued shard reopens the same checkpoint and skips finished windows.
+        """
+        return TDAPCheckpoint(self.output_dir, f"shard_{shard_id}", self.logger_name)
+
+    def done_shard_ids(self):
+        return [x[0] for x in self.conn.execute("select shard_id from shards where status = 'done' order by shard_id")]
+
+    def iter_results(self):
+        """
+        Yields every result of every finished shard
+        """
+        for shard_id in self.done_shard_ids():
+            yield from self.shard_checkpoint(shard_id).iter_results()
+
+    def failures(self):
+        """
+        Per patient failure records from every finished shard, plus a record per window of shards that never finished
+        """
+        failure_list = []
+        for shard_id in self.done_shard_ids():
+            with open(self.shard_output_dir(shard_id) / 'failures.pkl', 'rb') as f:
+                failure_list.extend(pickle.load(f))
+        for shard_id, error in self.conn.execute("select shard_id, error from shards where status != 'done'").fetchall():
+            for row in self.load_shard(shard_id).itertuples(index=False):
+                failure_list.append({'person_id': row.person_id, 'start_time_str': row.start_time_str,
+                                     'end_time_str': row.end_time_str, 'error_type': 'ShardFailed', 'error': error,
+                                     'traceback': None, 'attempts': None, 'transient': None})
+        return failure_list
+
+    def close(self):
+        self.conn.close()
+
+
+class ShardHeartbeat:
+    """
+    Context manager that touches a claimed shard's heartbeat every interval_seconds from a background thread, so a
+    shard whose patients are slow is not mistaken for a dead worker.  The thread has its own SQLite connection, since
+    the queue's connection belongs to the worker's main thread.
+    """
+    def __init__(self, queue, shard_id, attempt, interval_seconds=60):
+        self.queue_path = queue.queue_path
+        self.worker_id = queue.worker_id
+        self.shard_id = shard_id
+        self.attempt = attempt
+        self.interval_seconds = interval_seconds
+        self.logger_name = queue.logger_name
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def run(self):
+        logger = logging.getLogger(self.logger_name)
+        conn = sqlite3.connect(str(self.queue_path), timeout=60, isolation_level=None)
+        try:
+            while not self.stop_event.wait(self.interval_seconds):
+                try:
+                    conn.execute("update shards set heartbeat = ? where shard_id = ? and worker = ? and attempts = ?",
+                                 (datetime.now().timestamp(), self.shard_id, self.worker_id, self.attempt))
+                except sqlite3.Error as e:
+                    # a missed beat is fine, the timeout is many intervals long
+                    logger.warning(f"Heartbeat for shard {self.shard_id} failed: {e}")
+        finally:
+            conn.close()
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.run, name=f"heartbeat-{self.shard_id}", daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop_event.set()
+        self.thread.join()
+        return False
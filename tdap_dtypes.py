@@ -0,0 +1,286 @@
+"""
+Date: 2026-10-18
+Purpose: Compact in-memory representations for TDAP matrices.  After ingestion most concept columns are very sparse,
+yet the matrix is held as dense columns at the configured period over the whole window.  Columns below a density
+threshold are stored as pandas SparseArrays (numeric and 0/1 flag columns) or categoricals (strings), and are only
+densified when a consumer asks for them.  Matrices are converted in the worker as soon as run_omop has returned them,
+before they are pickled back, so the parent never holds them densely.  This reduces what a run holds across the cohort,
+not the peak while one patient's matrix is being built inside the tapestry package.
+
+Matrices also come back with float64 for every number and object for every string, though output_metadata already
+holds each column's SQL type.  With dtype_plan on, output_metadata is mapped to compact pandas dtypes:
+
+    Numeric(precision <= 7)          float32 - the value rounds back exactly at the column's scale when written
+    Float, Numeric without precision float32 only with "float32": "all", else left float64
+    SmallInteger/Integer/BigInteger  the smallest int8/16/32/64 holding the values, nullable Int8/16/32/64 with nulls
+    Boolean                          bool, nullable boolean with nulls
+    String/Text                      category for columns ending in category_suffixes (_native flags, list
+                                     aggregates) or with at most max_category_ratio distinct values per row
+
+and applied once per patient, after run_omop (and the module DAG, when enabled) has returned, so every cleanup,
+derivation and extension sees the plain float64 and object columns it always did.  The cast happens in the worker, so
+less is pickled back, but the peak while a patient's matrix is built is unchanged.  Each result carries memory_bytes (before, after) and MemoryReport summarizes memory per patient
+at the end of the run.
+
+Configured with the matrix_representation stanza of a tdap config:
+
+    "matrix_representation": {
+        "sparse": False,
+        "max_density": 0.3,
+        "dtype_plan": False,
+        "float32": "bounded",        # "bounded", "all" or "none"
+        "category_suffixes": ["_native", "_list"],
+        "max_category_ratio": 0.5,
+        "exclude_cols": ["key_time"]
+    }
+"""
+# imports
+import logging
+import numpy as np
+import pandas as pd
+from sqlalchemy import types
+
+FLOAT32_MODES = ('bounded', 'all', 'none')
+# significant decimal digits a float32 holds exactly
+FLOAT32_DIGITS = 7
+
+
+def get_matrix_representation_config(tdap_config):
+    return tdap_config.get('matrix_representation', {})
+
+
+def sparsify_matrix(matrix_df, max_density=0.3, exclude_cols=None):
+    """
+    Converts every column whose share of meaningful values is at or below max_density to a compact representation.
+    Numeric columns become SparseArrays with a NaN fill (0 fill for integer/bool flag columns such as _native),
+    string columns become categoricals.  exclude_cols, e.g. the matrix keys, are left alone.
+    """
+    exclude_cols = set(exclude_cols or [])
+    for c in matrix_df.columns:
+        if c in exclude_cols:
+            continue
+        s = matrix_df[c]
+        # sparse, categorical and the nullable dtypes of a dtype plan are already compact
+        if isinstance(s.dtype, pd.api.extensions.ExtensionDtype) or s.shape[0] == 0:
+            continue
+        if pd.api.types.is_bool_dtype(s) or pd.api.types.is_integer_dtype(s):
+            if (s != 0).mean() <= max_density:
+                matrix_df[c] = s.astype(pd.SparseDtype(s.dtype, 0))
+        elif pd.api.types.is_numeric_dtype(s):
+            if s.notna().mean() <= max_density:
+                matrix_df[c] = s.astype(pd.SparseDtype(s.dtype, np.nan))
+        elif pd.api.types.is_object_dtype(s) or pd.api.types.is_string_dtype(s):
+            # lists or dicts in a cell can't be categorized, leave those columns dense
+            try:
+                matrix_df[c] = s.astype('category')
+            except TypeError:
+                pass
+    return matrix_df
+
+
+def densify_matrix(matrix_df, cols=None, output_metadata=None):
+    """
+    Converts compact columns back to their dense dtypes.  Only cols are densified when given, else every column.
+    With output_metadata, float32 columns of a Numeric type with a scale go back to float64 rounded to it, so 98.6
+    is written as 98.6 rather than 98.59999847.
+    """
+    cols = matrix_df.columns if cols is None else [c for c in cols if c in matrix_df.columns]
+    for c in cols:
+        s = matrix_df[c]
+        if isinstance(s.dtype, pd.SparseDtype):
+            s = s.sparse.to_dense()
+            matrix_df[c] = s
+        elif isinstance(s.dtype, pd.CategoricalDtype):
+            matrix_df[c] = s.astype(s.cat.categories.dtype)
+        if output_metadata is not None and s.dtype == np.float32:
+            scale = getattr(output_metadata.get(c), 'scale', None)
+            if scale is not None:
+                matrix_df[c] = s.astype(np.float64).round(scale)
+    return matrix_df
+
+
+def matrix_memory_bytes(matrix_df):
+    return int(matrix_df.memory_usage(deep=True).sum())
+
+
+#####################################
+# dtype plan
+#####################################
+def plan_dtype(col_type, float32='bounded'):
+    """
+    The compact dtype family for one SQLAlchemy column type: 'float32', 'int', 'bool', 'category' or None to leave
+    the column alone.  The exact int width and nullability depend on the values, see cast_column.
+    """
+    if float32 not in FLOAT32_MODES:
+        raise ValueError(f"Unknown matrix_representation float32 mode {float32}")
+    if isinstance(col_type, types.Boolean):
+        return 'bool'
+    if isinstance(col_type, types.Integer):
+        return 'int'
+    if isinstance(col_type, types.Numeric):
+        # Float is a Numeric, its precision counts binary digits and it has no scale to round back to
+        precision = getattr(col_type, 'precision', None)
+        if float32 == 'all' or (float32 == 'bounded' and not isinstance(col_type, types.Float)
+                                and precision is not None and precision <= FLOAT32_DIGITS):
+            return 'float32'
+        return None
+    if isinstance(col_type, (types.String, types.Enum)):
+        return 'category'
+    return None
+
+
+def plan_dtypes(output_metadata, rep_config=None):
+    """
+    column -> dtype family for every column of output_metadata with a compact dtype
+    """
+    rep_config = {} if rep_config is None else rep_config
+    float32 = rep_config.get('float32', 'bounded')
+    exclude_cols = set(rep_config.get('exclude_cols', ['key_time']))
+    plan = {}
+    for c, col_type in output_metadata.items():
+        family = plan_dtype(col_type, float32)
+        if family is not None and c not in exclude_cols:
+            plan[c] = family
+    return plan
+
+
+def _smallest_int_dtype(s, nullable):
+    prefix = 'Int' if nullable else 'int'
+    if s.notna().sum() == 0:
+        return prefix + '8'
+    lo, hi = s.min(), s.max()
+    for bits in (8, 16, 32):
+        info = np.iinfo(f"int{bits}")
+        if info.min <= lo and hi <= info.max:
+            return f"{prefix}{bits}"
+    return prefix + '64'
+
+
+def cast_column(s, family, category_suffixes=('_native', '_list'), max_category_ratio=0.5):
+    """
+    s cast to the compact dtype of its family, or s itself when the values don't fit it (text in a numeric column,
+    fractions in an integer one, too many distinct strings)
+    """
+    if isinstance(s.dtype, (pd.SparseDtype, pd.CategoricalDtype)) or s.shape[0] == 0:
+        return s
+    if family == 'category':
+        if not (pd.api.types.is_object_dtype(s) or pd.api.types.is_string_dtype(s)):
+            return s
+        try:
+            if s.name.endswith(tuple(category_suffixes)) or s.nunique() <= max_category_ratio * s.shape[0]:
+                return s.astype('category')
+        except TypeError:
+            # lists or dicts in a cell can't be categorized
+            pass
+        return s
+    if family == 'bool':
+        if pd.api.types.is_bool_dtype(s) and s.dtype != object:
+            return s
+        values = s.dropna()
+        if values.shape[0] == 0 or not values.isin([0, 1]).all():
+            return s
+        return s.astype(bool) if values.shape[0] == s.shape[0] else s.astype(object).astype('boolean')
+    numeric = pd.to_numeric(s, errors='coerce')
+    if numeric.notna().sum() < s.notna().sum():
+        return s
+    if family == 'float32':
+        return numeric if numeric.dtype == np.float32 else numeric.astype(np.float32)
+    if family == 'int':
+        if pd.api.types.is_float_dtype(numeric) and not (numeric.dropna() % 1 == 0).all():
+            return s
+        nullable = numeric.isna().any()
+        dtype = _smallest_int_dtype(numeric, nullable)
+        return numeric if str(numeric.dtype) == dtype else numeric.astype(dtype)
+    return s
+
+
+def cast_matrix(matrix_df, output_metadata, rep_config, cols=None):
+    """
+    Casts the planned columns of matrix_df (only cols when given) to their compact dtypes in place.
+    Returns (matrix_df, bytes_saved).
+    """
+    plan = plan_dtypes(output_metadata, rep_config)
+    cols = plan.keys() if cols is None else [c for c in cols if c in plan]
+    bytes_saved = 0
+    for c in cols:
+        if c not in matrix_df.columns:
+            continue
+        s = matrix_df[c]
+        cast_s = cast_column(s, plan[c], rep_config.get('category_suffixes', ['_native', '_list']),
+                             rep_config.get('max_category_ratio', 0.5))
+        if cast_s is s:
+            continue
+        bytes_saved += s.memory_usage(deep=True, index=False) - cast_s.memory_usage(deep=True, index=False)
+        matrix_df[c] = cast_s
+    return matrix_df, int(bytes_saved)
+
+
+def compact_enabled(tdap_config):
+    rep_config = get_matrix_representation_config(tdap_config)
+    return rep_config.get('dtype_plan', False) or rep_config.get('sparse', False)
+
+
+def run_compact(run_func, rep_config, *args):
+    """
+    run_omop replacement: runs run_func, casts every planned column of the finished matrix when dtype_plan is on,
+    converts sparse columns when sparse is on, and stamps the result with memory_bytes (before, after)
+    """
+    ret = run_func(*args)
+    if not isinstance(ret, dict) or ret.get('matrix_df') is None:
+        return ret
+    matrix_df = ret['matrix_df']
+    bytes_before = matrix_memory_bytes(matrix_df)
+    if rep_config.get('dtype_plan', False):
+        matrix_df, _ = cast_matrix(matrix_df, ret.get('output_metadata', {}), rep_config)
+    if rep_config.get('sparse', False):
+        matrix_df = sparsify_matrix(matrix_df, max_density=rep_config.get('max_density', 0.3),
+                                    exclude_cols=rep_config.get('exclude_cols'))
+    ret['matrix_df'] = matrix_df
+    ret['memory_bytes'] = (bytes_before, matrix_memory_bytes(matrix_df))
+    return ret
+
+
+def get_run_func(tdap_config, run_func):
+    """
+    run_func itself, or run_func wrapped with run_compact when matrix_representation.dtype_plan or sparse is on
+    """
+    if not compact_enabled(tdap_config):
+        return run_func
+    rep_config = get_matrix_representation_config(tdap_config)
+    return lambda *args: run_compact(run_func, rep_config, *args)
+
+
+class MemoryReport:
+    """
+    Collects memory_bytes from results as they stream past and summarizes matrix memory per patient, before and
+    after the compact representation
+    """
+    def __init__(self, tdap_config, logger_name):
+        self.enabled = compact_enabled(tdap_config)
+        self.logger_name = logger_name
+        self.record_list = []
+
+    def track(self, ret_dict_iter):
+        for ret in ret_dict_iter:
+            if isinstance(ret, dict) and ret.get('memory_bytes') is not None:
+                self.record_list.append(ret['memory_bytes'])
+            yield ret
+
+    def summary_df(self):
+        record_df = pd.DataFrame(self.record_list, columns=['before', 'after'])
+        if record_df.shape[0] == 0:
+            return record_df
+        summary_df = record_df.agg(['mean', lambda x: x.quantile(0.95), 'max', 'sum']).T / 1e6
+        summary_df.columns = ['mean_mb', 'p95_mb', 'max_mb', 'total_mb']
+        return summary_df
+
+    def report(self):
+        logger = logging.getLogger(self.logger_name)
+        if not self.enabled:
+            return
+        summary_df = self.summary_df()
+        if summary_df.shape[0] == 0:
+            return
+        ratio = summary_df.loc['before', 'total_mb'] / max(summary_df.loc['after', 'total_mb'], 1e-9)
+        logger.info(f"Matrix memory per patient across {len(self.record_list)} patients, {ratio:,.1f}x smaller compacted\n"
+                    + summary_df.to_string(float_format=lambda x: f"{x:,.3f}"))
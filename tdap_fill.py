@@ -0,0 +1,130 @@
+"""
+Date: 2026-10-18
+Purpose: Column batched, NumPy backed forward fill for concept columns.  Implements the fillmethod 'forwardfill'
+semantics, including the fill to normal rule:
+
+    fillwithnormalmode 'n' - the last known value is carried forward until the next value
+    fillwithnormalmode 'y' - the last known value is carried forward for filltimetonormal periods, after which
+                             fillnormalvalue is used until the next value
+
+Rows before a patient's first value are left empty.  Every column sharing the same fill settings is filled in one
+pass using index arithmetic, i.e. the position of the last known value and the distance to it, rather than a loop
+per row.
+"""
+# imports
+import numpy as np
+import pandas as pd
+
+# per concept columns that describe an observation rather than a value and must not be filled
+NO_FILL_SUFFIXES = ('_native',)
+
+
+def _last_valid_position(mask, group_start=None):
+    """
+    For a 2d boolean mask of known values (rows x columns), returns the row position of the most recent known value
+    at or above each cell, -1 if there is none.  When group_start is given (row position where each row's patient
+    starts) positions from a previous patient are treated as missing.
+    """
+    row_pos = np.arange(mask.shape[0])[:, None]
+    last_pos = np.maximum.accumulate(np.where(mask, row_pos, -1), axis=0)
+    if group_start is not None:
+        last_pos = np.where(last_pos >= group_start[:, None], last_pos, -1)
+    return last_pos
+
+
+def _to_block(df, col_list, fillwithnormalmode, fillnormalvalue):
+    """
+    Pulls col_list out as one 2d array.  All numeric columns stay float64 unless a non numeric normal value has to be
+    written into them, everything else goes through object.  Bool flags go through object too, so they come back as
+    booleans rather than 1.0/0.0
+    """
+    block = df[col_list].to_numpy()
+    numeric_normal = fillwithnormalmode != 'y' or isinstance(fillnormalvalue, (int, float, np.number))
+    if block.dtype.kind in 'fiu' and numeric_normal:
+        return block.astype(float)
+    return df[col_list].to_numpy(dtype=object)
+
+
+def _fill_block(values, fillwithnormalmode='n', filltimetonormal=0, fillnormalvalue=None, group_start=None):
+    """
+    Fills a 2d float or object array (rows x columns) and returns a new array of the same kind
+    """
+    mask = ~pd.isna(values)
+    last_pos = _last_valid_position(mask, group_start)
+    has_value = last_pos >= 0
+    col_pos = np.broadcast_to(np.arange(values.shape[1]), values.shape)
+    filled = values[np.where(has_value, last_pos, 0), col_pos]
+    if fillwithnormalmode == 'y':
+        distance = np.arange(values.shape[0])[:, None] - last_pos
+        filled = np.where(distance > int(filltimetonormal), fillnormalvalue, filled)
+    return np.where(has_value, filled, np.nan)
+
+
+def fill_columns(matrix_df, col_list, fillwithnormalmode='n', filltimetonormal=0, fillnormalvalue=None):
+    """
+    Forward fills col_list of a single patient matrix (rows already in time order) in one pass
+    """
+    if len(col_list) == 0:
+        return matrix_df
+    block = _to_block(matrix_df, col_list, fillwithnormalmode, fillnormalvalue)
+    filled = _fill_block(block, fillwithnormalmode, filltimetonormal, fillnormalvalue)
+    filled_df = pd.DataFrame(filled, index=matrix_df.index, columns=col_list).infer_objects()
+    matrix_df[col_list] = filled_df
+    return matrix_df
+
+
+def fill_columns_stacked(stacked_df, col_list, fillwithnormalmode='n', filltimetonormal=0, fillnormalvalue=None,
+                         key_col='person_id', time_col='key_time'):
+    """
+    Multi patient variant of fill_columns for a stacked (key_col, time_col) frame.
+    Values never carry across patients.  Returns the frame sorted by key_col, time_col.
+    """
+    stacked_df = stacked_df.sort_values([key_col, time_col], kind='mergesort').reset_index(drop=True)
+    if len(col_list) == 0:
+        return stacked_df
+    keys = stacked_df[key_col].to_numpy()
+    is_start = np.ones(len(keys), dtype=bool)
+    is_start[1:] = keys[1:] != keys[:-1]
+    group_start = np.maximum.accumulate(np.where(is_start, np.arange(len(keys)), 0))
+    block = _to_block(stacked_df, col_list, fillwithnormalmode, fillnormalvalue)
+    filled = _fill_block(block, fillwithnormalmode, filltimetonormal, fillnormalvalue, group_start=group_start)
+    stacked_df[col_list] = pd.DataFrame(filled, index=stacked_df.index, columns=col_list).infer_objects()
+    return stacked_df
+
+
+def get_concept_fill_groups(matrix_df, tdap_config):
+    """
+    Groups the matrix's concept columns by their fill settings so each group can be filled in one pass.
+    A column belongs to the longest concept key it is prefixed with, so 'bp' does not claim 'bp_map_...' columns
+    when 'bp_map' is its own concept.
+    Returns a dict of (fillwithnormalmode, filltimetonormal, fillnormalvalue) -> column list
+    """
+    concepts = tdap_config.get('concepts', {})
+    concept_keys = sorted(concepts.keys(), key=len, reverse=True)
+    fill_groups = {}
+    for c in matrix_df.columns:
+        if c.endswith(NO_FILL_SUFFIXES):
+            continue
+        concept_key = next((k for k in concept_keys if c.startswith(k + '_')), None)
+        if concept_key is None:
+            continue
+        props = concepts[concept_key].get('conceptproperties', {})
+        if props.get('fillmethod') != 'forwardfill':
+            continue
+        group_key = (props.get('fillwithnormalmode', 'n'), int(props.get('filltimetonormal', 0)), props.get('fillnormalvalue'))
+        fill_groups.setdefault(group_key, []).append(c)
+    return fill_groups
+
+
+def fill_concepts(matrix_df, tdap_config, key_col=None, time_col='key_time'):
+    """
+    Fills every forwardfill concept column of a matrix, one pass per distinct fill setting.
+    Pass key_col to fill a stacked multi patient frame.
+    """
+    for (mode, time_to_normal, normal_value), col_list in get_concept_fill_groups(matrix_df, tdap_config).items():
+        if key_col is None:
+            matrix_df = fill_columns(matrix_df, col_list, mode, time_to_normal, normal_value)
+        else:
+            matrix_df = fill_columns_stacked(matrix_df, col_list, mode, time_to_normal, normal_value,
+                                             key_col=key_col, time_col=time_col)
+    return matrix_df
@@ -0,0 +1,189 @@
+"""
+Date: 2026-10-18
+Purpose: Incremental re-runs.  For every patient we record a watermark per concept - the max source datetime, the max
+source row id and the row count seen in the patient's windows - in a <matrix_table_name>_watermarks table next to the
+matrix.  On the next run the current watermarks are pulled from OMOP with one staged window query per concept per
+chunk (tdap_omop_batch), and only the patients whose watermarks moved (or whose set of windows changed) are rebuilt
+and merged into the matrix table.
+
+Rebuilt rows are written to a <table>_incr staging table first and merged per chunk of patients, delete and insert in
+one transaction, so a run that dies part way never leaves a patient without rows.  Patients that have left the
+population have their rows and watermarks removed.
+"""
+# imports
+import logging
+from random import sample
+import pandas as pd
+from sqlalchemy import inspect, text
+
+# sibling imports
+import tdap_omop_batch
+
+WATERMARK_COLS = ['person_id', 'concept_key', 'max_datetime', 'max_id', 'row_count']
+# pseudo concept that records the patient's window set, so a change in windows triggers a rebuild too
+WINDOW_CONCEPT_KEY = '__windows__'
+
+
+def get_watermark_table_name(tdap_config):
+    return tdap_config['tables']['matrix_table_name'] + '_watermarks'
+
+
+def build_watermark_sql(origintype, originid_list, window_table_name):
+    """
+    One query per concept returning the watermark of every staged window
+    """
+    domain = tdap_omop_batch.OMOP_DOMAINS[origintype]
+    sql = f"""
+    select
+        w.window_id,
+        max(t.{domain['datetime_col']}) as max_datetime,
+        max(t.{domain['id_col']}) as max_id,
+        count(*) as row_count
+    from
+        {window_table_name} w
+        inner join {domain['table']} t
+            on t.person_id = w.person_id
+            and t.{domain['datetime_col']} >= w.start_time
+            and t.{domain['datetime_col']} <= w.end_time
+    where
+        t.{domain['concept_col']} in ({",".join([str(x) for x in originid_list])})
+    group by
+        w.window_id
+    """
+    return sql
+
+
+def normalize_watermarks(watermark_df):
+    """
+    Puts watermarks read from different sources on the same dtypes so they compare cleanly
+    """
+    watermark_df = watermark_df.filter(WATERMARK_COLS).copy()
+    watermark_df['person_id'] = watermark_df['person_id'].astype('int64')
+    watermark_df['max_datetime'] = pd.to_datetime(watermark_df['max_datetime'])
+    watermark_df['max_id'] = pd.to_numeric(watermark_df['max_id']).astype('Int64')
+    watermark_df['row_count'] = pd.to_numeric(watermark_df['row_count']).astype('Int64')
+    return watermark_df
+
+
+def get_current_watermarks(engine, window_df, tdap_config, logger_name, chunk_size=500):
+    """
+    Pulls the current per patient, per concept watermarks for every window in window_df from OMOP
+    """
+    logger = logging.getLogger(logger_name)
+    concepts = tdap_omop_batch.get_batchable_concepts(tdap_config)
+    watermark_df_list = []
+    for chunk_df in tdap_omop_batch.chunk_windows(window_df, chunk_size):
+        with engine.connect() as conn:
+            window_table_name = tdap_omop_batch.stage_windows(conn, chunk_df, logger_name)
+            for concept_key, concept in concepts.items():
+                props = concept.get('conceptproperties')
+                sql = build_watermark_sql(props.get('origintype'), tdap_omop_batch.originid_to_list(props.get('originid')), window_table_name)
+                one_df = pd.read_sql(text(sql), conn)
+                one_df['concept_key'] = concept_key
+                watermark_df_list.append(one_df.merge(chunk_df.filter(['window_id', 'person_id']), on='window_id'))
+    if len(watermark_df_list) > 0:
+        window_wm_df = pd.concat(watermark_df_list, ignore_index=True)
+        watermark_df = (window_wm_df.groupby(['person_id', 'concept_key'], as_index=False)
+                                    .agg(max_datetime=('max_datetime', 'max'), max_id=('max_id', 'max'), row_count=('row_count', 'sum')))
+    else:
+        watermark_df = pd.DataFrame(columns=WATERMARK_COLS)
+
+    # the window set itself is part of the watermark
+    windows_wm_df = (window_df.groupby('person_id', as_index=False)
+                              .agg(max_datetime=('end_time', 'max'), row_count=('window_id', 'count')))
+    windows_wm_df['concept_key'] = WINDOW_CONCEPT_KEY
+    windows_wm_df['max_id'] = None
+    watermark_df = normalize_watermarks(pd.concat([watermark_df, windows_wm_df], ignore_index=True))
+    logger.info(f"Pulled {watermark_df.shape[0]} current watermarks for {window_df['person_id'].nunique()} patients")
+    return watermark_df
+
+
+def get_stored_watermarks(engine, tdap_config):
+    """
+    Returns the stored watermarks, or None when no watermark table exists yet (first run)
+    """
+    table_name = get_watermark_table_name(tdap_config)
+    if not inspect(engine).has_table(table_name):
+        return None
+    return normalize_watermarks(pd.read_sql(f"select {', '.join(WATERMARK_COLS)} from {table_name}", engine))
+
+
+def get_changed_person_ids(current_df, stored_df):
+    """
+    Patients with any concept watermark added, removed or moved since the stored watermarks were written.
+    Every patient is changed when there are no stored watermarks.
+    """
+    if stored_df is None:
+        return sorted(current_df['person_id'].unique().tolist())
+    stored_df = stored_df.loc[stored_df['person_id'].isin(current_df['person_id'].unique())]
+    compare_df = current_df.merge(stored_df, on=['person_id', 'concept_key'], how='outer', suffixes=('_cur', '_old'), indicator=True)
+    changed = compare_df['_merge'] != 'both'
+    for c in ['max_datetime', 'max_id', 'row_count']:
+        cur = compare_df[c + '_cur']
+        old = compare_df[c + '_old']
+        changed = changed | ~((cur == old).fillna(False) | (cur.isna() & old.isna()))
+    return sorted(compare_df.loc[changed, 'person_id'].unique().tolist())
+
+
+def get_dropped_person_ids(current_df, stored_df):
+    """
+    Patients with stored watermarks that are no longer in the population
+    """
+    if stored_df is None:
+        return []
+    return sorted(set(stored_df['person_id'].unique().tolist()) - set(current_df['person_id'].unique().tolist()))
+
+
+def sample_persons(process_df, pat_limit):
+    """
+    Limits process_df to pat_limit randomly chosen patients, keeping every window of each one.  Rebuilding a patient
+    replaces all of their rows, so sampling single windows would drop the rest of the patient's matrix.
+    """
+    person_ids = process_df['person_id'].unique().tolist()
+    if pat_limit <= 0 or pat_limit >= len(person_ids):
+        return process_df
+    return process_df[process_df['person_id'].isin(sample(person_ids, pat_limit))]
+
+
+def delete_person_rows(engine, table_name, person_ids, person_col='person_id', chunk_size=1000):
+    """
+    Deletes every row for person_ids from table_name, in chunks to keep IN lists a sane size
+    """
+    with engine.begin() as conn:
+        for i in range(0, len(person_ids), chunk_size):
+            id_str = ",".join([str(int(x)) for x in person_ids[i:i+chunk_size]])
+            conn.execute(text(f"delete from {table_name} where {person_col} in ({id_str})"))
+
+
+def merge_staged_rows(engine, table_name, staging_table_name, person_ids, person_col='person_id', chunk_size=1000):
+    """
+    Replaces the rows of person_ids in table_name with their rows in staging_table_name, then drops the staging table.
+    Each chunk is deleted and re-inserted in one transaction, so a failure leaves every patient with either the old
+    rows or the new ones.  Patients without staged rows (or no staging table at all) are only deleted.
+    table_name must already hold every staged column.
+    """
+    inspector = inspect(engine)
+    staged = inspector.has_table(staging_table_name)
+    if staged:
+        preparer = engine.dialect.identifier_preparer
+        col_str = ", ".join([preparer.quote(c['name']) for c in inspector.get_columns(staging_table_name)])
+    for i in range(0, len(person_ids), chunk_size):
+        id_str = ",".join([str(int(x)) for x in person_ids[i:i+chunk_size]])
+        with engine.begin() as conn:
+            conn.execute(text(f"delete from {table_name} where {person_col} in ({id_str})"))
+            if staged:
+                conn.execute(text(f"insert into {table_name} ({col_str}) select {col_str} from {staging_table_name} where {person_col} in ({id_str})"))
+    if staged:
+        with engine.begin() as conn:
+            conn.execute(text(f"drop table {staging_table_name}"))
+
+
+def save_watermarks(engine, tdap_config, watermark_df, person_ids, dropped_ids=()):
+    """
+    Replaces the stored watermarks for person_ids with the current ones and removes those of dropped_ids
+    """
+    table_name = get_watermark_table_name(tdap_config)
+    if inspect(engine).has_table(table_name):
+        delete_person_rows(engine, table_name, list(person_ids) + list(dropped_ids))
+    (watermark_df.loc[watermark_df['person_id'].isin(person_ids)]
+                 .to_sql(table_name, engine, index=False, if_exists='append'))
@@ -0,0 +1,318 @@
+"""
+Date: 2026-10-18
+Purpose: Dependency-aware execution of extensions, cleanups and derivations.  Each module declares the matrix
+columns it reads (config.required_cols) and the columns it writes (config.produced_cols).  From those the modules form a
+DAG: a module depends on every module producing one of its required columns.  The DAG is validated at startup, run in
+topological order with independent modules of a wave running concurrently, and a module whose inputs are missing for a
+patient is skipped along with the modules that read its produced columns, rather than raising MissingRequiredCols part
+way through.
+
+Configured with the module_dag stanza of a tdap config:
+
+    "module_dag": {
+        "enabled": True,
+        "max_threads": 4
+    }
+
+and per module, next to required_cols:
+
+    "kl_ratio": {
+        "include": True,
+        "module": "derivation_kl_ratio",
+        "concurrency": "thread",          # optional, run on a thread alongside the rest of its wave (I/O heavy modules)
+        "config": {
+            "required_cols": ["kapalr_ord_num_value_mean", "lmdalr_ord_num_value_mean"],
+            "produced_cols": ["kl_ratio"]
+        }
+    }
+
+A module without produced_cols keeps config order semantics: it runs after every module before it in the config and
+before every module after it.  Those config order edges only order the modules.  A skip is passed on only to modules
+that read a column the skipped module produces.  Modules run in the same process by default; thread modules work on
+their own copy of the matrix and only their produced_cols are merged back, so they must declare them.
+
+When enabled, run_omop is handed a config with extensions, cleanups and derivations switched off and the DAG runs them
+on its result.  Extensions are called with the tapestry helpers (key_time_to_period, get_mode_1,
+fill_concept_data_frame, add_phase) that can be imported; any that can't are left to the extension's defaults.  Every
+module is passed its own config, as run_omop passes it.
+"""
+# imports
+import heapq
+import importlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+# sibling imports
+from tdap_config_graph import match_column
+
+# section -> module function name, in the order run_omop runs them
+DAG_SECTIONS = {'extensions': 'extend', 'cleanups': 'cleanup', 'derivations': 'derive'}
+SECTION_ORDER = ['extensions', 'cleanups', 'derivations']
+# extend keyword -> name of the tapestry helper passed for it
+EXTENSION_HELPERS = {'to_period_func': 'key_time_to_period', 'mode_func': 'get_mode_1', 'fill_func': 'fill_concept_data_frame'}
+
+
+class ModuleDagError(ValueError):
+    """
+    The module declarations do not form a valid DAG (a cycle, or a thread module without produced_cols), or a thread
+    module changed the matrix rows its produced_cols are merged back onto
+    """
+    pass
+
+
+def get_module_dag_config(tdap_config):
+    return tdap_config.get('module_dag', {})
+
+
+def get_module_nodes(tdap_config):
+    """
+    One dict per included module in config order: name, section, key, module, config, required, produced, concurrency.
+    produced is None when the module does not declare produced_cols.
+    """
+    node_list = []
+    for section in SECTION_ORDER:
+        for key, v in tdap_config.get(section, {}).items():
+            if not v.get('include', False):
+                continue
+            module_config = v.get('config', {})
+            node_list.append({'name': f"{section[:-1]}:{key}", 'section': section, 'key': key, 'module': v.get('module'),
+                              'config': module_config, 'required': list(module_config.get('required_cols', [])),
+                              'produced': module_config.get('produced_cols'), 'concurrency': v.get('concurrency', 'inline')})
+    return node_list
+
+
+def build_module_dag(tdap_config):
+    """
+    Returns (node_list, dep_dict, unresolved_dict)
+        dep_dict - module name -> set of module names it depends on
+        unresolved_dict - module name -> required columns no concept or declared module produces
+    """
+    node_list = get_module_nodes(tdap_config)
+    concept_keys = sorted(tdap_config.get('concepts', {}).keys(), key=len, reverse=True)
+    dep_dict = {n['name']: set() for n in node_list}
+    unresolved_dict = {}
+    producer_dict = {}
+    for node in node_list:
+        for col in node['produced'] or []:
+            producer_dict.setdefault(col, []).append(node['name'])
+    for i, node in enumerate(node_list):
+        earlier = [n['name'] for n in node_list[:i]]
+        if node['produced'] is None:
+            # undeclared outputs - a barrier in config order
+            dep_dict[node['name']].update(earlier)
+            for later in node_list[i+1:]:
+                dep_dict[later['name']].add(node['name'])
+            continue
+        for col in node['required']:
+            producers = [p for p in producer_dict.get(col, []) if p != node['name']]
+            if len(producers) > 0:
+                dep_dict[node['name']].update(producers)
+            elif match_column(col, concept_keys)[0] is None:
+                unresolved_dict.setdefault(node['name'], []).append(col)
+        # a module rewriting a column another module produced runs after it, in config order
+        for col in node['produced']:
+            dep_dict[node['name']].update([p for p in producer_dict[col] if p in earlier])
+    return node_list, dep_dict, unresolved_dict
+
+
+def get_data_deps(node_list):
+    """
+    module name -> the modules producing one of its required_cols.  Only these edges carry a skip downstream; the
+    config order edges around modules without produced_cols just order them.
+    """
+    producer_dict = {}
+    for node in node_list:
+        for col in node['produced'] or []:
+            producer_dict.setdefault(col, []).append(node['name'])
+    return {n['name']: {p for col in n['required'] for p in producer_dict.get(col, []) if p != n['name']} for n in node_list}
+
+
+def topological_order(node_list, dep_dict):
+    """
+    Kahn's algorithm, ties broken by config order so independent modules keep the order they were written in.
+    Raises ModuleDagError naming the modules on a cycle.
+    """
+    position = {n['name']: i for i, n in enumerate(node_list)}
+    remaining = {k: set(v) for k, v in dep_dict.items()}
+    ready = [(position[k], k) for k, v in remaining.items() if len(v) == 0]
+    heapq.heapify(ready)
+    order = []
+    while len(ready) > 0:
+        _, name = heapq.heappop(ready)
+        order.append(name)
+        for k, v in remaining.items():
+            if name in v:
+                v.discard(name)
+                if len(v) == 0:
+                    heapq.heappush(ready, (position[k], k))
+    if len(order) < len(node_list):
+        cycle = sorted([k for k in remaining if k not in order], key=position.get)
+        raise ModuleDagError(f"Module dependencies form a cycle among {', '.join(cycle)}")
+    return order
+
+
+def validate_module_dag(tdap_config, logger_name):
+    """
+    Startup check of the module declarations.  Raises ModuleDagError for cycles and thread modules without
+    produced_cols, warns about required columns nothing is known to produce.  Returns the topological order.
+    """
+    logger = logging.getLogger(logger_name)
+    node_list, dep_dict, unresolved_dict = build_module_dag(tdap_config)
+    for node in node_list:
+        if node['concurrency'] == 'thread' and node['produced'] is None:
+            raise ModuleDagError(f"{node['name']} runs on a thread and must declare produced_cols")
+    order = topological_order(node_list, dep_dict)
+    for name, col_list in unresolved_dict.items():
+        logger.warning(f"{name} requires {', '.join(col_list)}, which no concept or declared module produces.  "
+                       f"It will be skipped for patients without them")
+    undeclared = [n['name'] for n in node_list if n['produced'] is None]
+    if len(undeclared) > 0:
+        logger.info(f"Modules without produced_cols run in config order: {', '.join(undeclared)}")
+    logger.info(f"Module order: {' -> '.join(order)}")
+    return order
+
+
+def get_waves(node_list, dep_dict):
+    """
+    Groups the DAG modules into waves - every module of a wave depends only on modules of earlier waves
+    """
+    order = topological_order(node_list, dep_dict)
+    wave_dict = {}
+    for name in order:
+        wave_dict[name] = 1 + max([wave_dict[d] for d in dep_dict[name] if d in wave_dict] or [-1])
+    wave_list = [[] for _ in range(max(wave_dict.values(), default=-1) + 1)]
+    for name in order:
+        wave_list[wave_dict[name]].append(name)
+    return wave_list
+
+
+def get_run_omop_config(tdap_config):
+    """
+    The config run_omop sees when the DAG runs the modules itself: extensions, cleanups and derivations switched off
+    """
+    stripped = {**tdap_config}
+    for section in DAG_SECTIONS:
+        stripped[section] = {k: {**v, 'include': False} for k, v in tdap_config.get(section, {}).items()}
+    return stripped
+
+
+def get_tapestry_helpers():
+    """
+    The tapestry functions handed to module functions, name -> function, for the ones that can be imported
+    """
+    helper_dict = {}
+    try:
+        from tapestry import tapestry
+    except ImportError:
+        return helper_dict
+    for name in list(EXTENSION_HELPERS.values()) + ['add_phase']:
+        func = getattr(tapestry, name, None)
+        if func is not None:
+            helper_dict[name] = func
+    return helper_dict
+
+
+def _call_module(node, matrix_df, pat_profile_dict, output_metadata, tdap_config, logger_name, helper_dict):
+    module = importlib.import_module(node['module'])
+    # looked up on every call so the timing wrappers of tdap_timing are what runs
+    func = getattr(module, DAG_SECTIONS[node['section']])
+    kwargs = {'add_phase_func': helper_dict.get('add_phase')}
+    if node['section'] == 'extensions':
+        kwargs.update({k: helper_dict[v] for k, v in EXTENSION_HELPERS.items() if v in helper_dict})
+    return func(matrix_df, pat_profile_dict, output_metadata, node['config'], logger_name, **kwargs)
+
+
+def _is_missing_required_cols(e):
+    # modules written before the DAG raise on missing inputs themselves
+    return type(e).__name__ == 'MissingRequiredCols'
+
+
+def run_module_dag(matrix_df, pat_profile_dict, output_metadata, tdap_config, logger_name, helper_dict=None):
+    """
+    Runs every included extension, cleanup and derivation on one patient's matrix in DAG order.
+    Returns (matrix_df, output_metadata, skipped) where skipped lists the modules skipped for missing inputs.
+    """
+    logger = logging.getLogger(logger_name)
+    helper_dict = helper_dict or {}
+    node_list, dep_dict, _ = build_module_dag(tdap_config)
+    data_dep_dict = get_data_deps(node_list)
+    node_dict = {n['name']: n for n in node_list}
+    max_threads = get_module_dag_config(tdap_config).get('max_threads', 4)
+    skipped = []
+    for wave in get_waves(node_list, dep_dict):
+        runnable = []
+        for name in wave:
+            node = node_dict[name]
+            missing = [c for c in node['required'] if c not in matrix_df.columns]
+            skipped_deps = [d for d in data_dep_dict[name] if d in skipped]
+            if len(missing) > 0 or len(skipped_deps) > 0:
+                skipped.append(name)
+                logger.warning(f"Skipping {name}, missing inputs {', '.join(missing + skipped_deps)}")
+                continue
+            runnable.append(node)
+
+        thread_nodes = [n for n in runnable if n['concurrency'] == 'thread']
+        # threads are only started on submit, so a wave without thread modules costs nothing here
+        with ThreadPoolExecutor(max_workers=max(min(max_threads, len(thread_nodes)), 1)) as executor:
+            # thread modules get their own copy, their produced columns are merged back once the wave is done
+            futures = {node['name']: executor.submit(_call_module, node, matrix_df.copy(), pat_profile_dict,
+                                                     dict(output_metadata), tdap_config, logger_name, helper_dict)
+                       for node in thread_nodes}
+            for node in runnable:
+                if node['concurrency'] == 'thread':
+                    continue
+                try:
+                    matrix_df, output_metadata = _call_module(node, matrix_df, pat_profile_dict, output_metadata,
+                                                              tdap_config, logger_name, helper_dict)
+                except Exception as e:
+                    if not _is_missing_required_cols(e):
+                        raise
+                    skipped.append(node['name'])
+                    logger.warning(f"Skipping {node['name']}, it raised MissingRequiredCols")
+            for name, future in futures.items():
+                try:
+                    thread_df, thread_metadata = future.result()
+                except Exception as e:
+                    if not _is_missing_required_cols(e):
+                        raise
+                    skipped.append(name)
+                    logger.warning(f"Skipping {name}, it raised MissingRequiredCols")
+                    continue
+                if not thread_df.index.equals(matrix_df.index):
+                    if not thread_df.index.is_unique or set(thread_df.index) != set(matrix_df.index):
+                        raise ModuleDagError(f"{name} ran on a thread and changed the matrix rows, its produced_cols "
+                                             f"can't be merged back")
+                    thread_df = thread_df.reindex(matrix_df.index)
+                for col in node_dict[name]['produced']:
+                    if col in thread_df.columns:
+                        # aligned on the index above, .array keeps the column's dtype, categoricals and nullable ints included
+                        matrix_df[col] = thread_df[col].array
+                        if col in thread_metadata:
+                            output_metadata[col] = thread_metadata[col]
+    return matrix_df, output_metadata, skipped
+
+
+def run_with_module_dag(run_func, *args):
+    """
+    run_omop replacement: runs run_func with extensions, cleanups and derivations switched off, then runs them through
+    the DAG.  args is run_omop's (person_id, start_time_str, end_time_str, visit_occurrence_id_list, id_type,
+    tdap_config, logger_name, source).  Modules skipped for missing inputs are listed on the result under
+    skipped_modules.
+    """
+    tdap_config, logger_name = args[5], args[6]
+    ret = run_func(*args[:5], get_run_omop_config(tdap_config), *args[6:])
+    if not isinstance(ret, dict) or ret.get('matrix_df') is None:
+        return ret
+    ret['matrix_df'], ret['output_metadata'], ret['skipped_modules'] = run_module_dag(
+        ret['matrix_df'], ret.get('pat_profile_dict', {}), ret['output_metadata'], tdap_config, logger_name,
+        helper_dict=get_tapestry_helpers())
+    return ret
+
+
+def get_run_func(tdap_config, run_func):
+    """
+    run_func itself, or run_func wrapped with the module DAG when module_dag is enabled
+    """
+    if not get_module_dag_config(tdap_config).get('enabled', False):
+        return run_func
+    return lambda *args: run_with_module_dag(run_func, *args)
@@ -0,0 +1,146 @@
+"""
+Date: 2026-10-18
+Purpose: Cohort batched queries against OMOP.  Rather than one templated query per concept per patient, a chunk of
+(person_id, start_time, end_time) windows is staged into a session temp table and each concept is queried for the
+whole chunk with a single join.  Incremental runs pull their watermarks this way (tdap_incremental) and precount
+scheduling its row counts (tdap_schedule).
+
+The matrix build itself still queries concepts per patient inside the tapestry package, which has no way to take
+frames pulled here, so there is no batched extraction of concept rows.
+"""
+# imports
+import logging
+from sqlalchemy import (MetaData, Table, Column, Integer, BigInteger, DateTime)
+
+
+###########################################
+# OMOP domain definitions
+# one entry per origintype supported by the OMOP adapter
+###########################################
+OMOP_DOMAINS = {
+    "measurement": {
+        "table": "measurement",
+        "id_col": "measurement_id",
+        "concept_col": "measurement_concept_id",
+        "datetime_col": "measurement_datetime",
+        "value_cols": ["value_as_number", "value_as_concept_id", "unit_concept_id", "value_source_value"]
+    },
+    "condition_occurrence": {
+        "table": "condition_occurrence",
+        "id_col": "condition_occurrence_id",
+        "concept_col": "condition_concept_id",
+        "datetime_col": "condition_start_datetime",
+        "value_cols": ["condition_end_datetime", "condition_source_value"]
+    },
+    "drug_exposure": {
+        "table": "drug_exposure",
+        "id_col": "drug_exposure_id",
+        "concept_col": "drug_concept_id",
+        "datetime_col": "drug_exposure_start_datetime",
+        "value_cols": ["drug_exposure_end_datetime", "quantity", "drug_source_value"]
+    },
+    "procedure_occurrence": {
+        "table": "procedure_occurrence",
+        "id_col": "procedure_occurrence_id",
+        "concept_col": "procedure_concept_id",
+        "datetime_col": "procedure_datetime",
+        "value_cols": ["quantity", "procedure_source_value"]
+    },
+    "observation": {
+        "table": "observation",
+        "id_col": "observation_id",
+        "concept_col": "observation_concept_id",
+        "datetime_col": "observation_datetime",
+        "value_cols": ["value_as_number", "value_as_string", "value_as_concept_id", "observation_source_value"]
+    },
+    "device_exposure": {
+        "table": "device_exposure",
+        "id_col": "device_exposure_id",
+        "concept_col": "device_concept_id",
+        "datetime_col": "device_exposure_start_datetime",
+        "value_cols": ["quantity", "device_source_value"]
+    }
+}
+
+WINDOW_COLS = ['window_id', 'person_id', 'start_time', 'end_time']
+# dialects stage_windows can create a session temp table on
+STAGING_DIALECTS = ('mssql', 'postgresql', 'sqlite')
+
+
+def get_batchable_concepts(tdap_config):
+    """
+    Returns the subset of the concepts stanza whose origintype is an OMOP domain this module knows how to query
+    """
+    return {k: v for k, v in tdap_config.get('concepts', {}).items()
+            if v.get('conceptproperties', {}).get('origintype') in OMOP_DOMAINS}
+
+
+def originid_to_list(originid):
+    """
+    Concepts carry originid either as a list of ints or as a comma delimited string.  Normalize to a list of ints
+    """
+    if isinstance(originid, str):
+        return [int(x) for x in originid.replace("'", "").split(',') if x.strip() != '']
+    return [int(x) for x in originid]
+
+
+def chunk_windows(window_df, chunk_size):
+    """
+    Yields successive chunk_size slices of the window dataframe
+    """
+    chunk_size = max(int(chunk_size), 1)
+    for i in range(0, window_df.shape[0], chunk_size):
+        yield window_df.iloc[i:i+chunk_size]
+
+
+def staging_dialect_error(dialect):
+    return (f"Incremental runs stage windows in a temp table on the OMOP server, "
+            f"which is supported for {', '.join(STAGING_DIALECTS)}, not {dialect}")
+
+
+def check_staging_dialect(engine):
+    """
+    Startup check for the features that stage windows on the OMOP server.  Raises ValueError naming the dialect
+    when it can't hold the session temp table, rather than failing on the first chunk.
+    """
+    dialect = engine.dialect.name
+    if dialect not in STAGING_DIALECTS:
+        raise ValueError(staging_dialect_error(dialect))
+
+
+def stage_windows(conn, window_df, logger_name):
+    """
+    Creates a session scoped temp table on conn and loads the window chunk into it.
+    Returns the name the table should be referenced by in subsequent queries on the same connection.
+
+    MSSQL uses a '#' local temp table; postgresql and sqlite support CREATE TEMPORARY TABLE.
+    """
+    logger = logging.getLogger(logger_name)
+    dialect = conn.dialect.name
+    if dialect == 'mssql':
+        table_name = '#tdap_windows'
+        prefixes = []
+    elif dialect in STAGING_DIALECTS:
+        table_name = 'tdap_windows'
+        prefixes = ['TEMPORARY']
+    else:
+        raise ValueError(staging_dialect_error(dialect))
+
+    window_table = Table(table_name, MetaData(),
+                         Column('window_id', Integer, primary_key=True),
+                         Column('person_id', BigInteger, index=True),
+                         Column('start_time', DateTime),
+                         Column('end_time', DateTime),
+                         prefixes=prefixes)
+    window_table.drop(conn, checkfirst=True)
+    window_table.create(conn)
+    records = (window_df.filter(WINDOW_COLS)
+                        .astype({'window_id': int, 'person_id': int})
+                        .to_dict(orient='records'))
+    # to_dict yields pandas Timestamps, DBAPI drivers want plain datetimes
+    for r in records:
+        r['start_time'] = r['start_time'].to_pydatetime()
+        r['end_time'] = r['end_time'].to_pydatetime()
+    conn.execute(window_table.insert(), records)
+    logger.debug(f"Staged {len(records)} windows into {table_name}")
+    return table_name
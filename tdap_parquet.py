@@ -0,0 +1,303 @@
+"""
+Date: 2026-10-18
+Purpose: Parquet file sink for TDAP matrices, an alternative or addition to the SQL destinations.  Matrices are
+written as a hive partitioned Parquet dataset, one set of part files per flush, as patients finish.  Column types come
+from output_metadata, mapped from SQLAlchemy types to Arrow types, so the files carry the same schema the SQL table
+would.  Reading back a few concept columns only touches those columns.
+
+Configured with the parquet_sink stanza of a tdap config:
+
+    "parquet_sink": {
+        "enabled": True,
+        "path": "output/parquet",
+        "partition_by": "person_hash",   # or "period"
+        "hash_buckets": 32,
+        "partition_period": "M",
+        "time_col": "key_time",
+        "write_batch_size": 50000
+    }
+
+The dataset for a run lives at <path>/<matrix_table_name>.  Full runs write <matrix_table_name>_temp and swap it in on
+close, like the temp table rename.  Incremental runs write <matrix_table_name>_incr and merge it in on close: the
+rebuilt and dropped patients' rows are removed from the live dataset and the new part files moved across.
+"""
+# imports
+import logging
+import shutil
+import uuid
+from datetime import datetime
+from pathlib import Path
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from sqlalchemy import types as sa_types
+
+# sibling imports
+from tdap_dtypes import densify_matrix
+from tdap_timing import stage
+
+PERSON_BUCKET_COL = 'person_bucket'
+PERIOD_COL = 'period'
+
+# checked in order, so subclasses (e.g. Date before DateTime, Boolean) land on the right Arrow type
+SA_TO_ARROW = [
+    (sa_types.Boolean, pa.bool_()),
+    (sa_types.BigInteger, pa.int64()),
+    (sa_types.SmallInteger, pa.int16()),
+    (sa_types.Integer, pa.int64()),
+    (sa_types.Float, pa.float64()),
+    (sa_types.Numeric, pa.float64()),
+    (sa_types.DateTime, pa.timestamp('us')),
+    (sa_types.Date, pa.date32()),
+    (sa_types.Time, pa.time64('us')),
+    (sa_types.String, pa.string()),
+]
+
+
+def sa_to_arrow_type(col_type):
+    """
+    Arrow type for a SQLAlchemy type (class or instance).  Anything unmapped, or no type at all, is stored as string.
+    """
+    if col_type is None:
+        return pa.string()
+    type_class = col_type if isinstance(col_type, type) else type(col_type)
+    for sa_type, arrow_type in SA_TO_ARROW:
+        if issubclass(type_class, sa_type):
+            return arrow_type
+    return pa.string()
+
+
+def get_arrow_schema(output_metadata):
+    return pa.schema([(k, sa_to_arrow_type(v)) for k, v in output_metadata.items()])
+
+
+def get_parquet_sink_config(tdap_config):
+    sink_config = tdap_config.get('parquet_sink', {})
+    return sink_config if sink_config.get('enabled', False) else None
+
+
+def get_partition_col(partition_by):
+    if partition_by == 'person_hash':
+        return PERSON_BUCKET_COL
+    if partition_by == 'period':
+        return PERIOD_COL
+    raise ValueError(f"Unknown parquet_sink partition_by {partition_by}")
+
+
+def person_buckets(person_ids, hash_buckets):
+    """
+    Stable bucket per person_id - the pandas hash is seeded with a fixed key, so a person lands in the same bucket
+    on every run and an incremental run only has to touch that patient's bucket
+    """
+    hashed = pd.util.hash_pandas_object(pd.Series(person_ids, dtype=object).astype(str), index=False).to_numpy()
+    return [f"{x:03d}" for x in hashed % hash_buckets]
+
+
+def to_arrow_table(batch_df, schema):
+    """
+    Casts a batch to the sink schema.  String columns go through pandas' string dtype first so mixed object columns
+    (numbers and text) convert cleanly.
+    """
+    batch_df = batch_df.copy()
+    for field in schema:
+        if pa.types.is_string(field.type):
+            batch_df[field.name] = batch_df[field.name].astype('string')
+        elif pa.types.is_timestamp(field.type) or pa.types.is_date(field.type):
+            batch_df[field.name] = pd.to_datetime(batch_df[field.name])
+    return pa.Table.from_pandas(batch_df, schema=schema, preserve_index=False, safe=False)
+
+
+class TDAPParquetWriter:
+    """
+    Drop-in counterpart of TDAPMatrixWriter that writes a partitioned Parquet dataset.
+
+    output_metadata may grow as results arrive.  Part files written before a column appeared simply lack it;
+    read_matrix unifies the schemas of every part file and returns nulls there.
+    """
+    def __init__(self, dataset_path, output_metadata, logger_name, partition_by='person_hash', hash_buckets=32,
+                 partition_period='M', time_col='key_time', batch_size=50000, final_path=None):
+        self.dataset_path = Path(dataset_path)
+        self.final_path = Path(final_path) if final_path is not None else None
+        self.output_metadata = dict(output_metadata) if output_metadata is not None else {}
+        self.logger_name = logger_name
+        self.partition_by = partition_by
+        self.partition_col = get_partition_col(partition_by)
+        self.hash_buckets = hash_buckets
+        self.partition_period = partition_period
+        self.time_col = time_col
+        self.batch_size = batch_size
+        self.buffer_list = []
+        self.buffer_rows = 0
+        self.rows_written = 0
+        self.files_written = 0
+        self.write_seconds = 0.0
+
+    def merge_output_metadata(self, output_metadata):
+        for k, v in output_metadata.items():
+            if k not in self.output_metadata:
+                self.output_metadata[k] = v
+
+    def write(self, matrix_df, output_metadata=None):
+        """
+        Adds one matrix to the buffer, flushing when the buffer reaches batch_size rows
+        """
+        if output_metadata is not None:
+            self.merge_output_metadata(output_metadata)
+        self.buffer_list.append(matrix_df)
+        self.buffer_rows += matrix_df.shape[0]
+        if self.buffer_rows >= self.batch_size:
+            self.flush()
+
+    def partition_values(self, batch_df):
+        if self.partition_col == PERSON_BUCKET_COL:
+            return person_buckets(batch_df['person_id'], self.hash_buckets)
+        return pd.to_datetime(batch_df[self.time_col]).dt.to_period(self.partition_period).astype(str)
+
+    def flush(self):
+        """
+        Writes everything in the buffer as one part file per partition
+        """
+        logger = logging.getLogger(self.logger_name)
+        if self.buffer_rows == 0:
+            self.buffer_list = []
+            return
+        start_time = datetime.now()
+        batch_df = pd.concat([densify_matrix(x.reindex(columns=list(self.output_metadata.keys())), output_metadata=self.output_metadata) for x in self.buffer_list],
+                             ignore_index=True)
+        self.buffer_list = []
+        self.buffer_rows = 0
+
+        with stage('write'):
+            table = to_arrow_table(batch_df, get_arrow_schema(self.output_metadata))
+            table = table.append_column(self.partition_col, pa.array(self.partition_values(batch_df), pa.string()))
+            pq.write_to_dataset(table, str(self.dataset_path), partition_cols=[self.partition_col],
+                                basename_template=f"part-{uuid.uuid4().hex}-{{i}}.parquet",
+                                existing_data_behavior='overwrite_or_ignore')
+
+        seconds = (datetime.now() - start_time).total_seconds()
+        self.rows_written += batch_df.shape[0]
+        self.files_written += 1
+        self.write_seconds += seconds
+        logger.debug(f"Flushed {batch_df.shape[0]} rows to {self.dataset_path} in {seconds:.2f}s")
+
+    def close(self):
+        """
+        Flushes any remaining rows and logs a throughput report
+        """
+        logger = logging.getLogger(self.logger_name)
+        self.flush()
+        rows_per_sec = self.rows_written / self.write_seconds if self.write_seconds > 0 else 0
+        logger.info(f"Wrote {self.rows_written} rows to {self.dataset_path} in {self.write_seconds:.2f}s ({rows_per_sec:,.0f} rows/s)")
+
+    def delete_person_rows(self, person_ids):
+        """
+        Removes every row of person_ids from the dataset.  Part files are rewritten without those rows, or removed
+        when nothing is left.  Under person_hash partitioning only the affected buckets are read.
+        """
+        person_ids = set(person_ids)
+        if len(person_ids) == 0 or not self.dataset_path.exists():
+            return
+        if self.partition_col == PERSON_BUCKET_COL:
+            dir_list = [self.dataset_path / f"{PERSON_BUCKET_COL}={b}" for b in set(person_buckets(list(person_ids), self.hash_buckets))]
+        else:
+            dir_list = [self.dataset_path]
+        for d in dir_list:
+            for part_path in d.rglob('*.parquet'):
+                table = pq.read_table(part_path)
+                keep_mask = pc.invert(pc.is_in(table['person_id'], value_set=pa.array(list(person_ids), table['person_id'].type)))
+                if pc.all(keep_mask).as_py() is not False:
+                    continue
+                kept = table.filter(keep_mask)
+                if kept.num_rows == 0:
+                    part_path.unlink()
+                else:
+                    pq.write_table(kept, part_path)
+
+    def swap(self):
+        """
+        Replaces final_path with this dataset, the file equivalent of the temp table rename.
+        A writer without a final_path already writes in place.
+        """
+        if self.final_path is None or self.final_path == self.dataset_path:
+            return
+        logger = logging.getLogger(self.logger_name)
+        old_path = self.final_path.with_name(self.final_path.name + '_old')
+        if old_path.exists():
+            shutil.rmtree(old_path)
+        if self.final_path.exists():
+            self.final_path.rename(old_path)
+        if self.dataset_path.exists():
+            self.dataset_path.rename(self.final_path)
+        else:
+            self.final_path.mkdir(parents=True)
+        if old_path.exists():
+            shutil.rmtree(old_path)
+        logger.info(f"Moved {self.dataset_path} to {self.final_path}")
+        self.dataset_path = self.final_path
+
+
+    def merge(self, person_ids):
+        """
+        Incremental counterpart of swap.  Removes person_ids from final_path, then moves this dataset's part files
+        into it.  Part files are only rewritten for the affected patients, so the gap where they have no rows is short.
+        """
+        if self.final_path is None or self.final_path == self.dataset_path:
+            return
+        logger = logging.getLogger(self.logger_name)
+        live_writer = TDAPParquetWriter(self.final_path, None, self.logger_name, partition_by=self.partition_by,
+                                        hash_buckets=self.hash_buckets, partition_period=self.partition_period,
+                                        time_col=self.time_col)
+        live_writer.delete_person_rows(person_ids)
+        if self.dataset_path.exists():
+            for part_path in self.dataset_path.rglob('*.parquet'):
+                dest_path = self.final_path / part_path.relative_to(self.dataset_path)
+                dest_path.parent.mkdir(parents=True, exist_ok=True)
+                part_path.rename(dest_path)
+            shutil.rmtree(self.dataset_path)
+        logger.info(f"Merged {self.dataset_path} into {self.final_path}")
+        self.dataset_path = self.final_path
+
+
+def get_parquet_writer(tdap_config, logger_name, incremental=False):
+    """
+    A TDAPParquetWriter for the run, or None when the sink is not enabled.  Full runs write to a _temp dataset that
+    replaces the live one on close, incremental runs to an _incr dataset that is merged into it.
+    """
+    sink_config = get_parquet_sink_config(tdap_config)
+    if sink_config is None:
+        return None
+    final_path = Path(sink_config.get('path', 'output/parquet')) / tdap_config['tables']['matrix_table_name']
+    dataset_path = final_path.with_name(final_path.name + ('_incr' if incremental else '_temp'))
+    if dataset_path.exists():
+        # left over from an earlier run that never swapped
+        shutil.rmtree(dataset_path)
+    return TDAPParquetWriter(dataset_path, None, logger_name,
+                             partition_by=sink_config.get('partition_by', 'person_hash'),
+                             hash_buckets=sink_config.get('hash_buckets', 32),
+                             partition_period=sink_config.get('partition_period', 'M'),
+                             time_col=sink_config.get('time_col', 'key_time'),
+                             batch_size=sink_config.get('write_batch_size', 50000),
+                             final_path=final_path)
+
+
+def read_matrix(dataset_path, columns=None, person_ids=None):
+    """
+    Reads a matrix dataset back into a DataFrame, optionally only some columns and patients.
+    Part files are unified into one schema, so columns added part way through a run come back as nulls where absent.
+    """
+    part_list = sorted(Path(dataset_path).rglob('*.parquet'))
+    if len(part_list) == 0:
+        return pd.DataFrame(columns=columns)
+    schema = pa.unify_schemas([pq.read_schema(p) for p in part_list])
+    # the partition column lives in the directory names, not the files
+    partition_col = part_list[0].parent.name.split('=')[0]
+    schema = schema.append(pa.field(partition_col, pa.string()))
+    dataset = ds.dataset(str(dataset_path), format='parquet', partitioning='hive', schema=schema)
+    row_filter = None
+    if person_ids is not None:
+        row_filter = ds.field('person_id').isin(list(person_ids))
+    if columns is None:
+        columns = [c for c in schema.names if c != partition_col]
+    return dataset.to_table(columns=columns, filter=row_filter).to_pandas()
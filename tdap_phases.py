@@ -0,0 +1,232 @@
+"""
+Date: 2026-10-18
+Purpose: Phase compressed (run length) matrix output.  A forward filled matrix repeats the same values period after
+period, often for weeks.  Rather than persisting every row, each column is stored as one row per phase - a run of
+consecutive periods holding the same value, the same change detection add_phase uses for its phase counters.  Runs of
+nulls are not stored at all.  phases_to_matrix reconstitutes the dense matrix on demand.
+
+Phase rows:
+
+    person_id     the patient
+    col_name      the matrix column, or __window__ for the row that records the extent of the patient's matrix
+    phase_start   start of the first period of the phase
+    phase_end     start of the period after the last one (exclusive)
+    value_num     the value, for numeric and boolean columns
+    value_str     the value as text, for every other column
+    value_dtype   the column's dtype, used to restore it when reading back
+
+Phases are kept per matrix column, so a concept with several aggregate columns gets phases for each, and they are
+recomputed here from the values rather than taken from add_phase's counters.  Reading back restores each column's
+dtype exactly, with two exceptions: an integer or bool column whose round trip leaves nulls (periods no phase covers)
+comes back as the nullable dtype of the same width (int8 as Int8, bool as boolean), and a categorical comes back with
+only the categories that appear in its phases.  Sparse columns come back dense.
+
+Configured with the phase_output stanza of a tdap config:
+
+    "phase_output": {
+        "mode": "both",              # "dense" (default), "phases" or "both"
+        "time_col": "key_time"
+    }
+
+Phase rows go to tables.matrix_phase_table_name, default <matrix_table_name>_phases.
+"""
+# imports
+import logging
+import numpy as np
+import pandas as pd
+from sqlalchemy import BigInteger, DateTime, Float, String, Text, text
+
+# sibling imports
+from tdap_dtypes import densify_matrix
+from tdap_timing import stage
+
+WINDOW_COL_NAME = '__window__'
+PHASE_COLS = ['person_id', 'col_name', 'phase_start', 'phase_end', 'value_num', 'value_str', 'value_dtype']
+PHASE_OUTPUT_METADATA = {
+    'person_id': BigInteger(),
+    'col_name': String(256),
+    'phase_start': DateTime(),
+    'phase_end': DateTime(),
+    'value_num': Float(),
+    'value_str': Text(),
+    'value_dtype': String(32)
+}
+
+
+def get_phase_output_config(tdap_config):
+    return tdap_config.get('phase_output', {})
+
+
+def get_output_tables(tdap_config):
+    """
+    (table_name, phased) for every matrix table the configured output mode writes
+    """
+    mode = get_phase_output_config(tdap_config).get('mode', 'dense')
+    if mode not in ('dense', 'phases', 'both'):
+        raise ValueError(f"Unknown phase_output mode {mode}")
+    tables = tdap_config['tables']
+    output_list = []
+    if mode in ('dense', 'both'):
+        output_list.append((tables['matrix_table_name'], False))
+    if mode in ('phases', 'both'):
+        output_list.append((tables.get('matrix_phase_table_name', tables['matrix_table_name'] + '_phases'), True))
+    return output_list
+
+
+def _period_ordinals(time_series, period):
+    return time_series.dt.to_period(period).array.asi8
+
+
+def _ordinals_to_times(ordinals, period):
+    return pd.PeriodIndex(pd.arrays.PeriodArray(np.asarray(ordinals, dtype='int64'), dtype=pd.PeriodDtype(period))).start_time
+
+
+def matrix_to_phases(matrix_df, period, time_col='key_time', output_metadata=None):
+    """
+    Run length encodes every column of a matrix (one patient or a stacked batch) into phase rows.
+    A phase ends where the value changes, at a gap in the period grid, or at the next patient.
+    """
+    df = densify_matrix(matrix_df.copy(), output_metadata=output_metadata).sort_values(['person_id', time_col], kind='mergesort').reset_index(drop=True)
+    if df.shape[0] == 0:
+        return pd.DataFrame(columns=PHASE_COLS)
+    ordinals = _period_ordinals(pd.to_datetime(df[time_col]), period)
+    person_ids = df['person_id'].to_numpy()
+    # a new run starts at each new patient and wherever the grid skips a period
+    boundary = np.ones(df.shape[0], dtype=bool)
+    boundary[1:] = (person_ids[1:] != person_ids[:-1]) | (ordinals[1:] != ordinals[:-1] + 1)
+
+    phase_df_list = []
+    window_df = pd.DataFrame({'person_id': person_ids, 'start': ordinals, 'end': ordinals + 1}).groupby('person_id', sort=False)
+    window_df = window_df.agg(start=('start', 'min'), end=('end', 'max')).reset_index()
+    phase_df_list.append(pd.DataFrame({'person_id': window_df['person_id'], 'col_name': WINDOW_COL_NAME,
+                                       'phase_start': _ordinals_to_times(window_df['start'], period),
+                                       'phase_end': _ordinals_to_times(window_df['end'], period)}))
+
+    for c in df.columns:
+        if c in ('person_id', time_col):
+            continue
+        s = df[c]
+        # categoricals are recorded as such, sparse columns by their dense dtype
+        dtype_str = 'category' if isinstance(matrix_df[c].dtype, pd.CategoricalDtype) else str(s.dtype)
+        isna = s.isna().to_numpy()
+        changed = boundary.copy()
+        # null to null is not a change, anything else that differs from the row before is.  Compared in pandas, where
+        # nullable columns (a dtype plan's Int8 etc.) give NA next to a null rather than raising
+        differs = (s != s.shift()).fillna(True).to_numpy(dtype=bool)
+        changed[1:] |= differs[1:] & ~(isna[1:] & isna[:-1])
+        keep = ~isna
+        if not keep.any():
+            continue
+        phase_id = np.cumsum(changed)[keep]
+        run_df = pd.DataFrame({'person_id': person_ids[keep], 'start': ordinals[keep], 'end': ordinals[keep] + 1,
+                               'value': s.to_numpy()[keep], 'phase_id': phase_id})
+        run_df = run_df.groupby('phase_id', sort=False).agg(person_id=('person_id', 'first'), start=('start', 'min'),
+                                                            end=('end', 'max'), value=('value', 'first'))
+        is_numeric = pd.api.types.is_numeric_dtype(s) or pd.api.types.is_bool_dtype(s)
+        phase_df_list.append(pd.DataFrame({
+            'person_id': run_df['person_id'].to_numpy(),
+            'col_name': c,
+            'phase_start': _ordinals_to_times(run_df['start'], period),
+            'phase_end': _ordinals_to_times(run_df['end'], period),
+            'value_num': run_df['value'].astype(float).to_numpy() if is_numeric else np.nan,
+            'value_str': None if is_numeric else run_df['value'].astype(str).to_numpy(),
+            'value_dtype': dtype_str
+        }))
+    return pd.concat(phase_df_list, ignore_index=True).reindex(columns=PHASE_COLS)
+
+
+def _restore_dtype(values, dtype_str):
+    """
+    Puts a rebuilt column back on its recorded dtype.  Periods outside any phase are nulls, so numpy integer and bool
+    columns that picked some up move to the nullable dtype of the same width.
+    """
+    if dtype_str.startswith('datetime64'):
+        return pd.to_datetime(values, format='ISO8601')
+    if dtype_str == 'bool':
+        return values.astype('boolean' if values.isna().any() else 'bool')
+    if dtype_str.startswith(('int', 'uint')):
+        if not values.isna().any():
+            return values.astype(dtype_str)
+        # int8 -> Int8, uint16 -> UInt16
+        return values.astype(dtype_str.replace('uint', 'UInt') if dtype_str.startswith('uint') else dtype_str.capitalize())
+    if dtype_str.startswith(('Int', 'UInt', 'float', 'Float')) or dtype_str in ('boolean', 'string', 'category'):
+        return values.astype(dtype_str)
+    return values
+
+
+def phases_to_matrix(phase_df, period, time_col='key_time', columns=None):
+    """
+    Reconstitutes the dense matrix from phase rows: one row per patient per period over the patient's window,
+    nulls wherever no phase covers a period.  Pass columns to rebuild only some of them.
+    """
+    window_df = phase_df.loc[phase_df['col_name'] == WINDOW_COL_NAME]
+    start = _period_ordinals(pd.to_datetime(window_df['phase_start']), period)
+    lengths = _period_ordinals(pd.to_datetime(window_df['phase_end']), period) - start
+    grid_person = np.repeat(window_df['person_id'].to_numpy(), lengths)
+    grid_ordinal = np.repeat(start, lengths) + (np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths))
+    grid_index = pd.MultiIndex.from_arrays([grid_person, grid_ordinal])
+    matrix_df = pd.DataFrame({'person_id': grid_person, time_col: _ordinals_to_times(grid_ordinal, period)})
+
+    value_df = phase_df.loc[phase_df['col_name'] != WINDOW_COL_NAME]
+    if columns is not None:
+        value_df = value_df.loc[value_df['col_name'].isin(columns)]
+    for col_name, col_df in value_df.groupby('col_name', sort=False):
+        start = _period_ordinals(pd.to_datetime(col_df['phase_start']), period)
+        lengths = _period_ordinals(pd.to_datetime(col_df['phase_end']), period) - start
+        ordinal = np.repeat(start, lengths) + (np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths))
+        dtype_str = col_df['value_dtype'].iloc[0]
+        values = col_df['value_num'] if col_df['value_str'].isna().all() else col_df['value_str']
+        col_s = pd.Series(np.repeat(values.to_numpy(), lengths),
+                          index=pd.MultiIndex.from_arrays([np.repeat(col_df['person_id'].to_numpy(), lengths), ordinal]))
+        matrix_df[col_name] = _restore_dtype(col_s.reindex(grid_index), dtype_str).reset_index(drop=True)
+    return matrix_df
+
+
+def read_dense_matrix(engine, phase_table_name, period, person_ids=None, time_col='key_time', columns=None):
+    """
+    Reads phase rows from the database and returns the dense matrix for person_ids (every patient when None)
+    """
+    sql = f"select * from {phase_table_name}"
+    params = {}
+    if person_ids is not None:
+        person_ids = list(person_ids)
+        sql += f" where person_id in ({','.join([f':p{i}' for i in range(len(person_ids))])})"
+        params = {f"p{i}": int(x) for i, x in enumerate(person_ids)}
+    with engine.connect() as conn:
+        phase_df = pd.read_sql(text(sql), conn, params=params)
+    return phases_to_matrix(phase_df, period, time_col=time_col, columns=columns)
+
+
+class TDAPPhaseWriter:
+    """
+    Wraps a matrix writer (TDAPMatrixWriter or TDAPParquetWriter) so each matrix is written as its phase rows
+    """
+    def __init__(self, writer, tdap_config, logger_name):
+        self.writer = writer
+        self.period = tdap_config.get('period', 'H')
+        self.time_col = get_phase_output_config(tdap_config).get('time_col', 'key_time')
+        self.logger_name = logger_name
+        self.dense_rows = 0
+        self.phase_rows = 0
+        self.writer.merge_output_metadata(PHASE_OUTPUT_METADATA)
+
+    def merge_output_metadata(self, output_metadata):
+        # the phase table's schema is fixed whatever columns the matrix has
+        pass
+
+    def write(self, matrix_df, output_metadata=None):
+        with stage('phase_compress'):
+            phase_df = matrix_to_phases(matrix_df, self.period, time_col=self.time_col, output_metadata=output_metadata)
+        self.dense_rows += matrix_df.shape[0]
+        self.phase_rows += phase_df.shape[0]
+        self.writer.write(phase_df)
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        logger = logging.getLogger(self.logger_name)
+        self.writer.close()
+        if self.dense_rows > 0:
+            logger.info(f"Phase compressed {self.dense_rows} matrix rows into {self.phase_rows} phase rows "
+                        f"({self.dense_rows / max(self.phase_rows, 1):,.1f}x)")
@@ -0,0 +1,241 @@
+"""
+Date: 2026-10-18
+Purpose: Population index.  Rather than scanning the clinical tables with a hand written UNION every run, the
+population query is generated from the configured concepts and its result - one row per person per concept with the
+first and last event datetime and the event count - is materialized once into an index table.  Windows are then built
+from the index, so later runs, and changes to the window length or mode, never touch the clinical tables.
+
+Index rows:
+
+    person_id        the patient
+    concept_key      the concept the events matched
+    first_datetime   earliest event datetime
+    last_datetime    latest event datetime
+    row_count        number of events
+
+Configured with the pop_index stanza of a tdap config:
+
+    "pop_index": {
+        "enabled": True,
+        "database": "tdap_dm",       # databases key the index is stored in, default the first dest database
+        "table_name": None,          # default <matrix_table_name>_pop_index
+        "max_age_hours": 24,         # rebuilt when older, None keeps it until the concepts change
+        "window_mode": "first",      # "first", "per_concept" or "span"
+        "window_days": 7
+    }
+
+Window modes, every window window_days long:
+
+    first          one window per person, starting at their first event of any concept
+    per_concept    one window per person per concept, starting at its first event
+    span           back to back windows from a person's first event to their last
+
+A <table_name>_meta table records each concept's origintype and originids when it was indexed.  Concepts added to the
+config, or whose ids change, are indexed on the next run without rebuilding the rest.
+
+Print the generated population query:
+
+python tdap_pop_index.py --config_key dev_omop
+"""
+# imports
+import argparse
+import logging
+from datetime import datetime
+import pandas as pd
+from sqlalchemy import inspect, text
+
+# ripy
+from ucdripydbutils import ucdripydbutils
+
+# sibling imports
+import tdap_omop_batch
+
+POP_INDEX_COLS = ['person_id', 'concept_key', 'first_datetime', 'last_datetime', 'row_count']
+META_COLS = ['concept_key', 'origintype', 'originids', 'built_at']
+WINDOW_MODES = ('first', 'per_concept', 'span')
+
+
+def get_pop_index_config(tdap_config):
+    return tdap_config.get('pop_index', {})
+
+
+def get_index_table_name(tdap_config):
+    table_name = get_pop_index_config(tdap_config).get('table_name')
+    return table_name if table_name is not None else tdap_config['tables']['matrix_table_name'] + '_pop_index'
+
+
+def get_index_database_key(tdap_config):
+    database_key = get_pop_index_config(tdap_config).get('database')
+    if database_key is not None:
+        return database_key
+    return next(k for k, v in tdap_config.get('databases').items() if v.get('dest') == True)
+
+
+def get_concept_signatures(tdap_config):
+    """
+    concept_key -> (origintype, comma delimited sorted originids) for every OMOP concept in the config
+    """
+    signature_dict = {}
+    for concept_key, concept in tdap_omop_batch.get_batchable_concepts(tdap_config).items():
+        props = concept.get('conceptproperties')
+        originid_list = sorted(tdap_omop_batch.originid_to_list(props.get('originid')))
+        signature_dict[concept_key] = (props.get('origintype'), ",".join([str(x) for x in originid_list]))
+    return signature_dict
+
+
+def build_pop_index_sql(tdap_config, concept_keys=None):
+    """
+    One statement returning the index rows for concept_keys (every OMOP concept when None): a per person aggregate
+    per concept, put together with union all
+    """
+    select_list = []
+    for concept_key, (origintype, originids) in get_concept_signatures(tdap_config).items():
+        if concept_keys is not None and concept_key not in concept_keys:
+            continue
+        domain = tdap_omop_batch.OMOP_DOMAINS[origintype]
+        select_list.append(f"""
+    select
+        t.person_id,
+        '{concept_key}' as concept_key,
+        min(t.{domain['datetime_col']}) as first_datetime,
+        max(t.{domain['datetime_col']}) as last_datetime,
+        count(*) as row_count
+    from
+        {domain['table']} t
+    where
+        t.{domain['concept_col']} in ({originids})
+        and t.{domain['datetime_col']} is not null
+    group by
+        t.person_id
+    """)
+    return "\n    union all\n".join(select_list)
+
+
+def delete_concept_rows(engine, table_name, concept_keys):
+    params = {f"k{i}": k for i, k in enumerate(concept_keys)}
+    with engine.begin() as conn:
+        conn.execute(text(f"delete from {table_name} where concept_key in ({','.join([':' + p for p in params])})"), params)
+
+
+def get_stale_concepts(index_engine, tdap_config):
+    """
+    Concept keys whose index rows are missing, out of date with the config, or older than max_age_hours
+    """
+    signature_dict = get_concept_signatures(tdap_config)
+    meta_table_name = get_index_table_name(tdap_config) + '_meta'
+    if not inspect(index_engine).has_table(meta_table_name):
+        return sorted(signature_dict.keys())
+    meta_df = pd.read_sql(f"select {', '.join(META_COLS)} from {meta_table_name}", index_engine)
+    meta_dict = {r.concept_key: r for r in meta_df.itertuples(index=False)}
+    max_age_hours = get_pop_index_config(tdap_config).get('max_age_hours', 24)
+    stale_list = []
+    for concept_key, (origintype, originids) in signature_dict.items():
+        meta = meta_dict.get(concept_key)
+        if meta is None or meta.origintype != origintype or meta.originids != originids:
+            stale_list.append(concept_key)
+        elif max_age_hours is not None and (datetime.now() - pd.Timestamp(meta.built_at)).total_seconds() > max_age_hours * 3600:
+            stale_list.append(concept_key)
+    return stale_list
+
+
+def build_pop_index(omop_engine, index_engine, tdap_config, logger_name, concept_keys=None):
+    """
+    Runs the population query for concept_keys and replaces their rows (and meta rows) in the index table
+    """
+    logger = logging.getLogger(logger_name)
+    table_name = get_index_table_name(tdap_config)
+    meta_table_name = table_name + '_meta'
+    signature_dict = get_concept_signatures(tdap_config)
+    concept_keys = sorted(signature_dict.keys()) if concept_keys is None else sorted(concept_keys)
+    if len(concept_keys) == 0:
+        return
+    start_time = datetime.now()
+    with omop_engine.connect() as conn:
+        index_df = pd.read_sql(text(build_pop_index_sql(tdap_config, concept_keys)), conn)
+    index_df = index_df.reindex(columns=POP_INDEX_COLS)
+    index_df['first_datetime'] = pd.to_datetime(index_df['first_datetime'])
+    index_df['last_datetime'] = pd.to_datetime(index_df['last_datetime'])
+    meta_df = pd.DataFrame([(k,) + signature_dict[k] + (datetime.now(),) for k in concept_keys], columns=META_COLS)
+    for one_table_name in (table_name, meta_table_name):
+        if inspect(index_engine).has_table(one_table_name):
+            delete_concept_rows(index_engine, one_table_name, concept_keys)
+    with index_engine.begin() as conn:
+        index_df.to_sql(table_name, conn, index=False, if_exists='append', chunksize=10000)
+        meta_df.to_sql(meta_table_name, conn, index=False, if_exists='append')
+    logger.info(f"Indexed {index_df.shape[0]} person concept rows for {len(concept_keys)} concepts "
+                f"in {(datetime.now() - start_time).total_seconds():.2f}s")
+
+
+def read_pop_index(index_engine, tdap_config):
+    """
+    Index rows for the concepts currently in the config
+    """
+    concept_keys = list(get_concept_signatures(tdap_config).keys())
+    if len(concept_keys) == 0:
+        return pd.DataFrame(columns=POP_INDEX_COLS)
+    key_str = ",".join([f"'{k}'" for k in concept_keys])
+    index_df = pd.read_sql(f"select {', '.join(POP_INDEX_COLS)} from {get_index_table_name(tdap_config)} "
+                           f"where concept_key in ({key_str})", index_engine)
+    index_df['first_datetime'] = pd.to_datetime(index_df['first_datetime'])
+    index_df['last_datetime'] = pd.to_datetime(index_df['last_datetime'])
+    return index_df
+
+
+def windows_from_index(index_df, window_mode='first', window_days=7):
+    """
+    Population frame (person_id, start_time) for create_process_df, one row per window
+    """
+    if window_mode not in WINDOW_MODES:
+        raise ValueError(f"Unknown pop_index window_mode {window_mode}")
+    if window_mode == 'per_concept':
+        pop_df = index_df.rename(columns={'first_datetime': 'start_time'})
+    else:
+        pop_df = (index_df.groupby('person_id', as_index=False)
+                          .agg(start_time=('first_datetime', 'min'), last_time=('last_datetime', 'max')))
+        if window_mode == 'span':
+            # enough back to back windows to reach the last event
+            window_len = pd.Timedelta(days=window_days)
+            pop_df['window_count'] = ((pop_df['last_time'] - pop_df['start_time']) // window_len).astype(int) + 1
+            pop_df = pop_df.loc[pop_df.index.repeat(pop_df['window_count'])]
+            pop_df['start_time'] = pop_df['start_time'] + window_len * pop_df.groupby(level=0).cumcount()
+    return (pop_df.filter(['person_id', 'start_time'])
+                  .drop_duplicates()
+                  .sort_values(['person_id', 'start_time'])
+                  .reset_index(drop=True))
+
+
+def get_pop(tdap_config, logger_name):
+    """
+    get_pop replacement: refreshes stale concepts in the index, then builds the population from it
+    """
+    logger = logging.getLogger(logger_name)
+    index_config = get_pop_index_config(tdap_config)
+    index_engine = ucdripydbutils.get_engine_from_connect_dict(
+        tdap_config.get('databases').get(get_index_database_key(tdap_config)).get('secret'))
+    stale_list = get_stale_concepts(index_engine, tdap_config)
+    if len(stale_list) > 0:
+        logger.info(f"Indexing the population for {', '.join(stale_list)}")
+        omop_engine = ucdripydbutils.get_engine_from_connect_dict(tdap_config.get('databases').get('omop').get('secret'))
+        build_pop_index(omop_engine, index_engine, tdap_config, logger_name, concept_keys=stale_list)
+        omop_engine.dispose()
+    else:
+        logger.info("Population index is up to date")
+    index_df = read_pop_index(index_engine, tdap_config)
+    index_engine.dispose()
+    pop_df = windows_from_index(index_df, index_config.get('window_mode', 'first'), index_config.get('window_days', 7))
+    logger.info(f"{pop_df.shape[0]} windows for {pop_df['person_id'].nunique()} patients from the population index")
+    return pop_df
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print the population query generated from a config's concepts")
+    parser.add_argument('--config_key', help='Chooses which configuration from tdap_config to use', type=str, required=True)
+    args = parser.parse_args()
+
+    import example_tapestry_config as my_tdap_config
+    tdap_config = my_tdap_config.tdap_configs.get(args.config_key)
+    print(build_pop_index_sql(tdap_config))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Date: 2026-10-18
+Purpose: Cost-aware ordering of patient windows and per-worker utilization reporting.  Patients vary hugely in window
+length and event density; dispatched in population order the tail of a run is a few heavy patients running on one
+worker while the others sit idle.  Windows are instead dispatched longest-first, one at a time (imap chunksize 1), so
+the heavy patients start early and the light ones fill in around them.
+
+Cost is estimated by databases.omop.schedule:
+    "window"   - window length in periods x number of configured concepts, no database work.  Windows are a fixed
+                 window_days long unless window_coalesce merges them, so without coalescing every window costs the same
+                 and the order is unchanged.
+    "precount" - source rows per window across every configured concept, from one count query per concept per chunk
+                 using the staged window join of tdap_omop_batch.  On a dialect that can't stage windows the population
+                 order is kept.
+
+Scheduling is opt in, the example config leaves schedule as None.
+"""
+# imports
+import logging
+import os
+from time import time
+import pandas as pd
+from pandas.tseries.frequencies import to_offset
+from sqlalchemy import text
+
+# sibling imports
+import tdap_omop_batch
+
+
+def build_count_sql(origintype, originid_list, window_table_name):
+    domain = tdap_omop_batch.OMOP_DOMAINS[origintype]
+    sql = f"""
+    select
+        w.window_id,
+        count(*) as row_count
+    from
+        {window_table_name} w
+        inner join {domain['table']} t
+            on t.person_id = w.person_id
+            and t.{domain['datetime_col']} >= w.start_time
+            and t.{domain['datetime_col']} <= w.end_time
+    where
+        t.{domain['concept_col']} in ({",".join([str(x) for x in originid_list])})
+    group by
+        w.window_id
+    """
+    return sql
+
+
+def estimate_window_costs(process_df, tdap_config, logger_name, method='window', engine=None, chunk_size=500):
+    """
+    Returns a Series of estimated cost indexed like process_df
+    """
+    logger = logging.getLogger(logger_name)
+    concept_count = max(len(tdap_config.get('concepts', {})), 1)
+    periods = (process_df['end_time'] - process_df['start_time']) / pd.Timedelta(to_offset(tdap_config.get('period', 'H')))
+    if method == 'window':
+        return periods.clip(lower=1) * concept_count
+    if method != 'precount':
+        raise ValueError(f"Unknown schedule method {method}")
+
+    concepts = tdap_omop_batch.get_batchable_concepts(tdap_config)
+    count_df_list = []
+    for chunk_df in tdap_omop_batch.chunk_windows(process_df, chunk_size):
+        with engine.connect() as conn:
+            window_table_name = tdap_omop_batch.stage_windows(conn, chunk_df, logger_name)
+            for concept_key, concept in concepts.items():
+                props = concept.get('conceptproperties')
+                sql = build_count_sql(props.get('origintype'), tdap_omop_batch.originid_to_list(props.get('originid')), window_table_name)
+                count_df_list.append(pd.read_sql(text(sql), conn))
+    if len(count_df_list) > 0:
+        row_counts = pd.concat(count_df_list).groupby('window_id')['row_count'].sum()
+    else:
+        row_counts = pd.Series(dtype=float)
+    logger.info(f"Pre-counted {int(row_counts.sum())} source rows over {process_df.shape[0]} windows")
+    # every window pays for its periods even with no rows, so empty windows still order by length
+    return process_df['window_id'].map(row_counts).fillna(0) + periods.clip(lower=1)
+
+
+def order_by_cost(process_df, tdap_config, logger_name, method='window', engine=None, chunk_size=500):
+    """
+    Returns process_df sorted most expensive first, with the estimate in a cost column.  precount on a dialect that
+    can't stage windows returns process_df as it is.
+    """
+    logger = logging.getLogger(logger_name)
+    if method == 'precount' and engine.dialect.name not in tdap_omop_batch.STAGING_DIALECTS:
+        logger.warning(f"precount scheduling can't stage windows on {engine.dialect.name}, keeping population order")
+        return process_df
+    process_df = process_df.copy()
+    process_df['cost'] = estimate_window_costs(process_df, tdap_config, logger_name, method=method, engine=engine, chunk_size=chunk_size)
+    process_df = process_df.sort_values('cost', ascending=False, kind='mergesort')
+    if process_df.shape[0] > 0:
+        logger.info(f"Scheduling {process_df.shape[0]} windows longest-first by {method} cost, "
+                    f"max {process_df['cost'].max():,.0f}, median {process_df['cost'].median():,.0f}")
+    return process_df
+
+
+##########################
+# utilization
+##########################
+def stamp_worker_stats(ret, start_time):
+    """
+    Attaches the worker pid and task start/end times to a result (or failure record) dict
+    """
+    if isinstance(ret, dict):
+        ret['worker_stats'] = {'pid': os.getpid(), 'start': start_time, 'end': time()}
+    return ret
+
+
+class WorkerUtilization:
+    """
+    Collects worker_stats from results as they stream past and summarizes busy time per worker
+    """
+    def __init__(self, logger_name):
+        self.logger_name = logger_name
+        self.stats_list = []
+        self.start_time = time()
+
+    def track(self, ret_dict_iter):
+        for ret in ret_dict_iter:
+            if isinstance(ret, dict) and ret.get('worker_stats') is not None:
+                self.stats_list.append(ret['worker_stats'])
+            yield ret
+
+    def summary_df(self):
+        if len(self.stats_list) == 0:
+            return pd.DataFrame(columns=['pid', 'tasks', 'busy_seconds', 'first_start', 'last_end', 'utilization'])
+        stats_df = pd.DataFrame(self.stats_list)
+        stats_df['seconds'] = stats_df['end'] - stats_df['start']
+        summary_df = stats_df.groupby('pid').agg(tasks=('seconds', 'size'), busy_seconds=('seconds', 'sum'),
+                                                 first_start=('start', 'min'), last_end=('end', 'max')).reset_index()
+        wall_seconds = max(stats_df['end'].max() - self.start_time, 1e-9)
+        summary_df['utilization'] = summary_df['busy_seconds'] / wall_seconds
+        return summary_df
+
+    def log_summary(self):
+        logger = logging.getLogger(self.logger_name)
+        summary_df = self.summary_df()
+        if summary_df.shape[0] == 0:
+            return
+        last_end = summary_df['last_end'].max()
+        for row in summary_df.itertuples(index=False):
+            logger.info(f"Worker {row.pid}: {row.tasks} patients, busy {row.busy_seconds:,.1f}s, "
+                        f"utilization {row.utilization:.0%}, idle for the last {last_end - row.last_end:,.1f}s")
+        logger.info(f"Mean worker utilization {summary_df['utilization'].mean():.0%} across {summary_df.shape[0]} workers")
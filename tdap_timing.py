@@ -0,0 +1,233 @@
+"""
+Date: 2026-10-18
+Purpose: Per-stage timing for TDAP runs.  Every patient's run_omop call is timed, and the extend/cleanup/derive
+functions of every configured extension, cleanup and derivation module are wrapped so each one is timed per patient.
+Executor side stages (matrix writes) are timed once per run.  Timings travel back from the
+workers on each result under 'stage_timings', are aggregated by TimingReport and summarized at the end of the run, with
+an optional JSON/CSV dump and opt-in cProfile output for chosen stages.
+
+Configured with the timing stanza of a tdap config:
+
+    "timing": {
+        "enabled": True,
+        "dump_dir": "log",
+        "profile_stages": ["derivation:pcd_gates"],
+        "profile_dir": "log/profiles"
+    }
+
+Stage names are run_omop, extension:<key>, cleanup:<key>, derivation:<key> and write.
+"""
+# imports
+import cProfile
+import importlib
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from pathlib import Path
+from time import perf_counter
+import pandas as pd
+
+# module function called by the tapestry package for each configurable section
+SECTION_FUNCS = {'extensions': ('extension', 'extend'), 'cleanups': ('cleanup', 'cleanup'), 'derivations': ('derivation', 'derive')}
+
+# per process state.  A worker runs one patient at a time, but the module DAG can run that patient's modules on
+# threads, so everything they touch is updated under _lock
+_lock = threading.Lock()
+_state = {'in_patient': False, 'patient': {}, 'run': {}, 'profile_stages': set(), 'profile_dir': None, 'profilers': {},
+          'profiling': False, 'instrumented': set()}
+# set on the thread whose stage holds the process profiler
+_profiling = threading.local()
+
+
+def _record(stage, seconds):
+    with _lock:
+        scope = 'patient' if _state['in_patient'] else 'run'
+        calls, total = _state[scope].get(stage, (0, 0.0))
+        _state[scope][stage] = (calls + 1, total + seconds)
+
+
+@contextmanager
+def stage(name):
+    """
+    Times the enclosed block as stage name.  Inside a patient (call_timed) it counts towards that patient, anywhere
+    else towards the run.
+    """
+    profiler = None
+    # only one profiler can be active per process.  A profiled stage nested in another on the same thread is covered by
+    # the outer one, and one starting on another thread while a profile runs is timed but not profiled.
+    if name in _state['profile_stages'] and not getattr(_profiling, 'active', False):
+        with _lock:
+            if not _state['profiling']:
+                _state['profiling'] = True
+                profiler = _state['profilers'].setdefault(name, cProfile.Profile())
+    start = perf_counter()
+    if profiler is not None:
+        _profiling.active = True
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            _profiling.active = False
+            # cumulative across calls, one file per stage per process
+            profiler.dump_stats(str(Path(_state['profile_dir']) / f"{name.replace(':', '_')}_{os.getpid()}.prof"))
+            with _lock:
+                _state['profiling'] = False
+        _record(name, perf_counter() - start)
+
+
+def timed(name, func):
+    """
+    Wraps func so every call is timed as stage name
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with stage(name):
+            return func(*args, **kwargs)
+    wrapper._tdap_timed = True
+    return wrapper
+
+
+def configure(tdap_config):
+    """
+    Sets up profiling and wraps the configured module functions in this process.  Call once per process, the
+    executor calls it for the main process and tdap_workers.init_worker for each worker.
+    """
+    timing_config = tdap_config.get('timing', {})
+    if not timing_config.get('enabled', False):
+        return
+    _state['profile_stages'] = set(timing_config.get('profile_stages', []))
+    if len(_state['profile_stages']) > 0:
+        _state['profile_dir'] = timing_config.get('profile_dir', 'log/profiles')
+        Path(_state['profile_dir']).mkdir(parents=True, exist_ok=True)
+    instrument_modules(tdap_config)
+
+
+def instrument_modules(tdap_config):
+    """
+    Replaces extend/cleanup/derive on every included module with a timed wrapper.  This only takes effect if the
+    caller looks the function up on the module at call time.  The module DAG does; the tapestry package is not
+    guaranteed to, so TimingReport warns about instrumented stages that never show up in the results.
+    """
+    for section, (stage_prefix, func_name) in SECTION_FUNCS.items():
+        for key, v in tdap_config.get(section, {}).items():
+            if not v.get('include', False):
+                continue
+            try:
+                module = importlib.import_module(v.get('module'))
+            except ImportError:
+                # the tapestry package reports missing modules itself
+                continue
+            func = getattr(module, func_name, None)
+            if func is None or getattr(func, '_tdap_timed', False):
+                continue
+            setattr(module, func_name, timed(f"{stage_prefix}:{key}", func))
+            _state['instrumented'].add(f"{stage_prefix}:{key}")
+
+
+def call_timed(func, *args, **kwargs):
+    """
+    Runs one patient, timing it as run_omop along with every stage inside it.
+    The patient's timings are attached to the result as stage_timings {stage: (calls, seconds)}.
+    """
+    with _lock:
+        _state['in_patient'] = True
+        _state['patient'] = {}
+    try:
+        with stage('run_omop'):
+            ret = func(*args, **kwargs)
+    finally:
+        with _lock:
+            _state['in_patient'] = False
+    if isinstance(ret, dict):
+        with _lock:
+            ret['stage_timings'] = dict(_state['patient'])
+    return ret
+
+
+def run_timings():
+    with _lock:
+        return dict(_state['run'])
+
+
+def instrumented_stages():
+    return set(_state['instrumented'])
+
+
+def _result_person_id(ret):
+    if 'failure' in ret:
+        return ret['failure']['person_id']
+    matrix_df = ret.get('matrix_df')
+    if matrix_df is not None and 'person_id' in matrix_df.columns and matrix_df.shape[0] > 0:
+        return matrix_df['person_id'].iloc[0]
+    return None
+
+
+class TimingReport:
+    """
+    Collects stage_timings from results as they stream past and summarizes them per stage
+    """
+    def __init__(self, tdap_config, logger_name):
+        self.timing_config = tdap_config.get('timing', {})
+        self.logger_name = logger_name
+        self.record_list = []
+
+    def enabled(self):
+        return self.timing_config.get('enabled', False)
+
+    def track(self, ret_dict_iter):
+        for ret in ret_dict_iter:
+            if isinstance(ret, dict) and ret.get('stage_timings') is not None:
+                person_id = _result_person_id(ret)
+                for stage_name, (calls, seconds) in ret['stage_timings'].items():
+                    self.record_list.append({'person_id': person_id, 'scope': 'patient', 'stage': stage_name,
+                                             'calls': calls, 'seconds': seconds})
+            yield ret
+
+    def summary_df(self):
+        """
+        One row per stage: calls, total seconds, per patient mean and p95, and share of total run_omop time
+        """
+        record_df = pd.DataFrame(self.record_list + [{'person_id': None, 'scope': 'run', 'stage': k, 'calls': c, 'seconds': s}
+                                                     for k, (c, s) in run_timings().items()])
+        if record_df.shape[0] == 0:
+            return record_df
+        summary_df = (record_df.groupby(['scope', 'stage'])
+                               .agg(calls=('calls', 'sum'), total_s=('seconds', 'sum'), patients=('seconds', 'size'),
+                                    mean_ms=('seconds', 'mean'), p95_ms=('seconds', lambda x: x.quantile(0.95)))
+                               .reset_index())
+        summary_df[['mean_ms', 'p95_ms']] = summary_df[['mean_ms', 'p95_ms']] * 1000
+        patient_total = summary_df.loc[summary_df['stage'] == 'run_omop', 'total_s'].sum()
+        summary_df['pct_of_run_omop'] = (100 * summary_df['total_s'] / patient_total) if patient_total > 0 else None
+        summary_df.loc[summary_df['scope'] == 'run', ['patients', 'mean_ms', 'p95_ms', 'pct_of_run_omop']] = None
+        return summary_df.sort_values(['scope', 'total_s'], ascending=[True, False]).reset_index(drop=True)
+
+    def report(self):
+        """
+        Logs the summary table and writes the JSON/CSV dump when dump_dir is configured
+        """
+        logger = logging.getLogger(self.logger_name)
+        if not self.enabled():
+            return
+        summary_df = self.summary_df()
+        if summary_df.shape[0] == 0:
+            return
+        logger.info("Stage timing summary\n" + summary_df.to_string(index=False, float_format=lambda x: f"{x:,.1f}"))
+        missing_stages = sorted(instrumented_stages() - set(summary_df['stage']))
+        if len(missing_stages) > 0 and (summary_df['stage'] == 'run_omop').any():
+            logger.warning(f"Stages {', '.join(missing_stages)} were instrumented but never timed.  Either they did not "
+                           f"run or their caller holds its own reference to the function; their time is inside run_omop")
+        dump_dir = self.timing_config.get('dump_dir')
+        if dump_dir is not None:
+            Path(dump_dir).mkdir(parents=True, exist_ok=True)
+            file_stem = Path(dump_dir) / f"tdap_timing_{datetime.today().strftime('%Y-%m-%dT%H:%M:%S')}"
+            summary_df.to_csv(str(file_stem) + '.csv', index=False)
+            with open(str(file_stem) + '.json', 'w') as f:
+                json.dump({'summary': summary_df.astype(object).where(summary_df.notna(), None).to_dict(orient='records'),
+                           'patients': self.record_list}, f, indent=2, default=str)
+            logger.info(f"Stage timings written to {file_stem}.csv and .json")
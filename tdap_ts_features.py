@@ -0,0 +1,241 @@
+"""
+Date: 2026-10-18
+Purpose: Vectorized time series features from ts_features_config - smoothing, peaks and change points - computed over a
+stacked multi patient frame rather than one patient and one column at a time.
+
+    smoothing       <col><smooth_suffix>  window_type/window_len kernel convolution, nulls taken as fill_val.  Each
+                                          patient's series is edge padded, so values never mix across patients, and the
+                                          whole column is convolved in one np.convolve call.  Kernels are cached.
+    peaks           <col><peak_suffix>    True where the smoothed series is a relative maximum over peak_order periods
+                                          either side (scipy argrelextrema, clipped at each patient's ends), found in
+                                          one argrelextrema call per column.
+    change points   <col><cp_suffix>      True on the first period of each new segment found by ruptures on the
+                                          filled series, cp_model / cp_min_size / cp_jump / cp_pen, one patient
+                                          and column at a time.  This is the expensive step.
+
+The settings are those of the ts_features_config stanza the tapestry package reads, plus cp_method, cp_long_len,
+cp_long_jump and columns.  The pipeline does not run this engine on its own: pass the settings to add_ts_features, or
+list the module as a derivation ("module": "tdap_ts_features") with them in the derivation's config:
+
+    "config": {
+        "window_len": 4,
+        "window_type": "blackman",
+        "fill_val": 0,
+        "group_level": 0,            # index level patients are grouped on when no key column is given
+        "peak_order": 2,
+        "peak_suffix": "_peak",
+        "cp_model": "l2",
+        "cp_min_size": 2,
+        "cp_jump": 1,
+        "cp_pen": 10,
+        "cp_suffix": "_cp",
+        "cp_method": "pelt",         # "pelt", "binseg", or "auto" - pelt, on a coarser cp_long_jump grid for long series
+        "cp_long_len": 2000,
+        "cp_long_jump": 24,
+        "smooth_suffix": "_smooth",
+        "columns": None              # columns to featurize, as a derivation required_cols is used without it
+    }
+
+Pelt with jump 1 considers every period as a change point and grows roughly quadratically with series length, a multi
+year hourly series is tens of thousands of points.  cp_method auto keeps jump 1 for series shorter than cp_long_len and
+only considers every cp_long_jump'th period on longer ones (daily resolution on an hourly grid), one to two orders of
+magnitude faster.  binseg uses binary segmentation, approximate, and cheaper than Pelt when there are few changes.
+Both can place change points differently from pelt, so they are opt in; the default is pelt with cp_jump.
+
+tests/test_ts_features.py checks the engine against a per patient, per column reference, and
+benchmarks/bench_ts_features.py times both.
+"""
+# imports
+import functools
+import logging
+import numpy as np
+import pandas as pd
+import ruptures as rpt
+from scipy.signal import argrelextrema, get_window
+from sqlalchemy import types
+
+# sibling imports
+from tdap_fill import NO_FILL_SUFFIXES
+
+CP_METHODS = ('pelt', 'binseg', 'auto')
+
+
+def get_ts_features_config(tdap_config):
+    return tdap_config.get('ts_features_config', {})
+
+
+@functools.lru_cache(maxsize=32)
+def get_kernel(window_type, window_len):
+    """
+    Normalized smoothing kernel, built once per (window_type, window_len)
+    """
+    kernel = get_window(window_type, window_len, fftbins=False)
+    kernel = kernel / kernel.sum()
+    kernel.setflags(write=False)
+    return kernel
+
+
+def get_feature_columns(matrix_df, tdap_config):
+    """
+    Columns to featurize: ts_features_config.columns, else every numeric column of a numeric concept
+    """
+    col_list = get_ts_features_config(tdap_config).get('columns')
+    if col_list is not None:
+        return [c for c in col_list if c in matrix_df.columns]
+    concepts = tdap_config.get('concepts', {})
+    concept_keys = sorted(concepts.keys(), key=len, reverse=True)
+    feature_list = []
+    for c in matrix_df.columns:
+        if c.endswith(NO_FILL_SUFFIXES) or not pd.api.types.is_numeric_dtype(matrix_df[c]) or pd.api.types.is_bool_dtype(matrix_df[c]):
+            continue
+        concept_key = next((k for k in concept_keys if c.startswith(k + '_')), None)
+        if concept_key is not None and concepts[concept_key].get('conceptproperties', {}).get('origindatatype') == 'numeric':
+            feature_list.append(c)
+    return feature_list
+
+
+def _group_bounds(keys):
+    """
+    (starts, lengths) of each run of equal keys in an array already grouped by key
+    """
+    is_start = np.ones(len(keys), dtype=bool)
+    is_start[1:] = keys[1:] != keys[:-1]
+    starts = np.flatnonzero(is_start)
+    lengths = np.diff(np.append(starts, len(keys)))
+    return starts, lengths
+
+
+def _edge_padded_index(starts, lengths, pad_left, pad_right):
+    """
+    Positions into the stacked array that lay every group out edge padded: pad_left copies of its first value, the
+    group, then pad_right copies of its last.  Returns (index, offsets) where offsets[g] is where group g's padded
+    run begins.
+    """
+    padded_lengths = lengths + pad_left + pad_right
+    offsets = np.cumsum(padded_lengths) - padded_lengths
+    within = np.arange(padded_lengths.sum()) - np.repeat(offsets, padded_lengths) - pad_left
+    within = np.clip(within, 0, np.repeat(lengths - 1, padded_lengths))
+    return np.repeat(starts, padded_lengths) + within, offsets
+
+
+def smooth_stacked(values, starts, lengths, window_len, window_type='blackman'):
+    """
+    Smooths each group of a stacked 1d array (nulls already filled) with one convolution.  Each group is edge padded
+    by half a window either side, so a valid convolution over the whole padded array gives every group's own result.
+    """
+    if window_len < 2 or len(values) == 0:
+        return values.astype(float)
+    kernel = get_kernel(window_type, window_len)
+    pad_left = (window_len - 1) // 2
+    pad_right = window_len - 1 - pad_left
+    index, offsets = _edge_padded_index(starts, lengths, pad_left, pad_right)
+    convolved = np.convolve(values[index], kernel[::-1], mode='valid')
+    # the valid output for position i of group g sits at offsets[g] + i
+    out_pos = np.repeat(offsets, lengths) + np.arange(lengths.sum()) - np.repeat(starts, lengths)
+    return convolved[out_pos]
+
+
+def peaks_stacked(smoothed, starts, lengths, peak_order):
+    """
+    Boolean relative maxima of each group, equivalent to argrelextrema(group, np.greater, order=peak_order,
+    mode='clip') per group.  Edge padding by peak_order repeats the clipped comparisons and keeps groups apart.
+    """
+    peaks = np.zeros(len(smoothed), dtype=bool)
+    if len(smoothed) == 0:
+        return peaks
+    index, offsets = _edge_padded_index(starts, lengths, peak_order, peak_order)
+    padded_pos = argrelextrema(smoothed[index], np.greater, order=peak_order, mode='clip')[0]
+    # back from padded positions to positions in the stacked array, dropping hits on the padding
+    group = np.searchsorted(offsets, padded_pos, side='right') - 1
+    within = padded_pos - offsets[group] - peak_order
+    keep = (within >= 0) & (within < lengths[group])
+    peaks[starts[group[keep]] + within[keep]] = True
+    return peaks
+
+
+def change_points(signal, cp_model='l2', cp_min_size=2, cp_jump=1, cp_pen=10, cp_method='pelt', cp_long_len=2000,
+                  cp_long_jump=24):
+    """
+    Start positions of the segments after the first, from ruptures Pelt or Binseg
+    """
+    if len(signal) < 2 * cp_min_size or np.all(signal == signal[0]):
+        # too short to split, or nothing to detect
+        return np.array([], dtype=int)
+    if cp_method == 'auto' and len(signal) >= cp_long_len:
+        cp_jump = max(cp_jump, cp_long_jump)
+    algo_class = rpt.Binseg if cp_method == 'binseg' else rpt.Pelt
+    breakpoints = algo_class(model=cp_model, min_size=cp_min_size, jump=cp_jump).fit(signal).predict(pen=cp_pen)
+    # predict ends with the series length, which is not a change
+    return np.array(breakpoints[:-1], dtype=int)
+
+
+def column_change_points(values, starts, lengths, cp_kwargs):
+    """
+    Change point flags for one stacked column, each group on its own
+    """
+    flags = np.zeros(len(values), dtype=bool)
+    for start, length in zip(starts, lengths):
+        flags[start + change_points(values[start:start + length], **cp_kwargs)] = True
+    return flags
+
+
+def get_cp_kwargs(ts_config):
+    cp_method = ts_config.get('cp_method', 'pelt')
+    if cp_method not in CP_METHODS:
+        raise ValueError(f"Unknown ts_features_config cp_method {cp_method}")
+    return {'cp_model': ts_config.get('cp_model', 'l2'), 'cp_min_size': ts_config.get('cp_min_size', 2),
+            'cp_jump': ts_config.get('cp_jump', 1), 'cp_pen': ts_config.get('cp_pen', 10), 'cp_method': cp_method,
+            'cp_long_len': ts_config.get('cp_long_len', 2000), 'cp_long_jump': ts_config.get('cp_long_jump', 24)}
+
+
+def add_ts_features(matrix_df, ts_config, col_list, output_metadata=None, key_col=None, time_col='key_time'):
+    """
+    Adds smoothed, peak and change point columns for col_list.  Pass key_col to featurize a stacked multi patient
+    frame, it is returned sorted by key_col, time_col.  Without key_col, a MultiIndex is grouped on
+    ts_config.group_level and anything else is one series in row order.
+    Returns (matrix_df, output_metadata).
+    """
+    output_metadata = {} if output_metadata is None else output_metadata
+    if key_col is not None:
+        matrix_df = matrix_df.sort_values([key_col, time_col], kind='mergesort').reset_index(drop=True)
+        keys = matrix_df[key_col].to_numpy()
+    elif isinstance(matrix_df.index, pd.MultiIndex):
+        keys = matrix_df.index.get_level_values(ts_config.get('group_level', 0)).to_numpy()
+    else:
+        keys = np.zeros(matrix_df.shape[0], dtype=int)
+    starts, lengths = _group_bounds(keys)
+    smooth_suffix = ts_config.get('smooth_suffix', '_smooth')
+    peak_suffix = ts_config.get('peak_suffix', '_peak')
+    cp_suffix = ts_config.get('cp_suffix', '_cp')
+
+    cp_kwargs = get_cp_kwargs(ts_config)
+    feature_dict = {}
+    for c in col_list:
+        values = pd.to_numeric(matrix_df[c], errors='coerce').astype(float).fillna(ts_config.get('fill_val', 0)).to_numpy()
+        smoothed = smooth_stacked(values, starts, lengths, ts_config.get('window_len', 4), ts_config.get('window_type', 'blackman'))
+        feature_dict[c + smooth_suffix] = smoothed
+        feature_dict[c + peak_suffix] = peaks_stacked(smoothed, starts, lengths, ts_config.get('peak_order', 2))
+        feature_dict[c + cp_suffix] = column_change_points(values, starts, lengths, cp_kwargs)
+
+    # added in one concat rather than column by column
+    feature_df = pd.DataFrame(feature_dict, index=matrix_df.index)
+    matrix_df = pd.concat([matrix_df.drop(columns=[c for c in feature_df.columns if c in matrix_df.columns]), feature_df], axis=1)
+    for c in col_list:
+        output_metadata[c + smooth_suffix] = types.Float()
+        output_metadata[c + peak_suffix] = types.Boolean()
+        output_metadata[c + cp_suffix] = types.Boolean()
+    return matrix_df, output_metadata
+
+
+def derive(df, pat_profile_dict, output_metadata, config, logger_name, add_phase_func=None):
+    """
+    Derivation module interface, so the engine can be listed under derivations with "module": "tdap_ts_features".
+    The module config holds the ts_features_config settings, and its columns (else required_cols) the columns to
+    featurize.
+    """
+    logger = logging.getLogger(logger_name)
+    col_list = [c for c in config.get('columns') or config.get('required_cols') or [] if c in df.columns]
+    if len(col_list) == 0:
+        logger.debug("No columns to compute time series features for")
+        return df, output_metadata
+    return add_ts_features(df, config, col_list, output_metadata)
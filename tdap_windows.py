@@ -0,0 +1,167 @@
+"""
+Date: 2026-10-18
+Purpose: Window coalescing.  get_pop returns one row per qualifying event and each becomes its own window, so a patient
+with dozens of events in a week gets dozens of heavily overlapping windows, each extracting and building the same
+matrix again.  Before dispatch, each person's overlapping windows - and windows starting within merge_gap_hours of the
+end of the one before - are merged into one window spanning them, and exact duplicates collapse.  Each merged window
+keeps the windows it replaced in source_windows.  A merge stops before it would span more than max_window_days, and the
+next window starts a new merge, so a patient with events every few days for years does not become one window (and one
+matrix) covering all of them.  A single window longer than max_window_days is kept as it is, along with any window
+inside it.
+
+Optionally the results are fanned back out: each merged matrix is sliced to every original window it covers, the
+slices tagged with window_start_time, so the output still holds one matrix per original window.  Slices are cut from
+the merged build, so a value carried forward from before an original window's start is present in its slice, where a
+separate build of that window would have started empty.
+
+Configured with the window_coalesce stanza of a tdap config:
+
+    "window_coalesce": {
+        "enabled": True,
+        "merge_gap_hours": 0,
+        "max_window_days": 30,      # None merges without a limit
+        "fan_out": False
+    }
+"""
+# imports
+import logging
+import numpy as np
+import pandas as pd
+from sqlalchemy import DateTime
+
+SOURCE_WINDOWS_COL = 'source_windows'
+WINDOW_START_COL = 'window_start_time'
+
+
+def get_window_coalesce_config(tdap_config):
+    return tdap_config.get('window_coalesce', {})
+
+
+def fan_out_enabled(tdap_config):
+    coalesce_config = get_window_coalesce_config(tdap_config)
+    return coalesce_config.get('enabled', False) and coalesce_config.get('fan_out', False)
+
+
+def _capped_merge_ids(df, merge_gap, max_window):
+    """
+    Merge id per row of df (sorted by person_id, start_time, end_time), starting a new merge when a window does not
+    overlap the current one or would stretch it past max_window.  A window inside the current one never splits it, even
+    when a single window already runs past max_window.  Returns the ids and the number of cap splits.
+    """
+    person_ids = df['person_id'].to_numpy()
+    starts = df['start_time'].to_numpy().astype('datetime64[ns]').astype(np.int64)
+    ends = df['end_time'].to_numpy().astype('datetime64[ns]').astype(np.int64)
+    merge_gap, max_window = merge_gap.value, max_window.value
+    merge_ids = np.empty(len(df), dtype=np.int64)
+    merge_id, split_count = -1, 0
+    cur_start = cur_end = 0
+    for i in range(len(df)):
+        if i == 0 or person_ids[i] != person_ids[i-1] or starts[i] > cur_end + merge_gap:
+            merge_id += 1
+            cur_start, cur_end = starts[i], ends[i]
+        elif ends[i] > cur_end and ends[i] - cur_start > max_window:
+            merge_id += 1
+            split_count += 1
+            cur_start, cur_end = starts[i], ends[i]
+        else:
+            cur_end = max(cur_end, ends[i])
+        merge_ids[i] = merge_id
+    return pd.Series(merge_ids, index=df.index), split_count
+
+
+def coalesce_windows(window_df, merge_gap_hours=0, max_window_days=None, logger_name=None):
+    """
+    Merges each person's overlapping or nearly adjacent (start, end) windows, no merged window spanning more than
+    max_window_days (None for no limit).  Returns one row per merged window with person_id, start_time, end_time and
+    source_windows, the list of (start_time, end_time) windows it replaced.
+    Columns other than those are taken from the first window of each merge.
+    """
+    df = window_df.sort_values(['person_id', 'start_time', 'end_time'], kind='mergesort').reset_index(drop=True)
+    split_count = 0
+    if max_window_days is None:
+        # latest end of any earlier window of the same person
+        prev_end = df.groupby('person_id')['end_time'].cummax().groupby(df['person_id']).shift()
+        new_window = prev_end.isna() | (df['start_time'] > prev_end + pd.Timedelta(hours=merge_gap_hours))
+        merge_id = new_window.cumsum()
+    else:
+        # where a merge stops depends on where the last one started, so this walks the windows in order
+        merge_id, split_count = _capped_merge_ids(df, pd.Timedelta(hours=merge_gap_hours), pd.Timedelta(days=max_window_days))
+    df[SOURCE_WINDOWS_COL] = list(zip(df['start_time'], df['end_time']))
+    group = df.groupby(merge_id, sort=False)
+    merged_df = group.first()
+    merged_df['start_time'] = group['start_time'].min()
+    merged_df['end_time'] = group['end_time'].max()
+    # identical windows are one window
+    merged_df[SOURCE_WINDOWS_COL] = group[SOURCE_WINDOWS_COL].agg(lambda s: sorted(set(s)))
+    merged_df = merged_df.reset_index(drop=True)
+    if logger_name is not None:
+        logger = logging.getLogger(logger_name)
+        window_hours = ((window_df['end_time'] - window_df['start_time']).sum() / pd.Timedelta(hours=1))
+        merged_hours = ((merged_df['end_time'] - merged_df['start_time']).sum() / pd.Timedelta(hours=1))
+        logger.info(f"Coalesced {window_df.shape[0]} windows into {merged_df.shape[0]}, "
+                    f"{window_hours:,.0f} window hours into {merged_hours:,.0f}"
+                    + (f", {split_count} merges split at {max_window_days} days" if split_count > 0 else ""))
+    return merged_df
+
+
+def get_source_windows(process_df):
+    """
+    person_id -> list of (start_time, end_time, source_windows), one per merged window of the person in process_df
+    """
+    source_dict = {}
+    for person_id, start_time, end_time, source_windows in zip(process_df['person_id'], process_df['start_time'],
+                                                               process_df['end_time'], process_df[SOURCE_WINDOWS_COL]):
+        source_dict.setdefault(person_id, []).append((start_time, end_time, source_windows))
+    return source_dict
+
+
+def match_source_windows(merged_list, matrix_df, period, time_col='key_time'):
+    """
+    Source windows of the merged window matrix_df was built for.  Merged windows split at max_window_days can overlap,
+    so the match is the merged window whose grid start and end are closest to the matrix's first and last times.
+    """
+    if len(merged_list) == 0:
+        return []
+    times = pd.to_datetime(matrix_df[time_col])
+    first_time, last_time = times.min(), times.max()
+    return min(merged_list, key=lambda m: (abs(pd.Timestamp(m[0]).to_period(period).start_time - first_time),
+                                           abs(pd.Timestamp(m[1]) - last_time)))[2]
+
+
+def fan_out_matrix(matrix_df, source_windows, period, time_col='key_time'):
+    """
+    One slice of matrix_df per source window starting inside it, each tagged with the window's start in
+    window_start_time.  Source windows starting outside this matrix are skipped.
+    """
+    times = pd.to_datetime(matrix_df[time_col])
+    first_time, last_time = times.min(), times.max()
+    slice_list = []
+    for start_time, end_time in source_windows:
+        if start_time < first_time or start_time > last_time:
+            continue
+        # the matrix grid starts at the start of the period the window starts in
+        grid_start = pd.Timestamp(start_time).to_period(period).start_time
+        one_df = matrix_df.loc[(times >= grid_start) & (times <= end_time)].copy()
+        one_df[WINDOW_START_COL] = pd.Timestamp(start_time)
+        slice_list.append(one_df)
+    if len(slice_list) == 0:
+        return matrix_df.iloc[0:0].assign(**{WINDOW_START_COL: pd.NaT})
+    return pd.concat(slice_list, ignore_index=True)
+
+
+def fan_out_results(ret_dict_iter, process_df, tdap_config, time_col='key_time'):
+    """
+    Yields every result with its matrix fanned out to the original windows it covers.  Failure records pass through.
+    """
+    source_dict = get_source_windows(process_df)
+    period = tdap_config.get('period', 'H')
+    for ret in ret_dict_iter:
+        matrix_df = ret.get('matrix_df') if isinstance(ret, dict) else None
+        if matrix_df is None or matrix_df.shape[0] == 0:
+            yield ret
+            continue
+        source_windows = match_source_windows(source_dict.get(matrix_df['person_id'].iloc[0], []), matrix_df, period,
+                                              time_col=time_col)
+        ret['matrix_df'] = fan_out_matrix(matrix_df, source_windows, period, time_col=time_col)
+        ret['output_metadata'] = {**ret['output_metadata'], WINDOW_START_COL: DateTime()}
+        yield ret
@@ -0,0 +1,177 @@
+"""
+Date: 2026-10-18
+Purpose: Persistent process pool for run_omop.  Each worker receives the tdap_config once through the pool initializer,
+keeps one pooled engine per configured database, and is then sent only a small per-patient payload:
+
+    (person_id, start_time_str, end_time_str, visit_occurrence_id_list, id_type)
+
+Every patient runs through call_with_retry, so one bad patient cannot abort the map.  Transient database errors are
+retried with exponential backoff, and anything that still fails comes back as a failure record instead of raising:
+
+    {'failure': {'person_id', 'start_time_str', 'end_time_str', 'error_type', 'error', 'traceback', 'attempts', 'transient'}}
+"""
+# imports
+import json
+import logging
+import logging.config
+import random
+import traceback
+from multiprocessing import Pool
+from multiprocessing.util import Finalize
+from time import sleep, time
+from sqlalchemy import exc as sa_exc
+
+# ripy
+from ucdripydbutils import ucdripydbutils
+
+# TDAP imports
+from tapestry.tapestry import run_omop
+
+# sibling imports
+from tdap_schedule import stamp_worker_stats
+import tdap_timing
+import tdap_module_dag
+import tdap_dtypes
+import tdap_concept_cache
+
+# per process state, populated by init_worker
+_worker_state = {}
+
+
+def _connect_dict_key(connect_dict):
+    return json.dumps(connect_dict, sort_keys=True, default=str)
+
+
+def _keep_pool(*args, **kwargs):
+    """
+    dispose for the engine views handed out by _get_worker_engine.  The shared pool is disposed at worker exit.
+    """
+    return None
+
+
+def _get_worker_engine(connect_dict, *args, **kwargs):
+    """
+    Drop-in replacement for ucdripydbutils.get_engine_from_connect_dict inside a worker.
+
+    The worker keeps one real engine per connect dict, created on first use and disposed when the worker exits.
+    Callers get a view of it (Engine.execution_options()) sharing its connection pool.  They dispose engines after
+    each patient, so the view's dispose leaves the shared pool alone.
+    """
+    key = _connect_dict_key(connect_dict)
+    engine_dict = _worker_state['engine_dict']
+    if key not in engine_dict:
+        engine = _worker_state['get_engine_func'](connect_dict, *args, **kwargs)
+        engine_dict[key] = engine
+        Finalize(None, engine.dispose, exitpriority=10)
+    engine_view = engine_dict[key].execution_options()
+    engine_view.dispose = _keep_pool
+    return engine_view
+
+
+def init_worker(tdap_config, logger_name, metadata_memo=None):
+    """
+    Pool initializer - runs once per worker process.
+
+    Stores the config, configures logging, and creates one engine per database that carries connection secrets.
+    ucdripydbutils.get_engine_from_connect_dict is swapped for the cached version so every engine request made
+    inside this worker, including those made by the tapestry package, reuses the same connection pool.  run_omop
+    creates its engines itself and takes none as an argument, so the swap is the only way to reach them.  It only
+    happens in pool workers, never in the parent process.
+
+    tapestry's get_concept_metadata is memoized the same way when concept_cache is enabled, seeded with the parent's
+    metadata_memo so the worker starts with every result the parent already holds.
+    """
+    if tdap_config.get('logging_config') is not None:
+        logging.config.dictConfig(tdap_config.get('logging_config'))
+    _worker_state['tdap_config'] = tdap_config
+    _worker_state['logger_name'] = logger_name
+    tdap_timing.configure(tdap_config)
+    tdap_concept_cache.memoize_concept_metadata(tdap_config, logger_name, metadata_memo)
+    _worker_state['engine_dict'] = {}
+    _worker_state['get_engine_func'] = ucdripydbutils.get_engine_from_connect_dict
+    ucdripydbutils.get_engine_from_connect_dict = _get_worker_engine
+    for k, v in tdap_config.get('databases').items():
+        secret = v.get('secret')
+        if isinstance(secret, dict) and secret.get('dbtype') is not None:
+            _get_worker_engine(secret)
+
+
+def is_transient_error(e):
+    """
+    Errors worth retrying - dropped or invalidated connections, pool and network timeouts
+    """
+    if isinstance(e, sa_exc.DBAPIError) and e.connection_invalidated:
+        return True
+    return isinstance(e, (sa_exc.OperationalError, sa_exc.InterfaceError, sa_exc.TimeoutError, ConnectionError, TimeoutError))
+
+
+def is_failure(ret):
+    return isinstance(ret, dict) and 'failure' in ret
+
+
+def call_with_retry(func, args, logger_name, max_retries=3, backoff_seconds=2, max_backoff_seconds=60):
+    """
+    Runs func(*args) for one patient.  Transient errors are retried up to max_retries times, waiting backoff_seconds
+    and doubling each try (with jitter, capped at max_backoff_seconds).
+    Returns func's result, or a failure record once the patient has failed for good.
+    args starts with (person_id, start_time_str, end_time_str), which identify the patient in the record.
+    """
+    logger = logging.getLogger(logger_name)
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            return func(*args)
+        except Exception as e:
+            transient = is_transient_error(e)
+            if transient and attempt <= max_retries:
+                wait = min(backoff_seconds * 2 ** (attempt - 1), max_backoff_seconds) * random.uniform(0.5, 1.5)
+                logger.warning(f"Transient error for person {args[0]} on attempt {attempt}, retrying in {wait:.1f}s: {e}")
+                sleep(wait)
+                continue
+            logger.error(f"Person {args[0]} failed after {attempt} attempt(s): {type(e).__name__}: {e}")
+            return {'failure': {'person_id': args[0], 'start_time_str': args[1], 'end_time_str': args[2],
+                                'error_type': type(e).__name__, 'error': str(e), 'traceback': traceback.format_exc(),
+                                'attempts': attempt, 'transient': transient}}
+
+
+def get_retry_kwargs(tdap_config):
+    omop_config = tdap_config.get('databases').get('omop')
+    return {'max_retries': omop_config.get('max_retries', 3),
+            'backoff_seconds': omop_config.get('retry_backoff_seconds', 2),
+            'max_backoff_seconds': omop_config.get('retry_max_backoff_seconds', 60)}
+
+
+def record_failures(ret_dict_iter, failure_list):
+    """
+    Passes successful results through and appends the failure records to failure_list
+    """
+    for ret in ret_dict_iter:
+        if is_failure(ret):
+            failure_list.append(ret['failure'])
+        else:
+            yield ret
+
+
+def run_omop_task(payload):
+    """
+    Runs one patient in a worker from the small payload tuple.  The result carries worker_stats for utilization reporting.
+    """
+    start_time = time()
+    tdap_config = _worker_state['tdap_config']
+    # with module_dag enabled, extensions, cleanups and derivations run through the DAG after run_omop, and with a
+    # dtype plan the matrix is compact before it is pickled back
+    run_func = tdap_dtypes.get_run_func(tdap_config, tdap_module_dag.get_run_func(tdap_config, run_omop))
+    ret = tdap_timing.call_timed(call_with_retry, run_func, tuple(payload[:5]) + (tdap_config, _worker_state['logger_name'], 'omop'),
+                                 _worker_state['logger_name'], **get_retry_kwargs(tdap_config))
+    return stamp_worker_stats(ret, start_time)
+
+
+def get_worker_pool(tdap_config, logger_name, process_count):
+    """
+    Returns a Pool whose workers have been initialized with init_worker.  Shut it down with close() and join(), not
+    terminate() (or the with statement), so the workers run their exit hooks and dispose their engines.
+    The concept metadata memoized in this process is built once and handed to every worker.
+    """
+    return Pool(processes=process_count, initializer=init_worker,
+                initargs=(tdap_config, logger_name, tdap_concept_cache.get_metadata_memo()))
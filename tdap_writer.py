@@ -0,0 +1,216 @@
+"""
+Date: 2026-10-18
+Purpose: Bulk writer for TDAP matrices.  Matrices are accumulated into large batches and flushed with the fastest
+bulk path the destination dialect offers, instead of one DataFrame.to_sql append per patient.
+"""
+# imports
+import io
+import csv
+import logging
+from datetime import datetime
+import pandas as pd
+from sqlalchemy import inspect, text
+
+# sibling imports
+from tdap_dtypes import densify_matrix
+from tdap_timing import stage
+
+
+def df_to_rows(df):
+    """
+    Converts a dataframe into a list of plain python tuples for DBAPI executemany style calls.
+    Missing values become None and timestamps become datetime.datetime
+    """
+    obj_df = df.astype(object)
+    for c in df.select_dtypes(include=['datetime', 'datetimetz']).columns:
+        obj_df[c] = pd.Series(df[c].dt.to_pydatetime(), index=df.index, dtype=object)
+    return list(obj_df.where(pd.notna(df), None).itertuples(index=False, name=None))
+
+
+class TDAPMatrixWriter:
+    """
+    Accumulates matrix_df's and writes them to a destination table in batches.
+
+    output_metadata may start empty and grow as results arrive (stream mode).  The table is created on the first flush
+    and any column that shows up later is added with ALTER TABLE, so the final schema is the union of every
+    patient's output_metadata.
+
+    Bulk paths by dialect:
+        mssql - pyodbc executemany with fast_executemany enabled
+        postgresql - COPY FROM STDIN (psycopg 3 copy, or copy_expert on psycopg2)
+        oracle - cx_Oracle executemany array binds
+        anything else - DataFrame.to_sql with the driver's executemany (one compiled INSERT, rows bound in bulk)
+    """
+    def __init__(self, engine, table_name, output_metadata, logger_name, batch_size=50000):
+        self.engine = engine
+        self.table_name = table_name
+        self.output_metadata = dict(output_metadata) if output_metadata is not None else {}
+        self.logger_name = logger_name
+        self.batch_size = batch_size
+        self.table_created = False
+        self.buffer_list = []
+        self.buffer_rows = 0
+        self.rows_written = 0
+        self.write_seconds = 0.0
+
+    def create_table(self):
+        """
+        Creates (replaces) an empty destination table using output_metadata as the template
+        """
+        temp_matrix_df = pd.DataFrame(columns=self.output_metadata.keys())
+        temp_matrix_df.to_sql(self.table_name, self.engine, dtype=self.output_metadata, index=False, if_exists='replace')
+        self.table_created = True
+
+    def attach_existing(self):
+        """
+        Appends into the destination table as it stands instead of replacing it (incremental runs).
+        The existing columns seed output_metadata so only genuinely new columns are added.
+        Returns False when there is no table to attach to.
+        """
+        inspector = inspect(self.engine)
+        if not inspector.has_table(self.table_name):
+            return False
+        for c in inspector.get_columns(self.table_name):
+            self.output_metadata.setdefault(c['name'], c['type'])
+        self.table_created = True
+        return True
+
+    def merge_output_metadata(self, output_metadata):
+        """
+        Incrementally unions one result's output_metadata into the writer's schema.
+        New columns are added to the destination table if it already exists.
+        """
+        logger = logging.getLogger(self.logger_name)
+        new_cols = [k for k in output_metadata.keys() if k not in self.output_metadata]
+        if len(new_cols) == 0:
+            return
+        # anything buffered was shaped by the old schema, write it out before the schema changes
+        if self.table_created:
+            self.flush()
+        for c in new_cols:
+            self.output_metadata[c] = output_metadata[c]
+            if self.table_created:
+                self._add_column(c, output_metadata[c])
+        logger.debug(f"Added {len(new_cols)} columns to the {self.table_name} schema")
+
+    def write(self, matrix_df, output_metadata=None):
+        """
+        Adds one matrix to the buffer, flushing when the buffer reaches batch_size rows
+        """
+        if output_metadata is not None:
+            self.merge_output_metadata(output_metadata)
+        self.buffer_list.append(matrix_df)
+        self.buffer_rows += matrix_df.shape[0]
+        if self.buffer_rows >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes everything in the buffer using the dialect specific bulk path
+        """
+        logger = logging.getLogger(self.logger_name)
+        if not self.table_created and len(self.output_metadata) > 0:
+            self.create_table()
+        if self.buffer_rows == 0:
+            self.buffer_list = []
+            return
+        start_time = datetime.now()
+        # matrices may arrive in a compact (sparse/categorical) representation, bulk paths want plain columns
+        batch_df = pd.concat([densify_matrix(x.reindex(columns=list(self.output_metadata.keys())), output_metadata=self.output_metadata) for x in self.buffer_list],
+                             ignore_index=True)
+        self.buffer_list = []
+        self.buffer_rows = 0
+
+        dialect = self.engine.dialect.name
+        with stage('write'):
+            if dialect == 'mssql':
+                self._flush_executemany(batch_df, fast_executemany=True)
+            elif dialect == 'postgresql':
+                self._flush_copy(batch_df)
+            elif dialect == 'oracle':
+                self._flush_executemany(batch_df)
+            else:
+                # method=None binds the rows with executemany.  method='multi' compiles a multi VALUES statement per
+                # chunk and was over 10x slower on the bench_pipeline matrices
+                batch_df.to_sql(self.table_name, self.engine, dtype=self.output_metadata, index=False, if_exists='append',
+                                method=None, chunksize=self.batch_size)
+
+        seconds = (datetime.now() - start_time).total_seconds()
+        self.rows_written += batch_df.shape[0]
+        self.write_seconds += seconds
+        logger.debug(f"Flushed {batch_df.shape[0]} rows to {self.table_name} in {seconds:.2f}s")
+
+    def close(self):
+        """
+        Flushes any remaining rows and logs a throughput report
+        """
+        logger = logging.getLogger(self.logger_name)
+        self.flush()
+        rows_per_sec = self.rows_written / self.write_seconds if self.write_seconds > 0 else 0
+        logger.info(f"Wrote {self.rows_written} rows to {self.table_name} in {self.write_seconds:.2f}s ({rows_per_sec:,.0f} rows/s)")
+
+    ##########################
+    # dialect specific paths
+    ##########################
+    def _quoted(self):
+        preparer = self.engine.dialect.identifier_preparer
+        table_str = preparer.quote(self.table_name)
+        col_str = ", ".join([preparer.quote(c) for c in self.output_metadata.keys()])
+        return table_str, col_str
+
+    def _add_column(self, col_name, col_type):
+        preparer = self.engine.dialect.identifier_preparer
+        # output_metadata may hold a type class rather than an instance, e.g. types.DateTime
+        if isinstance(col_type, type):
+            col_type = col_type()
+        type_str = col_type.compile(dialect=self.engine.dialect)
+        dialect = self.engine.dialect.name
+        if dialect == 'mssql':
+            add_str = f"ADD {preparer.quote(col_name)} {type_str}"
+        elif dialect == 'oracle':
+            add_str = f"ADD ({preparer.quote(col_name)} {type_str})"
+        else:
+            add_str = f"ADD COLUMN {preparer.quote(col_name)} {type_str}"
+        with self.engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE {preparer.quote(self.table_name)} {add_str}"))
+
+    def _flush_executemany(self, batch_df, fast_executemany=False):
+        table_str, col_str = self._quoted()
+        if self.engine.dialect.name == 'oracle':
+            bind_str = ", ".join([f":{i+1}" for i in range(batch_df.shape[1])])
+        else:
+            bind_str = ", ".join(["?"] * batch_df.shape[1])
+        insert_sql = f"INSERT INTO {table_str} ({col_str}) VALUES ({bind_str})"
+        rows = df_to_rows(batch_df)
+        raw_conn = self.engine.raw_connection()
+        try:
+            cursor = raw_conn.cursor()
+            if fast_executemany:
+                cursor.fast_executemany = True
+            cursor.executemany(insert_sql, rows)
+            raw_conn.commit()
+            cursor.close()
+        finally:
+            raw_conn.close()
+
+    def _flush_copy(self, batch_df):
+        table_str, col_str = self._quoted()
+        copy_sql = f"COPY {table_str} ({col_str}) FROM STDIN"
+        raw_conn = self.engine.raw_connection()
+        try:
+            cursor = raw_conn.cursor()
+            if hasattr(cursor, 'copy'):
+                # psycopg 3 - write_row handles the text format escaping for us
+                with cursor.copy(copy_sql) as copy:
+                    for row in df_to_rows(batch_df):
+                        copy.write_row(row)
+            else:
+                # psycopg2
+                buf = io.StringIO()
+                batch_df.to_csv(buf, index=False, header=False, quoting=csv.QUOTE_MINIMAL)
+                buf.seek(0)
+                cursor.copy_expert(copy_sql + " WITH (FORMAT csv)", buf)
+            raw_conn.commit()
+            cursor.close()
+        finally:
+            raw_conn.close()
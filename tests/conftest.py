@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# repo root on the path so the top level tdap_* modules import
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
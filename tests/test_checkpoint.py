@@ -0,0 +1,84 @@
+"""
+tdap_checkpoint spill directory, completed.txt, atomic writes and resume, on a local spill directory
+"""
+import json
+
+import pandas as pd
+import pytest
+
+from tdap_checkpoint import TDAPCheckpoint
+
+
+def make_result(window_id):
+    return {'matrix_df': pd.DataFrame({'window_id': [window_id] * 3, 'value': range(3)}), 'output_metadata': {}}
+
+
+def make_failure(window_id):
+    return {'failure': {'person_id': window_id, 'error_type': 'OperationalError'}}
+
+
+def spilled_window_ids(checkpoint):
+    return [ret['matrix_df']['window_id'].iloc[0] for ret in checkpoint.iter_results()]
+
+
+def test_spill_directory_layout(tmp_path):
+    checkpoint = TDAPCheckpoint(tmp_path, 'run1', 'test')
+    process_df = pd.DataFrame({'window_id': [3, 1, 2], 'person_id': [30, 10, 20]})
+    checkpoint.save_state(process_df, {'person_ids': [10]})
+    checkpoint.spill_results(iter([make_result(3), make_result(1)]), [3, 1])
+    assert sorted(p.name for p in (tmp_path / 'run1').iterdir()) == ['completed.txt', 'manifest.json', 'results', 'state.pkl']
+    assert sorted(p.name for p in checkpoint.result_dir.iterdir()) == ['1.pkl', '3.pkl']
+    # completed.txt in spill order, one id per line
+    assert checkpoint.completed_path.read_text() == '3\n1\n'
+    # no temp files are left behind by the atomic writes
+    assert list(tmp_path.rglob('*.tmp')) == []
+    manifest = json.loads(checkpoint.manifest_path.read_text())
+    assert (manifest['run_id'], manifest['status'], manifest['window_count']) == ('run1', 'extracting', 3)
+    loaded_df, incremental_dict = checkpoint.load_state()
+    pd.testing.assert_frame_equal(loaded_df, process_df)
+    assert incremental_dict == {'person_ids': [10]}
+
+
+def test_results_are_matched_to_windows_by_position(tmp_path):
+    checkpoint = TDAPCheckpoint(tmp_path, 'run1', 'test')
+    window_id_list = [7, 2, 9, 4]
+    ret_list = [make_result(7), make_failure(2), make_result(9), make_result(4)]
+    failure_ret_list = checkpoint.spill_results(iter(ret_list), window_id_list)
+    assert failure_ret_list == [make_failure(2)]
+    # each result file holds the result yielded at that window's position, failures are not spilled
+    assert checkpoint.completed_window_ids() == {4, 7, 9}
+    assert spilled_window_ids(checkpoint) == [4, 7, 9]
+
+
+@pytest.mark.parametrize('result_count', [2, 4])
+def test_result_count_must_match_windows(tmp_path, result_count):
+    checkpoint = TDAPCheckpoint(tmp_path, 'run1', 'test')
+    with pytest.raises(ValueError):
+        checkpoint.spill_results(iter([make_result(w) for w in range(result_count)]), [0, 1, 2])
+
+
+def test_resume_skips_finished_windows(tmp_path):
+    checkpoint = TDAPCheckpoint(tmp_path, 'run1', 'test')
+    checkpoint.save_state(pd.DataFrame({'window_id': range(5)}))
+    checkpoint.spill_results(iter([make_result(0), make_failure(1), make_result(2)]), [0, 1, 2])
+    # killed while writing window 3: listed, but its result file never landed
+    with open(checkpoint.completed_path, 'a') as f:
+        f.write('3\n')
+    (checkpoint.result_dir / '3.pkl.tmp').write_bytes(b'partial')
+
+    resumed = TDAPCheckpoint(tmp_path, 'run1', 'test')
+    assert resumed.read_manifest()['status'] == 'extracting'
+    process_df, _ = resumed.load_state()
+    todo_df = process_df.loc[~process_df['window_id'].isin(resumed.completed_window_ids())]
+    assert todo_df['window_id'].tolist() == [1, 3, 4]
+    resumed.spill_results(iter([make_result(w) for w in todo_df['window_id']]), todo_df['window_id'].tolist())
+    assert spilled_window_ids(resumed) == [0, 1, 2, 3, 4]
+
+
+def test_new_run_gets_a_timestamp_id(tmp_path):
+    checkpoint = TDAPCheckpoint(tmp_path, None, 'test')
+    assert (tmp_path / checkpoint.run_id / 'manifest.json').exists()
+    checkpoint.set_status('written', rows=10)
+    manifest = checkpoint.read_manifest()
+    assert (manifest['status'], manifest['rows']) == ('written', 10)
+    assert 'written' in manifest
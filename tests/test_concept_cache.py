@@ -0,0 +1,99 @@
+"""
+tdap_concept_cache bulk lookup and validation of configured concept ids, on an in memory SQLite database
+"""
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+
+tdap_concept_cache = pytest.importorskip('tdap_concept_cache', exc_type=ImportError)
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine('sqlite://')
+    pd.DataFrame({
+        'concept_id': [1, 2, 3, 4],
+        'concept_name': ['hr', 'old hr', 'sepsis', 'local'],
+        'domain_id': ['Measurement', 'Measurement', 'Condition', 'Measurement'],
+        'vocabulary_id': ['LOINC', 'LOINC', 'SNOMED', 'Local'],
+        'concept_class_id': ['Lab Test', 'Lab Test', 'Clinical Finding', 'Lab Test'],
+        'standard_concept': ['S', 'S', 'S', None],
+        'concept_code': ['a', 'b', 'c', 'd'],
+        'invalid_reason': [None, 'U', None, None],
+    }).to_sql('concept', engine, index=False)
+    yield engine
+    engine.dispose()
+
+
+def make_config(tmp_path, strict=False):
+    return {
+        'concept_cache': {'enabled': True, 'path': str(tmp_path / 'cache'), 'ttl_hours': 1, 'strict': strict},
+        'concepts': {
+            'hr': {'conceptproperties': {'origintype': 'measurement', 'originid': '1,2,4'}},
+            'dx': {'conceptproperties': {'origintype': 'measurement', 'originid': [3, 99]}},
+        },
+    }
+
+
+def test_check_concepts_reports_each_problem(engine, tmp_path):
+    tdap_config = make_config(tmp_path)
+    problem_list = tdap_concept_cache.check_concepts(tdap_config, 'test', engine=engine)
+    assert problem_list == [
+        'dx: 99 is not in the concept table',
+        'hr: 2 old hr is invalid (U)',
+        'hr: 4 local is not a standard concept',
+        'dx: 3 sepsis is in domain Condition, not Measurement',
+    ]
+    # the second run is served from disk without touching the database
+    engine.dispose()
+    assert tdap_concept_cache.check_concepts(tdap_config, 'test', engine=create_engine('sqlite://')) == problem_list
+
+
+def test_strict_raises_on_unknown_ids(engine, tmp_path):
+    with pytest.raises(ValueError):
+        tdap_concept_cache.check_concepts(make_config(tmp_path, strict=True), 'test', engine=engine)
+
+
+def test_disabled_does_nothing(engine, tmp_path):
+    assert tdap_concept_cache.check_concepts({'concepts': {}}, 'test', engine=engine) is None
+
+
+def test_descendants_missing_from_originid(engine, tmp_path):
+    pd.DataFrame({'ancestor_concept_id': [1, 1, 1, 3], 'descendant_concept_id': [1, 4, 5, 6]}).to_sql('concept_ancestor', engine, index=False)
+    pd.DataFrame({'concept_id': [5, 6], 'concept_name': ['hr child', 'old sepsis child'], 'domain_id': ['Measurement', 'Condition'],
+                  'vocabulary_id': ['LOINC', 'SNOMED'], 'concept_class_id': ['Lab Test', 'Clinical Finding'],
+                  'standard_concept': ['S', 'S'], 'concept_code': ['e', 'f'], 'invalid_reason': [None, 'D']}
+                 ).to_sql('concept', engine, index=False, if_exists='append')
+    problem_list = tdap_concept_cache.check_concepts(make_config(tmp_path), 'test', engine=engine)
+    # 4 is configured (and not standard), 6 is invalid, only 5 is reported
+    assert problem_list[-1] == 'hr: 1 standard descendants are not in originid (5 hr child)'
+    assert len([x for x in problem_list if 'descendants' in x]) == 1
+
+
+def test_concept_metadata_is_memoized(engine, tmp_path, monkeypatch):
+    tapestry = pytest.importorskip('tapestry.tapestry', exc_type=ImportError)
+    call_list = []
+
+    def get_concept_metadata(engine, concept_id_list):
+        call_list.append(concept_id_list)
+        return pd.DataFrame({'concept_id': concept_id_list})
+
+    monkeypatch.setattr(tapestry, 'get_concept_metadata', get_concept_metadata)
+    monkeypatch.setattr(tdap_concept_cache, '_memo_state', {})
+    tdap_config = make_config(tmp_path)
+    tdap_concept_cache.memoize_concept_metadata(tdap_config, 'test')
+    first_df = tapestry.get_concept_metadata(engine, [1, 2])
+    first_df['concept_id'] = 0
+    # another engine on the same database is the same call, and callers can't change the memoized result
+    assert tapestry.get_concept_metadata(create_engine('sqlite://'), [1, 2])['concept_id'].tolist() == [1, 2]
+    tapestry.get_concept_metadata(engine, [3])
+    assert call_list == [[1, 2], [3]]
+
+    # a worker seeded with the parent's memo, and a later run reading the disk cache, never call through
+    memo_dict = tdap_concept_cache.get_metadata_memo()
+    for seed in [memo_dict, None]:
+        monkeypatch.setattr(tapestry, 'get_concept_metadata', get_concept_metadata)
+        monkeypatch.setattr(tdap_concept_cache, '_memo_state', {})
+        tdap_concept_cache.memoize_concept_metadata(tdap_config, 'test', seed)
+        assert tapestry.get_concept_metadata(engine, [3])['concept_id'].tolist() == [3]
+    assert call_list == [[1, 2], [3]]
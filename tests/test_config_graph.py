@@ -0,0 +1,68 @@
+"""
+tdap_config_graph consumers and the projection plan
+"""
+import tdap_config_graph
+
+
+def make_config(extensions=None, derivations=None, output_columns=None):
+    concepts = {
+        'creat': {'conceptproperties': {'origindatatype': 'numeric'}},
+        'hgb': {'conceptproperties': {'origindatatype': 'numeric'}},
+        'dx': {'conceptproperties': {'origindatatype': 'string'}},
+    }
+    return {'concepts': concepts, 'extensions': extensions or {}, 'derivations': derivations or {}, 'cleanups': {},
+            'projection': {'enabled': True, 'output_columns': output_columns}}
+
+
+def test_derivation_required_cols_keep_only_their_aggregates():
+    tdap_config = make_config(derivations={'d': {'include': True, 'config': {'required_cols': ['creat_ord_num_value_max']}}},
+                              output_columns=['dx'])
+    plan_dict = tdap_config_graph.plan_projection(tdap_config)
+    assert plan_dict['creat'] == ['max']
+    assert plan_dict['hgb'] is None
+    assert plan_dict['dx'] == list(tdap_config_graph.get_concept_aggs('string'))
+
+
+def test_extension_required_cols_are_consumed():
+    tdap_config = make_config(extensions={'e': {'include': True, 'config': {'required_cols': ['hgb_ord_num_value_min']}}},
+                              output_columns=['dx'])
+    plan_dict = tdap_config_graph.plan_projection(tdap_config)
+    assert plan_dict['hgb'] == ['min']
+    assert plan_dict['creat'] is None
+
+
+def test_module_without_required_cols_keeps_every_concept():
+    tdap_config = make_config(extensions={'e': {'include': True, 'config': {}}}, output_columns=['dx'])
+    plan_dict = tdap_config_graph.plan_projection(tdap_config)
+    assert all(aggs is not None for aggs in plan_dict.values())
+    # an excluded extension consumes nothing
+    tdap_config['extensions']['e']['include'] = False
+    assert tdap_config_graph.plan_projection(tdap_config)['creat'] is None
+
+
+def test_apply_projection_drops_pruned_concepts():
+    tdap_config = make_config(output_columns=['creat_ord_num_value_mean'])
+    projected = tdap_config_graph.apply_projection(tdap_config, 'test')
+    assert list(projected['concepts']) == ['creat']
+    assert projected['concepts']['creat']['conceptproperties']['aggregations'] == ['mean']
+    assert 'aggregations' not in tdap_config['concepts']['creat']['conceptproperties']
+
+
+def test_non_aggregate_concept_columns_keep_their_concept():
+    required_cols = ['creat_raw_timestamp', 'hgb_transaction_id', 'dx_value']
+    tdap_config = make_config(derivations={'d': {'include': True, 'config': {'required_cols': required_cols}}},
+                              output_columns=[])
+    plan_dict = tdap_config_graph.plan_projection(tdap_config)
+    assert all(plan_dict[k] is not None for k in ['creat', 'hgb', 'dx'])
+    assert tdap_config_graph.build_graph(tdap_config)[1] == {}
+
+
+def test_produced_cols_with_a_concept_prefix_are_derived():
+    derivations = {'clearance': {'include': True, 'config': {'required_cols': ['creat_ord_num_value_last'],
+                                                             'produced_cols': ['creat_clearance']}},
+                   'd': {'include': True, 'config': {'required_cols': ['creat_clearance', 'hgb_value']}}}
+    tdap_config = make_config(derivations=derivations, output_columns=[])
+    concept_dict, derived_dict = tdap_config_graph.build_graph(tdap_config)
+    assert derived_dict == {'creat_clearance': {'derivation:d'}}
+    assert concept_dict['creat']['consumers'] == {'derivation:clearance'}
+    assert concept_dict['hgb']['consumers'] == {'derivation:d'}
@@ -0,0 +1,73 @@
+"""
+tdap_distributed shard queue claims, heartbeats, stale requeues and lost claims on a local run directory
+"""
+from time import sleep
+
+import pandas as pd
+
+import tdap_distributed
+
+
+def make_queue(tmp_path, windows=5, shard_size=2):
+    queue = tdap_distributed.ShardQueue(tmp_path, 'test')
+    process_df = pd.DataFrame({'window_id': range(windows), 'person_id': range(windows), 'start_time_str': None,
+                               'end_time_str': None})
+    queue.create_shards(process_df, shard_size)
+    return queue
+
+
+def get_heartbeat(queue, shard_id):
+    return queue.conn.execute("select heartbeat from shards where shard_id = ?", (shard_id,)).fetchone()[0]
+
+
+def test_claims_every_shard_once(tmp_path):
+    queue = make_queue(tmp_path)
+    claimed = [queue.claim('a'), queue.claim('b'), queue.claim('a'), queue.claim('b')]
+    assert claimed == [(0, 1), (1, 1), (2, 1), None]
+    queue.close()
+
+
+def test_heartbeat_runs_while_the_shard_is_busy(tmp_path):
+    queue = make_queue(tmp_path)
+    shard_id, attempt = queue.claim()
+    claimed_beat = get_heartbeat(queue, shard_id)
+    with tdap_distributed.ShardHeartbeat(queue, shard_id, attempt, interval_seconds=0.05) as heartbeat:
+        # no results arrive while the main thread is busy, the beat comes from the thread
+        sleep(0.3)
+    assert get_heartbeat(queue, shard_id) > claimed_beat
+    assert not heartbeat.thread.is_alive()
+    # a shard with a fresh heartbeat is not requeued
+    assert queue.requeue_stale(60) == 0
+    queue.close()
+
+
+def test_stale_shard_is_requeued(tmp_path):
+    queue = make_queue(tmp_path)
+    shard_id, attempt = queue.claim()
+    queue.conn.execute("update shards set heartbeat = 0 where shard_id = ?", (shard_id,))
+    assert queue.live_shard_count(60) == 0
+    assert queue.requeue_stale(60) == 1
+    assert queue.claim() == (shard_id, attempt + 1)
+    assert queue.live_shard_count(60) == 1
+    queue.close()
+
+
+def test_lost_claim_changes_nothing(tmp_path):
+    queue = make_queue(tmp_path)
+    shard_id, attempt = queue.claim('a')
+    queue.conn.execute("update shards set heartbeat = 0 where shard_id = ?", (shard_id,))
+    queue.requeue_stale(60)
+    # the same worker id reclaiming is a new attempt, the old attempt's result is ignored
+    assert queue.claim('a') == (shard_id, attempt + 1)
+    queue.shard_output_dir(shard_id).mkdir(parents=True)
+    assert not queue.complete(shard_id, attempt, [{'person_id': 1}], worker_id='a')
+    assert not queue.fail(shard_id, attempt + 1, 'boom', worker_id='b')
+    assert queue.status_counts() == {'pending': 2, 'running': 1}
+    assert not (queue.shard_output_dir(shard_id) / 'failures.pkl').exists()
+    assert queue.complete(shard_id, attempt + 1, [], worker_id='a')
+    assert queue.done_shard_ids() == [shard_id]
+    # a finished shard can't be failed afterwards
+    assert not queue.fail(shard_id, attempt + 1, 'late', worker_id='a')
+    assert queue.failures() == [{'person_id': x, 'start_time_str': None, 'end_time_str': None, 'error_type': 'ShardFailed',
+                                 'error': None, 'traceback': None, 'attempts': None, 'transient': None} for x in [2, 3, 4]]
+    queue.close()
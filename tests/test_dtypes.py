@@ -0,0 +1,112 @@
+"""
+tdap_dtypes column casts from output_metadata types, and the single cast and sparse conversion after the whole patient has run
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import BigInteger, Boolean, Float, Integer, Numeric, String
+
+import tdap_dtypes
+
+SEEDS = range(20)
+
+
+@pytest.mark.parametrize('values, dtype', [
+    ([1.0, 2.0, -3.0], 'int8'),
+    ([1.0, np.nan, 3.0], 'Int8'),
+    ([1.0, 40000.0], 'int32'),
+    ([1.0, 2 ** 40], 'int64'),
+    ([np.nan, np.nan], 'Int8'),
+])
+def test_int_picks_the_smallest_width(values, dtype):
+    cast_s = tdap_dtypes.cast_column(pd.Series(values, name='a'), 'int')
+    assert str(cast_s.dtype) == dtype
+    np.testing.assert_array_equal(cast_s.astype(float).to_numpy(), np.array(values, dtype=float))
+
+
+@pytest.mark.parametrize('family, values', [
+    ('int', [1.5, 2.0]),
+    ('int', ['a', '1']),
+    ('float32', ['x', 1.0]),
+    ('bool', [0.0, 2.0]),
+    ('bool', [np.nan, np.nan]),
+    ('category', [1.0, 2.0]),
+])
+def test_values_that_do_not_fit_are_left_alone(family, values):
+    s = pd.Series(values, name='a')
+    assert tdap_dtypes.cast_column(s, family) is s
+
+
+def test_bool_is_nullable_only_with_nulls():
+    assert tdap_dtypes.cast_column(pd.Series([0.0, 1.0], name='a'), 'bool').dtype == bool
+    cast_s = tdap_dtypes.cast_column(pd.Series([0.0, np.nan, 1.0], name='a'), 'bool')
+    assert str(cast_s.dtype) == 'boolean'
+    assert cast_s.tolist() == [False, pd.NA, True]
+
+
+def test_category_by_suffix_or_ratio():
+    unique_s = pd.Series([str(x) for x in range(10)])
+    assert tdap_dtypes.cast_column(unique_s.rename('dx_native'), 'category').dtype == 'category'
+    assert tdap_dtypes.cast_column(unique_s.rename('dx'), 'category').dtype == object
+    assert tdap_dtypes.cast_column(pd.Series(['a', 'b'] * 5, name='dx'), 'category').dtype == 'category'
+    list_s = pd.Series([[1], [2]], name='dx_list')
+    assert tdap_dtypes.cast_column(list_s, 'category') is list_s
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_float32_round_trips_at_scale(seed):
+    rng = np.random.default_rng(seed)
+    values = np.where(rng.random(200) < 0.3, np.nan, rng.normal(100, 30, 200).round(2))
+    matrix_df = pd.DataFrame({'hr': values})
+    output_metadata = {'hr': Numeric(7, 2)}
+    matrix_df, _ = tdap_dtypes.cast_matrix(matrix_df, output_metadata, {})
+    assert matrix_df['hr'].dtype == np.float32
+    matrix_df = tdap_dtypes.densify_matrix(matrix_df, output_metadata=output_metadata)
+    np.testing.assert_array_equal(matrix_df['hr'].to_numpy(), values)
+
+
+def test_plan_follows_float32_mode():
+    output_metadata = {'key_time': String(), 'hr': Numeric(7, 2), 'wide': Numeric(12, 4), 'f': Float(), 'n': Integer(),
+                       'b': Boolean(), 'dx': String()}
+    assert tdap_dtypes.plan_dtypes(output_metadata) == {'hr': 'float32', 'n': 'int', 'b': 'bool', 'dx': 'category'}
+    assert tdap_dtypes.plan_dtypes(output_metadata, {'float32': 'all'})['f'] == 'float32'
+    assert 'hr' not in tdap_dtypes.plan_dtypes(output_metadata, {'float32': 'none'})
+    with pytest.raises(ValueError):
+        tdap_dtypes.plan_dtypes(output_metadata, {'float32': 'half'})
+
+
+def test_cast_once_after_the_run():
+    seen = {}
+
+    def run_func(row):
+        matrix_df = pd.DataFrame({'person_id': [row] * 4, 'dx_native': ['y', 'n', 'n', 'y'], 'n': [1.0, 2.0, 3.0, 4.0]})
+        # a derivation relabelling a string column runs inside run_func, on plain object columns
+        seen['dtype'] = matrix_df['dx_native'].dtype
+        matrix_df.loc[0, 'dx_native'] = 'unknown'
+        return {'matrix_df': matrix_df, 'output_metadata': {'person_id': BigInteger(), 'dx_native': String(), 'n': Integer()}}
+
+    run = tdap_dtypes.get_run_func({'matrix_representation': {'dtype_plan': True}}, run_func)
+    ret = run(7)
+    assert seen['dtype'] == object
+    assert ret['matrix_df']['dx_native'].dtype == 'category'
+    assert ret['matrix_df']['dx_native'].tolist() == ['unknown', 'n', 'n', 'y']
+    assert str(ret['matrix_df']['n'].dtype) == 'int8'
+    assert ret['memory_bytes'][0] > ret['memory_bytes'][1]
+    assert tdap_dtypes.get_run_func({}, run_func) is run_func
+
+
+def test_sparse_in_the_run_func():
+    def run_func(row):
+        matrix_df = pd.DataFrame({'key_time': pd.date_range('2026-01-01', periods=10, freq='h'),
+                                  'hgb_max': [np.nan] * 9 + [12.5], 'creat_max': np.arange(10.0)})
+        return {'matrix_df': matrix_df, 'output_metadata': {}}
+
+    run = tdap_dtypes.get_run_func({'matrix_representation': {'sparse': True, 'exclude_cols': ['key_time']}}, run_func)
+    ret = run(1)
+    assert isinstance(ret['matrix_df']['hgb_max'].dtype, pd.SparseDtype)
+    assert ret['matrix_df']['creat_max'].dtype == np.float64
+    assert ret['matrix_df']['key_time'].dtype == 'datetime64[ns]'
+    assert ret['memory_bytes'][0] > ret['memory_bytes'][1]
+    pd.testing.assert_frame_equal(tdap_dtypes.densify_matrix(ret['matrix_df']), run_func(1)['matrix_df'])
+    # failure records pass through
+    assert tdap_dtypes.run_compact(lambda: None, {'sparse': True}) is None
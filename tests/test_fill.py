@@ -0,0 +1,91 @@
+"""
+tdap_fill against a row by row reference of the forwardfill / fill to normal rules
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import tdap_fill
+
+
+def reference_fill(stacked_df, col_list, fillwithnormalmode, filltimetonormal, fillnormalvalue):
+    """
+    Walks each patient and column carrying the last value and a count of periods since it
+    """
+    out_df = stacked_df.sort_values(['person_id', 'key_time'], kind='mergesort').reset_index(drop=True)
+    for c in col_list:
+        values = out_df[c].tolist()
+        last_val = None
+        since = 0
+        prev_pat = None
+        for i, pat in enumerate(out_df['person_id'].tolist()):
+            if pat != prev_pat:
+                last_val = None
+                prev_pat = pat
+            if not pd.isna(values[i]):
+                last_val = values[i]
+                since = 0
+            elif last_val is not None:
+                since += 1
+                if fillwithnormalmode == 'y' and since > filltimetonormal:
+                    values[i] = fillnormalvalue
+                else:
+                    values[i] = last_val
+        out_df[c] = pd.Series(values, dtype=object).infer_objects()
+    return out_df
+
+
+def make_stacked(rng, patients, rows_per_patient, cols, sparsity):
+    n = patients * rows_per_patient
+    data = {
+        'person_id': np.repeat(np.arange(patients), rows_per_patient),
+        'key_time': np.tile(pd.date_range('2024-01-01', periods=rows_per_patient, freq='H'), patients),
+    }
+    for i in range(cols):
+        vals = rng.normal(100, 10, n).round(1)
+        data[f"c{i}"] = np.where(rng.random(n) < sparsity, vals, np.nan)
+    df = pd.DataFrame(data)
+    # shuffled so the stacked fill has to sort
+    return df.sample(frac=1, random_state=int(rng.integers(0, 1_000_000))).reset_index(drop=True)
+
+
+@pytest.mark.parametrize('seed', range(100))
+def test_stacked_matches_reference(seed):
+    rng = np.random.default_rng(seed)
+    cols = int(rng.integers(1, 5))
+    df = make_stacked(rng, int(rng.integers(1, 6)), int(rng.integers(1, 40)), cols, float(rng.random()))
+    mode = 'y' if rng.random() < 0.5 else 'n'
+    time_to_normal = int(rng.integers(0, 6))
+    normal_value = 'unk' if rng.random() < 0.5 else 0.0
+    col_list = [f"c{i}" for i in range(cols)]
+    ref_df = reference_fill(df, col_list, mode, time_to_normal, normal_value)
+    vec_df = tdap_fill.fill_columns_stacked(df.copy(), col_list, mode, time_to_normal, normal_value)
+    pd.testing.assert_frame_equal(ref_df, vec_df, check_dtype=False)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_single_patient_matches_reference(seed):
+    rng = np.random.default_rng(seed)
+    df = make_stacked(rng, 1, 50, 3, 0.3).sort_values('key_time').reset_index(drop=True)
+    col_list = ['c0', 'c1', 'c2']
+    ref_df = reference_fill(df, col_list, 'y', 2, 0.0)
+    vec_df = tdap_fill.fill_columns(df.copy(), col_list, 'y', 2, 0.0)
+    pd.testing.assert_frame_equal(ref_df, vec_df, check_dtype=False)
+
+
+def test_bool_columns_stay_boolean():
+    df = pd.DataFrame({'person_id': [1] * 4, 'key_time': pd.date_range('2024-01-01', periods=4, freq='H'),
+                       'flag': [True, None, False, None]})
+    filled = tdap_fill.fill_columns(df.copy(), ['flag'])['flag']
+    assert filled.tolist() == [True, True, False, False]
+    assert all(isinstance(x, (bool, np.bool_)) for x in filled)
+    dense = pd.DataFrame({'flag': np.array([True, False, True])})
+    assert tdap_fill.fill_columns(dense, ['flag'])['flag'].dtype == bool
+
+
+def test_native_and_other_fill_methods_are_not_filled():
+    tdap_config = {'concepts': {
+        'hr': {'conceptproperties': {'fillmethod': 'forwardfill'}},
+        'dx': {'conceptproperties': {'fillmethod': 'none'}}}}
+    df = pd.DataFrame({'hr_value_mean': [1.0, np.nan], 'hr_native': [1.0, np.nan], 'dx_value_first': [1.0, np.nan]})
+    assert tdap_fill.get_concept_fill_groups(df, tdap_config) == {('n', 0, None): ['hr_value_mean']}
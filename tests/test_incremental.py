@@ -0,0 +1,62 @@
+"""
+tdap_incremental merge of staged rows, dropped patient detection and pat_limit sampling, on an in memory SQLite database
+"""
+import random
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, inspect
+
+import tdap_incremental
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine('sqlite://')
+    pd.DataFrame({'person_id': [1, 1, 2, 3, 4], 'a': [1, 2, 3, 4, 5]}).to_sql('m', engine, index=False)
+    yield engine
+    engine.dispose()
+
+
+def read_rows(engine):
+    return sorted(pd.read_sql('select person_id, a from m', engine).itertuples(index=False, name=None))
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 1000])
+def test_merge_replaces_only_listed_patients(engine, chunk_size):
+    pd.DataFrame({'person_id': [1, 3, 3], 'a': [10, 30, 31]}).to_sql('m_incr', engine, index=False)
+    # 2 has no staged rows (dropped), 4 is not listed and keeps its rows
+    tdap_incremental.merge_staged_rows(engine, 'm', 'm_incr', [1, 2, 3], chunk_size=chunk_size)
+    assert read_rows(engine) == [(1, 10), (3, 30), (3, 31), (4, 5)]
+    assert not inspect(engine).has_table('m_incr')
+
+
+def test_merge_without_staging_only_deletes(engine):
+    tdap_incremental.merge_staged_rows(engine, 'm', 'm_incr', [2, 4])
+    assert read_rows(engine) == [(1, 1), (1, 2), (3, 4)]
+
+
+def test_failed_insert_keeps_old_rows(engine):
+    # the staged table has a column the target lacks, so the insert fails after the delete
+    pd.DataFrame({'person_id': [1], 'a': [10], 'b': [1]}).to_sql('m_incr', engine, index=False)
+    with pytest.raises(Exception):
+        tdap_incremental.merge_staged_rows(engine, 'm', 'm_incr', [1])
+    assert read_rows(engine) == [(1, 1), (1, 2), (2, 3), (3, 4), (4, 5)]
+
+
+def test_dropped_person_ids():
+    current_df = pd.DataFrame({'person_id': [1, 3]})
+    stored_df = pd.DataFrame({'person_id': [1, 2, 2, 4]})
+    assert tdap_incremental.get_dropped_person_ids(current_df, stored_df) == [2, 4]
+    assert tdap_incremental.get_dropped_person_ids(current_df, None) == []
+
+
+def test_sample_persons_keeps_whole_patients():
+    process_df = pd.DataFrame({'person_id': [1, 1, 1, 2, 2, 3, 4, 4], 'window_id': range(8)})
+    for seed in range(5):
+        random.seed(seed)
+        sampled = tdap_incremental.sample_persons(process_df, 2)
+        assert sampled['person_id'].nunique() == 2
+        # every window of a sampled patient is kept
+        pd.testing.assert_frame_equal(sampled, process_df[process_df['person_id'].isin(sampled['person_id'])])
+    assert tdap_incremental.sample_persons(process_df, 0) is process_df
+    assert tdap_incremental.sample_persons(process_df, 4) is process_df
@@ -0,0 +1,181 @@
+"""
+tdap_module_dag ordering, waves and skip propagation, with small in memory modules
+"""
+import sys
+import threading
+import types
+
+import pandas as pd
+import pytest
+
+import tdap_module_dag
+
+
+def module_entry(module, required=None, produced=None, concurrency=None):
+    config = {}
+    if required is not None:
+        config['required_cols'] = required
+    if produced is not None:
+        config['produced_cols'] = produced
+    entry = {'include': True, 'module': module, 'config': config}
+    if concurrency is not None:
+        entry['concurrency'] = concurrency
+    return entry
+
+
+def make_config(extensions=None, cleanups=None, derivations=None):
+    return {'concepts': {'a': {}, 'b': {}}, 'extensions': extensions or {}, 'cleanups': cleanups or {},
+            'derivations': derivations or {}, 'module_dag': {'enabled': True, 'max_threads': 4}}
+
+
+def build(tdap_config):
+    node_list, dep_dict, _ = tdap_module_dag.build_module_dag(tdap_config)
+    return node_list, dep_dict
+
+
+def test_topological_order_follows_columns_then_config_order():
+    tdap_config = make_config(derivations={
+        'late': module_entry('m', required=['x_early'], produced=['x_late']),
+        'early': module_entry('m', required=['a_mean'], produced=['x_early']),
+        'other': module_entry('m', required=['b_mean'], produced=['x_other']),
+    })
+    node_list, dep_dict = build(tdap_config)
+    assert tdap_module_dag.topological_order(node_list, dep_dict) == ['derivation:early', 'derivation:late', 'derivation:other']
+    assert tdap_module_dag.get_waves(node_list, dep_dict) == [['derivation:early', 'derivation:other'], ['derivation:late']]
+
+
+def test_barrier_splits_waves():
+    tdap_config = make_config(derivations={
+        'one': module_entry('m', required=['a_mean'], produced=['x1']),
+        'gate': module_entry('m', required=['a_mean']),
+        'two': module_entry('m', required=['b_mean'], produced=['x2']),
+    })
+    node_list, dep_dict = build(tdap_config)
+    assert tdap_module_dag.get_waves(node_list, dep_dict) == [['derivation:one'], ['derivation:gate'], ['derivation:two']]
+
+
+def test_cycle_raises():
+    tdap_config = make_config(derivations={
+        'p': module_entry('m', required=['x_q'], produced=['x_p']),
+        'q': module_entry('m', required=['x_p'], produced=['x_q']),
+    })
+    node_list, dep_dict = build(tdap_config)
+    with pytest.raises(tdap_module_dag.ModuleDagError, match='derivation:p, derivation:q'):
+        tdap_module_dag.topological_order(node_list, dep_dict)
+
+
+def test_thread_module_needs_produced_cols():
+    tdap_config = make_config(derivations={'t': module_entry('m', required=['a_mean'], concurrency='thread')})
+    with pytest.raises(tdap_module_dag.ModuleDagError):
+        tdap_module_dag.validate_module_dag(tdap_config, 'test')
+
+
+@pytest.fixture
+def modules(monkeypatch):
+    """
+    Registers modules that add a column, and records which thread each call ran on
+    """
+    calls = []
+
+    def make_module(name, section_func, col=None):
+        module = types.ModuleType(name)
+
+        def func(matrix_df, pat_profile_dict, output_metadata, config, logger_name, **kwargs):
+            calls.append((name, threading.current_thread().name, sorted(kwargs)))
+            if col is not None:
+                matrix_df[col] = 1
+                output_metadata[col] = None
+            return matrix_df, output_metadata
+        setattr(module, section_func, func)
+        monkeypatch.setitem(sys.modules, name, module)
+    return make_module, calls
+
+
+def run(tdap_config, matrix_df, helper_dict=None):
+    return tdap_module_dag.run_module_dag(matrix_df, {}, {}, tdap_config, 'test', helper_dict=helper_dict)
+
+
+def test_barrier_skip_does_not_reach_independent_modules(modules):
+    make_module, calls = modules
+    make_module('gate_mod', 'derive')
+    make_module('after_mod', 'derive', 'x_after')
+    tdap_config = make_config(derivations={
+        'gate': module_entry('gate_mod', required=['missing_col']),
+        'after': module_entry('after_mod', required=['a_mean'], produced=['x_after']),
+    })
+    matrix_df, _, skipped = run(tdap_config, pd.DataFrame({'a_mean': [1.0]}))
+    assert skipped == ['derivation:gate']
+    assert 'x_after' in matrix_df.columns
+
+
+def test_skip_follows_produced_columns(modules):
+    make_module, calls = modules
+    make_module('first_mod', 'derive', 'x_first')
+    make_module('second_mod', 'derive', 'x_second')
+    tdap_config = make_config(derivations={
+        'first': module_entry('first_mod', required=['missing_col'], produced=['x_first']),
+        'second': module_entry('second_mod', required=['x_first'], produced=['x_second']),
+    })
+    matrix_df, _, skipped = run(tdap_config, pd.DataFrame({'x_first': [0]}))
+    # x_first is there already, but the module that should have rewritten it was skipped
+    assert skipped == ['derivation:first', 'derivation:second']
+    assert len(calls) == 0
+
+
+def test_extensions_run_first_with_helpers(modules):
+    make_module, calls = modules
+    make_module('ext_mod', 'extend', 'ext_col')
+    make_module('der_mod', 'derive', 'x_der')
+    tdap_config = make_config(extensions={'e': module_entry('ext_mod', produced=['ext_col'], concurrency='thread')},
+                              derivations={'d': module_entry('der_mod', required=['ext_col'], produced=['x_der'])})
+    helper_dict = {'key_time_to_period': len, 'add_phase': len}
+    matrix_df, _, skipped = run(tdap_config, pd.DataFrame({'a_mean': [1.0]}), helper_dict=helper_dict)
+    assert skipped == []
+    assert [c[0] for c in calls] == ['ext_mod', 'der_mod']
+    assert calls[0][2] == ['add_phase_func', 'to_period_func']
+    assert calls[0][1] != threading.current_thread().name
+    assert calls[1][2] == ['add_phase_func']
+    assert {'ext_col', 'x_der'} <= set(matrix_df.columns)
+
+
+def test_run_omop_config_switches_every_section_off():
+    tdap_config = make_config(extensions={'e': module_entry('m')}, cleanups={'c': module_entry('m')},
+                              derivations={'d': module_entry('m')})
+    stripped = tdap_module_dag.get_run_omop_config(tdap_config)
+    assert not any(v['include'] for section in ['extensions', 'cleanups', 'derivations'] for v in stripped[section].values())
+    assert tdap_config['extensions']['e']['include']
+
+
+def register(monkeypatch, name, section_func, func):
+    module = types.ModuleType(name)
+    setattr(module, section_func, func)
+    monkeypatch.setitem(sys.modules, name, module)
+
+
+def test_thread_columns_merge_by_index(monkeypatch):
+    def derive(matrix_df, pat_profile_dict, output_metadata, config, logger_name, **kwargs):
+        # a module that reorders its copy, and is handed only its own config
+        assert 'tdap_config' not in config
+        matrix_df = matrix_df.sort_values('a_mean', ascending=False)
+        matrix_df['x_double'] = matrix_df['a_mean'] * 2
+        return matrix_df, output_metadata
+
+    register(monkeypatch, 'sort_mod', 'derive', derive)
+    tdap_config = make_config(derivations={'s': module_entry('sort_mod', required=['a_mean'], produced=['x_double'],
+                                                             concurrency='thread')})
+    matrix_df, _, _ = run(tdap_config, pd.DataFrame({'a_mean': [1.0, 3.0, 2.0]}, index=[10, 11, 12]))
+    assert matrix_df['x_double'].tolist() == [2.0, 6.0, 4.0]
+    assert matrix_df.index.tolist() == [10, 11, 12]
+
+
+def test_thread_module_changing_rows_raises(monkeypatch):
+    def derive(matrix_df, pat_profile_dict, output_metadata, config, logger_name, **kwargs):
+        matrix_df = matrix_df.iloc[1:].copy()
+        matrix_df['x_double'] = matrix_df['a_mean'] * 2
+        return matrix_df, output_metadata
+
+    register(monkeypatch, 'drop_mod', 'derive', derive)
+    tdap_config = make_config(derivations={'d': module_entry('drop_mod', required=['a_mean'], produced=['x_double'],
+                                                             concurrency='thread')})
+    with pytest.raises(tdap_module_dag.ModuleDagError):
+        run(tdap_config, pd.DataFrame({'a_mean': [1.0, 3.0, 2.0]}))
@@ -0,0 +1,131 @@
+"""
+tdap_parquet TDAPParquetWriter partitioning, growing schemas, column subsets, swap and incremental merge, on tmp_path
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import BigInteger, Boolean, DateTime, Float, Integer, String
+
+tdap_parquet = pytest.importorskip('tdap_parquet', exc_type=ImportError)
+
+SEEDS = range(3)
+OUTPUT_METADATA = {'person_id': BigInteger(), 'key_time': DateTime(), 'hgb_max': Float(), 'dx_native': Integer(),
+                   'note': String()}
+
+
+def make_matrix(rng, person_id, rows, start='2024-01-30'):
+    return pd.DataFrame({'person_id': person_id,
+                         'key_time': pd.date_range(start, periods=rows, freq='D'),
+                         'hgb_max': np.where(rng.random(rows) < 0.5, np.nan, rng.normal(12, 2, rows)),
+                         'dx_native': rng.integers(0, 2, rows),
+                         'note': rng.choice(['a', 'b', None], rows)})
+
+
+def sort_rows(df):
+    return df.sort_values(['person_id', 'key_time']).reset_index(drop=True)
+
+
+def write_all(writer, matrix_list, output_metadata=OUTPUT_METADATA):
+    for matrix_df in matrix_list:
+        writer.write(matrix_df, output_metadata)
+    writer.close()
+
+
+def assert_matrix_equal(read_df, expected_df):
+    read_df = sort_rows(read_df)
+    expected_df = sort_rows(expected_df)
+    read_df['key_time'] = read_df['key_time'].astype('datetime64[ns]')
+    read_df['note'] = read_df['note'].astype(object).where(read_df['note'].notna(), None)
+    pd.testing.assert_frame_equal(read_df, expected_df, check_dtype=False)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_person_hash_partitions(tmp_path, seed):
+    rng = np.random.default_rng(seed)
+    matrix_list = [make_matrix(rng, person_id, int(rng.integers(1, 10))) for person_id in range(12)]
+    writer = tdap_parquet.TDAPParquetWriter(tmp_path / 'm', {}, 'test', hash_buckets=4, batch_size=20)
+    write_all(writer, matrix_list)
+    expected_df = pd.concat(matrix_list, ignore_index=True)
+    assert writer.rows_written == expected_df.shape[0]
+    # every patient lives in exactly the one bucket directory its hash names
+    for bucket_dir in (tmp_path / 'm').iterdir():
+        bucket = bucket_dir.name.split('=')[1]
+        person_ids = tdap_parquet.read_matrix(bucket_dir, columns=['person_id'])['person_id'].unique()
+        assert all(b == bucket for b in tdap_parquet.person_buckets(person_ids, 4))
+    assert len(list((tmp_path / 'm').iterdir())) <= 4
+    assert_matrix_equal(tdap_parquet.read_matrix(tmp_path / 'm'), expected_df)
+
+
+def test_period_partitions(tmp_path):
+    rng = np.random.default_rng(0)
+    matrix_list = [make_matrix(rng, person_id, 5) for person_id in range(3)]
+    writer = tdap_parquet.TDAPParquetWriter(tmp_path / 'm', {}, 'test', partition_by='period', partition_period='M')
+    write_all(writer, matrix_list)
+    # 2024-01-30 plus 5 days spans January and February
+    assert sorted(p.name for p in (tmp_path / 'm').iterdir()) == ['period=2024-01', 'period=2024-02']
+    assert tdap_parquet.read_matrix(tmp_path / 'm' / 'period=2024-01').shape[0] == 6
+    with pytest.raises(ValueError):
+        tdap_parquet.TDAPParquetWriter(tmp_path / 'x', {}, 'test', partition_by='week')
+
+
+def test_columns_appearing_mid_run(tmp_path):
+    rng = np.random.default_rng(1)
+    writer = tdap_parquet.TDAPParquetWriter(tmp_path / 'm', {}, 'test', hash_buckets=2, batch_size=1)
+    first_df = make_matrix(rng, 1, 4)
+    writer.write(first_df, OUTPUT_METADATA)
+    second_df = make_matrix(rng, 2, 3).assign(kl_ratio=0.5, flag=True)
+    writer.write(second_df, {**OUTPUT_METADATA, 'kl_ratio': Float(), 'flag': Boolean()})
+    writer.close()
+    read_df = sort_rows(tdap_parquet.read_matrix(tmp_path / 'm'))
+    assert read_df['kl_ratio'].isna().tolist() == [True] * 4 + [False] * 3
+    assert read_df['flag'].tolist()[4:] == [True] * 3
+    assert read_df.columns.tolist() == list(OUTPUT_METADATA) + ['kl_ratio', 'flag']
+
+
+def test_read_column_subset_and_patients(tmp_path):
+    rng = np.random.default_rng(2)
+    matrix_list = [make_matrix(rng, person_id, 4) for person_id in range(6)]
+    write_all(tdap_parquet.TDAPParquetWriter(tmp_path / 'm', {}, 'test', hash_buckets=3), matrix_list)
+    read_df = tdap_parquet.read_matrix(tmp_path / 'm', columns=['person_id', 'hgb_max'], person_ids=[1, 4])
+    assert read_df.columns.tolist() == ['person_id', 'hgb_max']
+    expected_df = pd.concat([matrix_list[1], matrix_list[4]], ignore_index=True)[['person_id', 'hgb_max']]
+    pd.testing.assert_frame_equal(read_df.sort_values('person_id', kind='mergesort').reset_index(drop=True),
+                                  expected_df.sort_values('person_id', kind='mergesort').reset_index(drop=True),
+                                  check_dtype=False)
+    assert tdap_parquet.read_matrix(tmp_path / 'empty', columns=['person_id']).shape == (0, 1)
+
+
+def test_swap_replaces_the_live_dataset(tmp_path):
+    rng = np.random.default_rng(3)
+    tdap_config = {'tables': {'matrix_table_name': 'm'},
+                   'parquet_sink': {'enabled': True, 'path': str(tmp_path), 'hash_buckets': 2}}
+    for run in range(2):
+        writer = tdap_parquet.get_parquet_writer(tdap_config, 'test')
+        assert writer.dataset_path == tmp_path / 'm_temp'
+        matrix_list = [make_matrix(rng, run * 10 + person_id, 3) for person_id in range(3)]
+        write_all(writer, matrix_list)
+        writer.swap()
+        assert_matrix_equal(tdap_parquet.read_matrix(tmp_path / 'm'), pd.concat(matrix_list, ignore_index=True))
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['m']
+
+
+def test_incremental_merge(tmp_path):
+    rng = np.random.default_rng(4)
+    tdap_config = {'tables': {'matrix_table_name': 'm'},
+                   'parquet_sink': {'enabled': True, 'path': str(tmp_path), 'hash_buckets': 2}}
+    matrix_dict = {person_id: make_matrix(rng, person_id, 3) for person_id in range(5)}
+    writer = tdap_parquet.get_parquet_writer(tdap_config, 'test')
+    write_all(writer, matrix_dict.values())
+    writer.swap()
+
+    # 1 is rebuilt, 3 left the population, 4 left and came back, 7 is new
+    matrix_dict[1] = make_matrix(rng, 1, 5, start='2024-03-01')
+    del matrix_dict[3]
+    matrix_dict[4] = make_matrix(rng, 4, 2, start='2024-04-01')
+    matrix_dict[7] = make_matrix(rng, 7, 2)
+    writer = tdap_parquet.get_parquet_writer(tdap_config, 'test', incremental=True)
+    assert writer.dataset_path == tmp_path / 'm_incr'
+    write_all(writer, [matrix_dict[x] for x in [1, 4, 7]])
+    writer.merge([1, 3, 4, 7])
+    assert_matrix_equal(tdap_parquet.read_matrix(tmp_path / 'm'), pd.concat(matrix_dict.values(), ignore_index=True))
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['m']
@@ -0,0 +1,78 @@
+"""
+tdap_phases round trip: matrix_to_phases then phases_to_matrix gives back the matrix, dtypes included
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import tdap_phases
+
+SEEDS = range(10)
+
+
+def make_matrix(rng, patients=4, periods=30, period='H'):
+    """
+    A stacked matrix on a full period grid with long runs, nulls and one column of every dtype the pipeline produces
+    """
+    frame_list = []
+    for person_id in range(patients):
+        n = int(rng.integers(1, periods))
+        start = pd.Timestamp('2024-01-01') + pd.Timedelta(hours=int(rng.integers(0, 48)))
+        frame_list.append(pd.DataFrame({'person_id': person_id, 'key_time': pd.date_range(start, periods=n, freq=period)}))
+    matrix_df = pd.concat(frame_list, ignore_index=True)
+    n = matrix_df.shape[0]
+
+    def runs(values):
+        # repeat each drawn value a few periods so there are real phases
+        return np.repeat(values, rng.integers(1, 6, n))[:n]
+
+    float_values = runs(rng.choice([np.nan, 1.5, 2.25, -3.0], n))
+    matrix_df['f64'] = float_values
+    matrix_df['f32'] = float_values.astype(np.float32)
+    matrix_df['i8'] = runs(rng.integers(-5, 5, n)).astype(np.int8)
+    matrix_df['i64'] = runs(rng.integers(0, 10**12, n)).astype(np.int64)
+    matrix_df['flag'] = runs(rng.random(n) < 0.5)
+    matrix_df['nullable_int'] = pd.array(runs(rng.choice([1, 2, 3], n)), dtype='Int8')
+    matrix_df.loc[rng.random(n) < 0.2, 'nullable_int'] = pd.NA
+    matrix_df['nullable_flag'] = pd.array(runs(rng.random(n) < 0.5), dtype='boolean')
+    matrix_df.loc[rng.random(n) < 0.2, 'nullable_flag'] = pd.NA
+    matrix_df['text'] = pd.Series(runs(rng.choice(['low', 'normal', 'high'], n)), dtype=object)
+    matrix_df.loc[rng.random(n) < 0.2, 'text'] = None
+    matrix_df['cat'] = pd.Categorical(runs(rng.choice(['a', 'b'], n)))
+    matrix_df['when'] = pd.to_datetime('2023-06-01') + pd.to_timedelta(runs(rng.integers(0, 5, n)), unit='D')
+    matrix_df['sparse'] = pd.arrays.SparseArray(np.where(rng.random(n) < 0.8, np.nan, 7.0))
+    return matrix_df
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_round_trip(seed):
+    matrix_df = make_matrix(np.random.default_rng(seed))
+    phase_df = tdap_phases.matrix_to_phases(matrix_df, 'H')
+    rebuilt_df = tdap_phases.phases_to_matrix(phase_df, 'H')
+
+    expected_df = matrix_df.copy()
+    expected_df['sparse'] = expected_df['sparse'].sparse.to_dense()
+    # a column that is null in every row has no phases and is not rebuilt
+    expected_df = expected_df.loc[:, expected_df.notna().any()]
+    rebuilt_df = rebuilt_df.reindex(columns=expected_df.columns)
+    # object columns hold None or NaN for a missing value depending on how they were built
+    rebuilt_df['text'] = rebuilt_df['text'].where(rebuilt_df['text'].notna(), None)
+    pd.testing.assert_frame_equal(rebuilt_df, expected_df, check_categorical=False)
+    assert rebuilt_df['cat'].dtype == 'category'
+
+
+def test_compresses_runs():
+    matrix_df = pd.DataFrame({'person_id': 1, 'key_time': pd.date_range('2024-01-01', periods=100, freq='H'),
+                              'v': [1.0] * 60 + [2.0] * 40})
+    phase_df = tdap_phases.matrix_to_phases(matrix_df, 'H')
+    assert (phase_df['col_name'] == 'v').sum() == 2
+
+
+@pytest.mark.parametrize('dtype_str, expected', [('int8', 'Int8'), ('uint16', 'UInt16'), ('bool', 'boolean')])
+def test_nulls_move_to_the_nullable_dtype(dtype_str, expected):
+    # a gap in the grid becomes a null row when the window is rebuilt
+    key_time = pd.date_range('2024-01-01', periods=4, freq='H').delete(2)
+    matrix_df = pd.DataFrame({'person_id': 1, 'key_time': key_time, 'v': pd.Series([1, 0, 1], dtype=dtype_str)})
+    rebuilt_df = tdap_phases.phases_to_matrix(tdap_phases.matrix_to_phases(matrix_df, 'H'), 'H')
+    assert str(rebuilt_df['v'].dtype) == expected
+    assert rebuilt_df['v'].isna().tolist() == [False, False, True, False]
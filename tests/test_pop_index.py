@@ -0,0 +1,88 @@
+"""
+tdap_pop_index windows against a per person reference, and an index build and refresh on an in memory SQLite database
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+
+tdap_pop_index = pytest.importorskip('tdap_pop_index', exc_type=ImportError)
+
+SEEDS = range(30)
+
+
+def reference_windows(index_df, window_mode, window_days):
+    row_set = set()
+    for person_id, pat_df in index_df.groupby('person_id'):
+        if window_mode == 'per_concept':
+            row_set.update((person_id, t) for t in pat_df['first_datetime'])
+            continue
+        start_time, last_time = pat_df['first_datetime'].min(), pat_df['last_datetime'].max()
+        row_set.add((person_id, start_time))
+        while window_mode == 'span' and start_time + pd.Timedelta(days=window_days) <= last_time:
+            start_time = start_time + pd.Timedelta(days=window_days)
+            row_set.add((person_id, start_time))
+    return pd.DataFrame(sorted(row_set), columns=['person_id', 'start_time'])
+
+
+def make_index(rng):
+    row_list = []
+    for person_id in range(int(rng.integers(1, 8))):
+        for concept_key in rng.choice(['hr', 'sbp', 'dx'], int(rng.integers(1, 4)), replace=False):
+            first = pd.Timestamp('2024-01-01') + pd.Timedelta(hours=int(rng.integers(0, 24 * 30)))
+            last = first + pd.Timedelta(hours=int(rng.integers(0, 24 * 40)))
+            row_list.append((person_id, concept_key, first, last, int(rng.integers(1, 100))))
+    return pd.DataFrame(row_list, columns=tdap_pop_index.POP_INDEX_COLS)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+@pytest.mark.parametrize('window_mode', tdap_pop_index.WINDOW_MODES)
+def test_windows_match_reference(seed, window_mode):
+    rng = np.random.default_rng(seed)
+    index_df = make_index(rng)
+    window_days = int(rng.integers(1, 10))
+    pop_df = tdap_pop_index.windows_from_index(index_df, window_mode, window_days)
+    pd.testing.assert_frame_equal(pop_df, reference_windows(index_df, window_mode, window_days), check_dtype=False)
+
+
+def test_span_window_ending_on_the_last_event():
+    # the last event falls exactly on the second window's start, so it gets a third
+    index_df = pd.DataFrame([(1, 'hr', pd.Timestamp('2024-01-01'), pd.Timestamp('2024-01-15'), 3)],
+                            columns=tdap_pop_index.POP_INDEX_COLS)
+    pop_df = tdap_pop_index.windows_from_index(index_df, 'span', 7)
+    assert pop_df['start_time'].tolist() == list(pd.to_datetime(['2024-01-01', '2024-01-08', '2024-01-15']))
+
+
+def test_unknown_window_mode_raises():
+    with pytest.raises(ValueError):
+        tdap_pop_index.windows_from_index(make_index(np.random.default_rng(0)), 'last')
+
+
+def test_build_indexes_only_stale_concepts():
+    engine = create_engine('sqlite://')
+    pd.DataFrame({
+        'person_id': [1, 1, 2, 2],
+        'measurement_concept_id': [10, 10, 10, 20],
+        'measurement_datetime': pd.to_datetime(['2024-01-02', '2024-01-05', '2024-01-03', '2024-01-01']),
+    }).to_sql('measurement', engine, index=False)
+    tdap_config = {
+        'tables': {'matrix_table_name': 'm'},
+        'pop_index': {'max_age_hours': None},
+        'concepts': {
+            'hr': {'conceptproperties': {'origintype': 'measurement', 'originid': '10'}},
+            'sbp': {'conceptproperties': {'origintype': 'measurement', 'originid': [20]}},
+        },
+    }
+    assert tdap_pop_index.get_stale_concepts(engine, tdap_config) == ['hr', 'sbp']
+    tdap_pop_index.build_pop_index(engine, engine, tdap_config, 'test')
+    assert tdap_pop_index.get_stale_concepts(engine, tdap_config) == []
+    index_df = tdap_pop_index.read_pop_index(engine, tdap_config).sort_values(['concept_key', 'person_id'])
+    assert list(index_df.itertuples(index=False, name=None)) == [
+        (1, 'hr', pd.Timestamp('2024-01-02'), pd.Timestamp('2024-01-05'), 2),
+        (2, 'hr', pd.Timestamp('2024-01-03'), pd.Timestamp('2024-01-03'), 1),
+        (2, 'sbp', pd.Timestamp('2024-01-01'), pd.Timestamp('2024-01-01'), 1),
+    ]
+    # changing a concept's ids makes only that concept stale
+    tdap_config['concepts']['sbp']['conceptproperties']['originid'] = [20, 30]
+    assert tdap_pop_index.get_stale_concepts(engine, tdap_config) == ['sbp']
+    engine.dispose()
@@ -0,0 +1,98 @@
+"""
+tdap_schedule window and precount ordering, the dialect fallback and worker utilization, on a SQLite OMOP
+"""
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+
+import tdap_schedule
+
+SEEDS = range(5)
+
+
+def make_config():
+    return {'period': 'H', 'concepts': {
+        'hr': {'conceptproperties': {'origintype': 'measurement', 'originid': '1,2'}},
+        'temp': {'conceptproperties': {'origintype': 'measurement', 'originid': [3]}},
+    }}
+
+
+def make_windows(rng, windows=12):
+    start = pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 240, windows), unit='h')
+    return pd.DataFrame({'window_id': range(windows), 'person_id': rng.integers(1, 6, windows), 'start_time': start,
+                         'end_time': start + pd.to_timedelta(rng.integers(1, 4, windows), unit='D')})
+
+
+@pytest.fixture
+def engine(tmp_path):
+    # a file, since every connection to an in memory database is a new empty one
+    engine = create_engine(f"sqlite:///{tmp_path / 'omop.db'}")
+    yield engine
+    engine.dispose()
+
+
+def make_measurements(rng, rows=400):
+    return pd.DataFrame({'measurement_id': range(rows), 'person_id': rng.integers(1, 6, rows),
+                         'measurement_concept_id': rng.choice([1, 2, 3, 4], rows),
+                         'measurement_datetime': pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 400, rows), unit='h')})
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_window_cost_orders_longest_first(seed):
+    rng = np.random.default_rng(seed)
+    process_df = make_windows(rng)
+    ordered_df = tdap_schedule.order_by_cost(process_df, make_config(), 'test', method='window')
+    hours = (ordered_df['end_time'] - ordered_df['start_time']) / pd.Timedelta(hours=1)
+    assert ordered_df['cost'].tolist() == (hours * 2).tolist()
+    assert hours.is_monotonic_decreasing
+    # ties keep population order
+    for _, tie_df in ordered_df.groupby('cost'):
+        assert tie_df['window_id'].is_monotonic_increasing
+    assert 'cost' not in process_df.columns
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_precount_matches_a_pandas_count(engine, seed):
+    rng = np.random.default_rng(seed)
+    process_df = make_windows(rng)
+    measurement_df = make_measurements(rng)
+    measurement_df.to_sql('measurement', engine, index=False)
+    ordered_df = tdap_schedule.order_by_cost(process_df, make_config(), 'test', method='precount', engine=engine, chunk_size=5)
+
+    configured_df = measurement_df[measurement_df['measurement_concept_id'].isin([1, 2, 3])]
+    hours = (process_df['end_time'] - process_df['start_time']) / pd.Timedelta(hours=1)
+    expected = pd.Series([((configured_df['person_id'] == w.person_id) & (configured_df['measurement_datetime'] >= w.start_time)
+                           & (configured_df['measurement_datetime'] <= w.end_time)).sum() for w in process_df.itertuples()]) + hours
+    assert ordered_df['cost'].tolist() == expected.sort_values(ascending=False, kind='mergesort').tolist()
+    assert ordered_df['window_id'].tolist() == expected.sort_values(ascending=False, kind='mergesort').index.tolist()
+
+
+def test_precount_keeps_order_on_dialects_without_staging(caplog):
+    process_df = make_windows(np.random.default_rng(0))
+    oracle_engine = SimpleNamespace(dialect=SimpleNamespace(name='oracle'))
+    ordered_df = tdap_schedule.order_by_cost(process_df, make_config(), 'test', method='precount', engine=oracle_engine)
+    assert ordered_df is process_df
+    assert "can't stage windows on oracle" in caplog.text
+
+
+def test_unknown_method_raises():
+    with pytest.raises(ValueError):
+        tdap_schedule.order_by_cost(make_windows(np.random.default_rng(0)), make_config(), 'test', method='random')
+
+
+def test_worker_utilization():
+    utilization = tdap_schedule.WorkerUtilization('test')
+    utilization.start_time = 100.0
+    ret_list = [{'worker_stats': {'pid': 1, 'start': 100.0, 'end': 104.0}},
+                {'worker_stats': {'pid': 2, 'start': 100.0, 'end': 101.0}},
+                {'failure': {}, 'worker_stats': {'pid': 1, 'start': 104.0, 'end': 110.0}},
+                {'matrix_df': None}]
+    assert list(utilization.track(iter(ret_list))) == ret_list
+    summary_df = utilization.summary_df().set_index('pid')
+    assert summary_df['tasks'].to_dict() == {1: 2, 2: 1}
+    assert summary_df['busy_seconds'].to_dict() == {1: 10.0, 2: 1.0}
+    assert summary_df['utilization'].to_dict() == {1: 1.0, 2: 0.1}
+    assert tdap_schedule.WorkerUtilization('test').summary_df().shape[0] == 0
@@ -0,0 +1,66 @@
+"""
+tdap_timing stage recording and profiler ownership across threads
+"""
+import sys
+import threading
+import types
+
+import pytest
+
+import tdap_timing
+
+
+@pytest.fixture(autouse=True)
+def clean_state(tmp_path):
+    tdap_timing._state.update({'in_patient': False, 'patient': {}, 'run': {}, 'profile_stages': set(),
+                               'profile_dir': str(tmp_path), 'profilers': {}, 'profiling': False, 'instrumented': set()})
+    yield
+
+
+def test_threaded_stages_count_towards_the_patient():
+    def run_patient():
+        threads = [threading.Thread(target=lambda: [tdap_timing.timed('derivation:x', lambda: None)() for _ in range(50)])
+                   for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return {}
+    ret = tdap_timing.call_timed(run_patient)
+    assert ret['stage_timings']['derivation:x'][0] == 200
+    assert ret['stage_timings']['run_omop'][0] == 1
+    assert tdap_timing.run_timings() == {}
+
+
+def test_one_profiler_per_process_across_threads():
+    tdap_timing._state['profile_stages'] = {'derivation:a', 'derivation:b'}
+    inside = threading.Event()
+    release = threading.Event()
+
+    def slow():
+        with tdap_timing.stage('derivation:a'):
+            inside.set()
+            release.wait(5)
+    t = threading.Thread(target=slow)
+    t.start()
+    inside.wait(5)
+    # another thread's profiled stage while a is being profiled is only timed
+    with tdap_timing.stage('derivation:b'):
+        pass
+    release.set()
+    t.join()
+    assert set(tdap_timing._state['profilers']) == {'derivation:a'}
+    assert not tdap_timing._state['profiling']
+    with tdap_timing.stage('derivation:b'):
+        pass
+    assert set(tdap_timing._state['profilers']) == {'derivation:a', 'derivation:b'}
+    assert tdap_timing.run_timings()['derivation:b'][0] == 2
+
+
+def test_instrumented_stages_are_tracked(monkeypatch):
+    module = types.ModuleType('tdap_test_derivation')
+    module.derive = lambda *args: None
+    monkeypatch.setitem(sys.modules, 'tdap_test_derivation', module)
+    tdap_timing.instrument_modules({'derivations': {'d1': {'include': True, 'module': 'tdap_test_derivation'}}})
+    assert tdap_timing.instrumented_stages() == {'derivation:d1'}
+    assert module.derive._tdap_timed
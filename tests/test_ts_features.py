@@ -0,0 +1,115 @@
+"""
+tdap_ts_features stacked smoothing, peaks and change points against a per patient, per column reference
+"""
+import numpy as np
+import pandas as pd
+import pytest
+import ruptures as rpt
+from scipy.signal import argrelextrema
+
+import tdap_ts_features
+
+SEEDS = range(40)
+TS_CONFIG = {
+    "window_len": 4,
+    "window_type": "blackman",
+    "fill_val": 0,
+    "peak_order": 2,
+    "peak_suffix": "_peak",
+    "cp_model": "l2",
+    "cp_min_size": 2,
+    "cp_jump": 1,
+    "cp_pen": 10,
+    "cp_suffix": "_cp",
+}
+
+
+def reference_features(stacked_df, col_list, ts_config):
+    """
+    One patient and one column at a time: pad and convolve, argrelextrema, and a plain ruptures Pelt call
+    """
+    out_df = stacked_df.sort_values(['person_id', 'key_time'], kind='mergesort').reset_index(drop=True)
+    kernel = tdap_ts_features.get_kernel(ts_config['window_type'], ts_config['window_len'])
+    pad_left = (ts_config['window_len'] - 1) // 2
+    pad_right = ts_config['window_len'] - 1 - pad_left
+    for c in col_list:
+        smooth_list, peak_list, cp_list = [], [], []
+        for _, pat_df in out_df.groupby('person_id', sort=True):
+            values = pat_df[c].astype(float).fillna(ts_config['fill_val']).to_numpy()
+            smoothed = np.convolve(np.pad(values, (pad_left, pad_right), mode='edge'), kernel[::-1], mode='valid')
+            peaks = np.zeros(len(values), dtype=bool)
+            peaks[argrelextrema(smoothed, np.greater, order=ts_config['peak_order'], mode='clip')[0]] = True
+            cps = np.zeros(len(values), dtype=bool)
+            if len(values) >= 2 * ts_config['cp_min_size'] and not np.all(values == values[0]):
+                algo = rpt.Pelt(model=ts_config['cp_model'], min_size=ts_config['cp_min_size'], jump=ts_config['cp_jump'])
+                cps[algo.fit(values).predict(pen=ts_config['cp_pen'])[:-1]] = True
+            smooth_list.append(smoothed)
+            peak_list.append(peaks)
+            cp_list.append(cps)
+        out_df[c + '_smooth'] = np.concatenate(smooth_list)
+        out_df[c + ts_config['peak_suffix']] = np.concatenate(peak_list)
+        out_df[c + ts_config['cp_suffix']] = np.concatenate(cp_list)
+    return out_df
+
+
+def make_stacked(rng, patients, rows_per_patient, cols, sparsity):
+    n = patients * rows_per_patient
+    data = {
+        'person_id': np.repeat(np.arange(patients), rows_per_patient),
+        'key_time': np.tile(pd.date_range('2024-01-01', periods=rows_per_patient, freq='H'), patients),
+    }
+    for i in range(cols):
+        # level shifts every few days, so there are change points to find
+        level = np.repeat(rng.normal(100, 20, n // 72 + 1), 72)[:n]
+        vals = (level + rng.normal(0, 3, n)).round(1)
+        data[f"c{i}"] = np.where(rng.random(n) < sparsity, vals, np.nan)
+    df = pd.DataFrame(data)
+    # shuffled so the engine has to sort
+    return df.sample(frac=1, random_state=int(rng.integers(0, 1_000_000))).reset_index(drop=True)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_matches_reference(seed):
+    rng = np.random.default_rng(seed)
+    cols = int(rng.integers(1, 4))
+    ts_config = {**TS_CONFIG, 'window_len': int(rng.integers(1, 9)), 'peak_order': int(rng.integers(1, 4))}
+    df = make_stacked(rng, int(rng.integers(1, 6)), int(rng.integers(1, 200)), cols, float(rng.random()))
+    col_list = [f"c{i}" for i in range(cols)]
+    ref_df = reference_features(df, col_list, ts_config)
+    vec_df, output_metadata = tdap_ts_features.add_ts_features(df.copy(), ts_config, col_list, key_col='person_id')
+    pd.testing.assert_frame_equal(ref_df, vec_df, check_dtype=False)
+    assert set(output_metadata) == {c + s for c in col_list for s in ['_smooth', '_peak', '_cp']}
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_smooth_and_peaks_stacked_keep_patients_apart(seed):
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(1, 30, int(rng.integers(1, 6)))
+    starts = np.cumsum(lengths) - lengths
+    values = rng.normal(0, 1, lengths.sum())
+    window_len = int(rng.integers(2, 8))
+    peak_order = int(rng.integers(1, 4))
+    smoothed = tdap_ts_features.smooth_stacked(values, starts, lengths, window_len)
+    peaks = tdap_ts_features.peaks_stacked(smoothed, starts, lengths, peak_order)
+    kernel = tdap_ts_features.get_kernel('blackman', window_len)
+    pad_left = (window_len - 1) // 2
+    for start, length in zip(starts, lengths):
+        group = values[start:start + length]
+        expected = np.convolve(np.pad(group, (pad_left, window_len - 1 - pad_left), mode='edge'), kernel[::-1], mode='valid')
+        np.testing.assert_allclose(smoothed[start:start + length], expected)
+        expected_peaks = np.zeros(length, dtype=bool)
+        expected_peaks[argrelextrema(expected, np.greater, order=peak_order, mode='clip')[0]] = True
+        np.testing.assert_array_equal(peaks[start:start + length], expected_peaks)
+
+
+def test_default_method_is_pelt_with_cp_jump():
+    assert tdap_ts_features.get_cp_kwargs({})['cp_method'] == 'pelt'
+    rng = np.random.default_rng(0)
+    signal = np.repeat(rng.normal(0, 10, 40), 60) + rng.normal(0, 1, 2400)
+    expected = rpt.Pelt(model='l2', min_size=2, jump=1).fit(signal).predict(pen=10)[:-1]
+    np.testing.assert_array_equal(tdap_ts_features.change_points(signal, cp_long_len=100), expected)
+
+
+def test_unknown_cp_method_raises():
+    with pytest.raises(ValueError):
+        tdap_ts_features.get_cp_kwargs({'cp_method': 'fast'})
@@ -0,0 +1,118 @@
+"""
+tdap_windows coalescing and fan out against a per person reference on randomly generated windows
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import BigInteger, DateTime, Float
+
+import tdap_windows
+
+SEEDS = range(40)
+
+
+def reference_coalesce(window_df, merge_gap_hours, max_window_days):
+    """
+    One person and one window at a time
+    """
+    gap = pd.Timedelta(hours=merge_gap_hours)
+    max_window = pd.Timedelta(days=max_window_days) if max_window_days is not None else None
+    row_list = []
+    for person_id, pat_df in window_df.groupby('person_id', sort=True):
+        merged = None
+        for start_time, end_time in sorted(zip(pat_df['start_time'], pat_df['end_time'])):
+            within_cap = max_window is None or end_time <= merged[1] or end_time - merged[0] <= max_window \
+                if merged is not None else False
+            if merged is not None and start_time <= merged[1] + gap and within_cap:
+                merged = (merged[0], max(merged[1], end_time), merged[2] | {(start_time, end_time)})
+                continue
+            if merged is not None:
+                row_list.append((person_id, merged[0], merged[1], sorted(merged[2])))
+            merged = (start_time, end_time, {(start_time, end_time)})
+        row_list.append((person_id, merged[0], merged[1], sorted(merged[2])))
+    return pd.DataFrame(row_list, columns=['person_id', 'start_time', 'end_time', tdap_windows.SOURCE_WINDOWS_COL])
+
+
+def make_windows(rng):
+    row_list = []
+    for person_id in range(int(rng.integers(1, 6))):
+        for _ in range(int(rng.integers(1, 30))):
+            start_time = pd.Timestamp('2024-01-01') + pd.Timedelta(hours=int(rng.integers(0, 24 * 120)))
+            row_list.append((person_id, start_time, start_time + pd.Timedelta(days=int(rng.integers(1, 10)))))
+    window_df = pd.DataFrame(row_list, columns=['person_id', 'start_time', 'end_time'])
+    return window_df.sample(frac=1, random_state=int(rng.integers(0, 1_000_000))).reset_index(drop=True)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+@pytest.mark.parametrize('max_window_days', [None, 5, 30])
+def test_coalesce_matches_reference(seed, max_window_days):
+    rng = np.random.default_rng(seed)
+    window_df = make_windows(rng)
+    merge_gap_hours = int(rng.choice([0, 0, 6, 48]))
+    merged_df = tdap_windows.coalesce_windows(window_df, merge_gap_hours, max_window_days=max_window_days)
+    ref_df = reference_coalesce(window_df, merge_gap_hours, max_window_days)
+    pd.testing.assert_frame_equal(merged_df[ref_df.columns], ref_df, check_dtype=False)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_capped_windows_cover_their_sources_once(seed):
+    rng = np.random.default_rng(seed)
+    window_df = make_windows(rng)
+    merged_df = tdap_windows.coalesce_windows(window_df, 24, max_window_days=7)
+    source_list = []
+    for person_id, start_time, end_time, source_windows in merged_df[
+            ['person_id', 'start_time', 'end_time', tdap_windows.SOURCE_WINDOWS_COL]].itertuples(index=False):
+        assert all(start_time <= s and e <= end_time for s, e in source_windows)
+        # only a long window keeps going past the limit, and only with windows inside it
+        assert end_time - start_time <= pd.Timedelta(days=7) or (start_time, end_time) in source_windows
+        source_list.extend([(person_id, s, e) for s, e in source_windows])
+    assert sorted(source_list) == sorted(set(zip(window_df['person_id'], window_df['start_time'], window_df['end_time'])))
+
+
+def make_matrix(person_id, start_time, end_time):
+    key_time = pd.date_range(pd.Timestamp(start_time).floor('H'), end_time, freq='H')
+    return pd.DataFrame({'person_id': person_id, 'key_time': key_time, 'hr': np.arange(len(key_time), dtype=float)})
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_fan_out_matrix_slices_each_window(seed):
+    rng = np.random.default_rng(seed)
+    # slices are tagged by start, so one window per start
+    merged_df = tdap_windows.coalesce_windows(make_windows(rng).drop_duplicates(['person_id', 'start_time']), 0)
+    for person_id, start_time, end_time, source_windows in merged_df[
+            ['person_id', 'start_time', 'end_time', tdap_windows.SOURCE_WINDOWS_COL]].itertuples(index=False):
+        matrix_df = make_matrix(person_id, start_time, end_time)
+        out_df = tdap_windows.fan_out_matrix(matrix_df, source_windows, 'H')
+        assert out_df[tdap_windows.WINDOW_START_COL].nunique() == len(source_windows)
+        for one_start, one_end in source_windows:
+            one_df = out_df.loc[out_df[tdap_windows.WINDOW_START_COL] == one_start]
+            expected = matrix_df.loc[(matrix_df['key_time'] >= one_start.floor('H')) & (matrix_df['key_time'] <= one_end)]
+            assert one_df['key_time'].tolist() == expected['key_time'].tolist()
+            assert one_df['hr'].tolist() == expected['hr'].tolist()
+
+
+def test_fan_out_results_with_overlapping_merges():
+    # the cap splits these into two merged windows that overlap on 2024-01-05
+    window_df = pd.DataFrame({'person_id': [1, 1], 'start_time': pd.to_datetime(['2024-01-01', '2024-01-04']),
+                              'end_time': pd.to_datetime(['2024-01-06', '2024-01-09'])})
+    process_df = tdap_windows.coalesce_windows(window_df, 0, max_window_days=7)
+    assert process_df.shape[0] == 2
+    ret_list = [{'matrix_df': make_matrix(1, s, e), 'output_metadata': {'person_id': BigInteger(), 'key_time': DateTime(),
+                                                                        'hr': Float()}}
+                for s, e in zip(process_df['start_time'], process_df['end_time'])]
+    out_list = list(tdap_windows.fan_out_results(iter(ret_list), process_df, {'period': 'H'}))
+    # each original window comes out once, from the merged window it belongs to
+    assert [x['matrix_df'][tdap_windows.WINDOW_START_COL].unique().tolist() for x in out_list] == \
+        [[pd.Timestamp('2024-01-01')], [pd.Timestamp('2024-01-04')]]
+    assert all(tdap_windows.WINDOW_START_COL in x['output_metadata'] for x in out_list)
+
+
+def test_single_long_window_is_kept():
+    # the window inside the long one (and its duplicate) merge into it, the one running past its end does not
+    window_df = pd.DataFrame({'person_id': [1, 1, 1, 1],
+                              'start_time': pd.to_datetime(['2024-01-01', '2024-01-01', '2024-01-02', '2024-02-28']),
+                              'end_time': pd.to_datetime(['2024-03-01', '2024-03-01', '2024-01-03', '2024-03-02'])})
+    merged_df = tdap_windows.coalesce_windows(window_df, 0, max_window_days=7)
+    assert list(zip(merged_df['start_time'], merged_df['end_time'])) == [
+        (pd.Timestamp('2024-01-01'), pd.Timestamp('2024-03-01')), (pd.Timestamp('2024-02-28'), pd.Timestamp('2024-03-02'))]
+    assert len(merged_df[tdap_windows.SOURCE_WINDOWS_COL].iloc[0]) == 2
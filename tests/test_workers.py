@@ -0,0 +1,83 @@
+"""
+tdap_workers call_with_retry retries, backoff and failure records, and record_failures, with a fake patient function
+"""
+import pytest
+from sqlalchemy import exc as sa_exc
+
+tdap_workers = pytest.importorskip('tdap_workers', exc_type=ImportError)
+
+ARGS = (42, '2024-01-01 00:00:00', '2024-01-08 00:00:00')
+
+
+class FlakyFunc:
+    """
+    Raises each of errors in turn, then returns a result for the patient
+    """
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self, person_id, start_time_str, end_time_str):
+        self.calls += 1
+        if len(self.errors) > 0:
+            raise self.errors.pop(0)
+        return {'person_id': person_id}
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleep_list = []
+    monkeypatch.setattr(tdap_workers, 'sleep', sleep_list.append)
+    # jitter at its top end, so the cap is what's checked
+    monkeypatch.setattr(tdap_workers.random, 'uniform', lambda a, b: b)
+    return sleep_list
+
+
+def operational_error():
+    return sa_exc.OperationalError('select 1', {}, Exception('connection reset'))
+
+
+def test_transient_errors_are_retried(sleeps):
+    func = FlakyFunc([operational_error(), ConnectionError('reset')])
+    ret = tdap_workers.call_with_retry(func, ARGS, 'test', max_retries=3, backoff_seconds=2)
+    assert ret == {'person_id': 42}
+    assert func.calls == 3
+    assert sleeps == [2 * 1.5, 4 * 1.5]
+
+
+def test_backoff_is_capped(sleeps):
+    func = FlakyFunc([TimeoutError()] * 6)
+    ret = tdap_workers.call_with_retry(func, ARGS, 'test', max_retries=6, backoff_seconds=2, max_backoff_seconds=10)
+    assert 'failure' not in ret
+    assert sleeps == [x * 1.5 for x in [2, 4, 8, 10, 10, 10]]
+
+
+def test_failure_record_after_retries_run_out(sleeps):
+    func = FlakyFunc([operational_error()] * 5)
+    ret = tdap_workers.call_with_retry(func, ARGS, 'test', max_retries=2)
+    assert func.calls == 3
+    failure = ret['failure']
+    assert (failure['person_id'], failure['start_time_str'], failure['end_time_str']) == ARGS
+    assert (failure['error_type'], failure['attempts'], failure['transient']) == ('OperationalError', 3, True)
+    assert 'connection reset' in failure['traceback']
+
+
+def test_other_errors_fail_at_once(sleeps):
+    func = FlakyFunc([KeyError('MissingRequiredCols')])
+    ret = tdap_workers.call_with_retry(func, ARGS, 'test', max_retries=3)
+    assert func.calls == 1
+    assert sleeps == []
+    assert (ret['failure']['error_type'], ret['failure']['attempts'], ret['failure']['transient']) == ('KeyError', 1, False)
+
+
+def test_record_failures_keeps_good_results_flowing(sleeps):
+    func_list = [FlakyFunc([]), FlakyFunc([ValueError('bad row')]), FlakyFunc([]), FlakyFunc([ZeroDivisionError()])]
+    ret_iter = (tdap_workers.call_with_retry(func, (person_id,) + ARGS[1:], 'test') for person_id, func in enumerate(func_list))
+    failure_list = []
+    assert list(tdap_workers.record_failures(ret_iter, failure_list)) == [{'person_id': 0}, {'person_id': 2}]
+    assert [(x['person_id'], x['error_type']) for x in failure_list] == [(1, 'ValueError'), (3, 'ZeroDivisionError')]
+
+
+def test_retry_kwargs_from_config():
+    tdap_config = {'databases': {'omop': {'max_retries': 5, 'retry_max_backoff_seconds': 30}}}
+    assert tdap_workers.get_retry_kwargs(tdap_config) == {'max_retries': 5, 'backoff_seconds': 2, 'max_backoff_seconds': 30}
@@ -0,0 +1,109 @@
+"""
+tdap_writer TDAPMatrixWriter buffering, flushes, compact matrices and a growing schema, on a SQLite database
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import BigInteger, DateTime, Float, Integer, Numeric, String, create_engine, inspect
+
+import tdap_dtypes
+from tdap_writer import TDAPMatrixWriter
+
+SEEDS = range(5)
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'writer.db'}")
+    yield engine
+    engine.dispose()
+
+
+OUTPUT_METADATA = {'person_id': BigInteger(), 'key_time': DateTime(), 'hgb_max': Numeric(6, 2), 'dx_native': Integer()}
+
+
+def make_matrix(rng, person_id, rows):
+    return pd.DataFrame({'person_id': person_id,
+                         'key_time': pd.date_range('2024-01-01', periods=rows, freq='H'),
+                         'hgb_max': np.where(rng.random(rows) < 0.7, np.nan, rng.normal(12, 2, rows).round(2)),
+                         'dx_native': rng.integers(0, 2, rows)})
+
+
+def read_table(engine, table_name='m'):
+    return pd.read_sql(f"select * from {table_name}", engine, parse_dates=['key_time'])
+
+
+def row_count(engine, table_name='m'):
+    if not inspect(engine).has_table(table_name):
+        return None
+    return read_table(engine, table_name).shape[0]
+
+
+def test_flushes_at_batch_size(engine):
+    rng = np.random.default_rng(0)
+    writer = TDAPMatrixWriter(engine, 'm', OUTPUT_METADATA, 'test', batch_size=10)
+    writer.write(make_matrix(rng, 1, 6))
+    # below batch_size nothing is written, the table isn't even created
+    assert row_count(engine) is None
+    assert writer.buffer_rows == 6
+    writer.write(make_matrix(rng, 2, 6))
+    assert row_count(engine) == 12
+    assert (writer.buffer_rows, writer.buffer_list, writer.rows_written) == (0, [], 12)
+    writer.write(make_matrix(rng, 3, 3))
+    assert row_count(engine) == 12
+    writer.close()
+    assert row_count(engine) == 15
+    assert writer.rows_written == 15
+    # closing with an empty buffer writes nothing more
+    writer.close()
+    assert writer.rows_written == 15
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_compact_matrices_are_written_dense(engine, seed):
+    rng = np.random.default_rng(seed)
+    matrix_list = [make_matrix(rng, person_id, int(rng.integers(1, 30))) for person_id in range(4)]
+    writer = TDAPMatrixWriter(engine, 'm', OUTPUT_METADATA, 'test', batch_size=25)
+    rep_config = {'dtype_plan': True, 'sparse': True, 'max_density': 0.5, 'exclude_cols': ['key_time']}
+    for matrix_df in matrix_list:
+        ret = tdap_dtypes.run_compact(lambda: {'matrix_df': matrix_df.copy(), 'output_metadata': OUTPUT_METADATA}, rep_config)
+        writer.write(ret['matrix_df'])
+    writer.close()
+    expected_df = pd.concat(matrix_list, ignore_index=True)
+    pd.testing.assert_frame_equal(read_table(engine), expected_df, check_dtype=False)
+
+
+def test_output_metadata_grows(engine):
+    rng = np.random.default_rng(1)
+    writer = TDAPMatrixWriter(engine, 'm', {}, 'test', batch_size=6)
+    writer.write(make_matrix(rng, 1, 4), {'person_id': BigInteger(), 'key_time': DateTime()})
+    # before the table exists the schema just grows
+    writer.write(make_matrix(rng, 2, 4), OUTPUT_METADATA)
+    assert [c['name'] for c in inspect(engine).get_columns('m')] == list(OUTPUT_METADATA)
+    assert row_count(engine) == 8
+    writer.write(make_matrix(rng, 3, 2))
+    writer.write(make_matrix(rng, 4, 3).assign(kl_ratio=0.5), {**OUTPUT_METADATA, 'kl_ratio': Float()})
+    # the buffer shaped by the old schema is flushed before the column is added
+    assert row_count(engine) == 10
+    assert 'kl_ratio' in [c['name'] for c in inspect(engine).get_columns('m')]
+    writer.close()
+    table_df = read_table(engine)
+    assert table_df['kl_ratio'].isna().tolist() == [True] * 10 + [False] * 3
+    assert table_df['person_id'].tolist() == [1] * 4 + [2] * 4 + [3] * 2 + [4] * 3
+    assert writer.rows_written == 13
+    assert list(writer.output_metadata) == list(OUTPUT_METADATA) + ['kl_ratio']
+
+
+def test_attach_existing_appends(engine):
+    rng = np.random.default_rng(2)
+    writer = TDAPMatrixWriter(engine, 'm', OUTPUT_METADATA, 'test')
+    writer.write(make_matrix(rng, 1, 5))
+    writer.close()
+    writer = TDAPMatrixWriter(engine, 'm', {}, 'test')
+    assert writer.attach_existing()
+    writer.write(make_matrix(rng, 2, 2).assign(note='x'), {'note': String()})
+    writer.close()
+    table_df = read_table(engine)
+    assert table_df['person_id'].tolist() == [1] * 5 + [2] * 2
+    assert table_df['note'].tolist() == [None] * 5 + ['x'] * 2
+    assert not TDAPMatrixWriter(engine, 'other', {}, 'test').attach_existing()